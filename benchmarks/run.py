@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""
+CareSync - data layer and reminder micro-benchmarks
+Builds a seeded synthetic database, times every database helper and the
+reminder logic on it, writes the timings as JSON and compares them with a
+saved baseline, exiting with status 1 on a regression:
+
+    python benchmarks/run.py --save-baseline     # on the main branch
+    python benchmarks/run.py                     # on your change
+"""
+
+import argparse
+import inspect
+import itertools
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# Add the caresync directory to the Python path
+sys.path.insert(0, os.path.join(HERE, '..', 'caresync'))
+
+from common import database
+from common.models import DoseEvent, Medication, doses_due_soon, minutes_of, split_open_doses
+
+import synthetic
+
+MIN_ROUNDS = 5
+MAX_ROUNDS = 500
+TIME_BUDGET = 0.5  # seconds spent on each benchmark once MIN_ROUNDS are done
+TOLERANCE = 0.25  # this much slower than the baseline is a regression
+COMPARE = 'min_ms'  # the fastest round is the one least disturbed by the rest of the machine
+NOISE_FLOOR_MS = 0.02  # differences smaller than this are never regressions
+BULK_ROWS = 1000
+
+# Database helpers that are plumbing rather than data access
+NOT_BENCHMARKED = {'cached', 'close_pool'}
+
+BENCHMARKS = []  # (name, database functions covered, callable)
+
+
+def bench(name, covers=()):
+    covers = (covers,) if isinstance(covers, str) else covers
+
+    def register(func):
+        BENCHMARKS.append((name, covers, func))
+        return func
+    return register
+
+
+def read(name, func):
+    """Register a cached read twice: served from the query cache, and with the cache cleared first."""
+    covers = name.split('(')[0]
+    bench(name, covers)(func)
+    bench(name + ' [uncached]', covers)(lambda: (database.clear_cache(), func()))
+
+
+class IdleOutbox:
+    """Stands in for the delivery worker: reminders are still claimed and queued, just never sent."""
+
+    def start(self):
+        pass
+
+    def wake(self):
+        pass
+
+
+def define(user_id, scratch_id):
+    """Register the benchmarks for a database whose main user is user_id.
+
+    Writes go to the scratch user where they would otherwise change what the
+    read benchmarks see.
+    """
+    today = date.today()
+    month_ago = (today - timedelta(days=30)).isoformat()
+    year_ago = (today - timedelta(days=365)).isoformat()
+    meds = database.get_today_medications(user_id)[0]
+    counter = itertools.count(1)
+
+    # Reads
+    read('load_dashboard_snapshot', lambda: database.load_dashboard_snapshot(user_id))
+    read('get_today_medications', lambda: database.get_today_medications(user_id))
+    read('get_users', database.get_users)
+    read('get_moods', lambda: database.get_moods(user_id))
+    read('get_journals', lambda: database.get_journals(user_id))
+    read('get_mood_series(raw, all time)', lambda: database.get_mood_series(user_id=user_id))
+    read('get_mood_series(weekly, year)', lambda: database.get_mood_series(year_ago, None, 'weekly', user_id=user_id))
+    read('get_mood_series(monthly, all time)', lambda: database.get_mood_series(granularity='monthly', user_id=user_id))
+    read('get_weekly_summaries', lambda: database.get_weekly_summaries(today.isoformat(), 26, user_id))
+    read('get_journal_tone(weekly, year)', lambda: database.get_journal_tone(year_ago, None, 'weekly', user_id))
+    read('get_adherence(month)', lambda: database.get_adherence(month_ago, today.isoformat(), user_id))
+    read('get_adherence(year)', lambda: database.get_adherence(year_ago, today.isoformat(), user_id))
+    read('get_medication_adherence(all time)', lambda: database.get_medication_adherence(user_id=user_id))
+    read('get_medication_adherence(month)', lambda: database.get_medication_adherence(month_ago, None, user_id))
+    read('search_journals', lambda: database.search_journals('tired sleep', user_id=user_id))
+    bench('get_sent_reminders', 'get_sent_reminders')(lambda: database.get_sent_reminders(today.isoformat()))
+    bench('next_outbox_due', 'next_outbox_due')(database.next_outbox_due)
+    bench('get_dose_logs', 'get_dose_logs')(lambda: database.get_dose_logs(today.isoformat(), user_id))
+    bench('get_notification_settings', 'get_notification_settings')(lambda: database.get_notification_settings(user_id))
+    bench('get_all_notification_settings', 'get_all_notification_settings')(database.get_all_notification_settings)
+    bench('export_chunks(moods)', 'export_chunks')(lambda: sum(map(len, database.export_chunks('moods', user_id))))
+
+    # Writes
+    bench('add_mood', 'add_mood')(lambda: database.add_mood(3, "😐", scratch_id))
+    bench('add_journal', 'add_journal')(lambda: database.add_journal("Felt calm after a short walk.", scratch_id))
+    bench('save_notification_settings', 'save_notification_settings')(
+        lambda: database.save_notification_settings(database.NOTIFICATION_DEFAULTS, scratch_id))
+    scratch_med = [None]
+
+    @bench('add_medication', 'add_medication')
+    def add_medication():
+        database.add_medication("Benchmark", "1mg", "Once daily", "08:00:00", scratch_id)
+
+    @bench('log_medication', 'log_medication')
+    def log_medication():
+        if scratch_med[0] is None:
+            scratch_med[0] = database.get_today_medications(scratch_id)[0][0].id
+        database.log_medication(scratch_med[0], "taken" if next(counter) % 2 else "missed", scratch_id)
+
+    bench('add_user', 'add_user')(lambda: database.add_user(f"Benchmark {next(counter)}"))
+    bench('get_identity_user', 'get_identity_user')(lambda: database.get_identity_user("benchmark@example.com"))
+
+    def old_days(n):
+        # Distinct days long before the synthetic history, one batch after another
+        start = date(1990, 1, 1) + timedelta(days=next(counter) * n)
+        return [(start + timedelta(days=i)).isoformat() for i in range(n)]
+
+    bench(f'log_medications_bulk({BULK_ROWS})', 'log_medications_bulk')(lambda: database.log_medications_bulk(
+        [(scratch_med[0], day, "taken") for day in old_days(BULK_ROWS)], scratch_id))
+    bench(f'add_moods_bulk({BULK_ROWS})', 'add_moods_bulk')(lambda: database.add_moods_bulk(
+        [(4, "🙂", day) for day in old_days(BULK_ROWS)], scratch_id))
+    bench(f'add_journals_bulk({BULK_ROWS})', 'add_journals_bulk')(lambda: database.add_journals_bulk(
+        [("Slept well and felt rested, a good day.", day) for day in old_days(BULK_ROWS)], scratch_id))
+    bench('rescore_journals', 'rescore_journals')(lambda: database.rescore_journals(user_id=user_id))
+    bench('claim_reminder', 'claim_reminder')(lambda: database.claim_reminder(meds[0].id, today.isoformat(), next(counter)))
+
+    @bench('outbox round trip', ('enqueue_notifications', 'claim_outbox', 'complete_outbox', 'retry_outbox', 'fail_outbox'))
+    def outbox_round_trip():
+        n = next(counter)
+        database.enqueue_notifications([(f"bench:{n}:{channel}", channel, "Title", "Message")
+                                        for channel in ('email', 'desktop', 'mobile')], user_id)
+        items = database.claim_outbox(3, 60)
+        database.complete_outbox(items[0].id)
+        database.retry_outbox(items[1].id, 3600, "benchmark")
+        database.fail_outbox(items[2].id, "benchmark")
+
+    # Plumbing
+    bench('init_db', 'init_db')(database.init_db)
+    bench('get_pool', 'get_pool')(database.get_pool)
+    bench('cache_stats', 'cache_stats')(database.cache_stats)
+    bench('clear_cache', 'clear_cache')(database.clear_cache)
+    bench('chunked(10000)', 'chunked')(lambda: sum(map(len, database.chunked(range(10000), 500))))
+
+    @bench('transaction(read)', 'transaction')
+    def read_transaction():
+        with database.transaction(write=False):
+            pass
+
+    @bench('after_commit', 'after_commit')
+    def after_commit():
+        with database.transaction(invalidate=False):
+            database.after_commit(lambda: None)
+
+    @bench('migrate(fresh)', 'migrate')
+    def migrate():
+        conn = sqlite3.connect(':memory:', isolation_level=None)
+        database.migrate(conn)
+        conn.close()
+
+    # Reminder logic
+    snapshot = database.load_dashboard_snapshot(user_id)
+    now = minutes_of(datetime.now())
+    # Every medication of the snapshot, due around now, so the classification has work to do
+    doses = [DoseEvent(Medication(m.id, m.name, m.dose, m.frequency, (now + offset) % (24 * 60), user_id), today.isoformat())
+             for m, offset in zip(snapshot.medications, itertools.cycle([-45, -20, -5, 10, 25, 50]))]
+    bench('med_schedule overdue/upcoming')(lambda: split_open_doses(doses, now))
+    bench('med_schedule due soon')(lambda: doses_due_soon(doses, now))
+
+    try:
+        from common.notifications import NotificationManager
+    except ImportError:
+        print("Skipping the notification benchmarks: streamlit is not installed", file=sys.stderr)
+        return
+    manager = NotificationManager()
+    manager.outbox = IdleOutbox()
+    settings = dict(database.NOTIFICATION_DEFAULTS, desktop_enabled=True)
+    due = [dose.medication for dose in doses]
+    # The first call claims and queues the reminders; every later one (as on
+    # each rerun) finds them already claimed
+    bench('check_and_send_reminders')(lambda: manager.check_and_send_reminders(due, settings))
+    bench('send_reminders_once(new)')(lambda: manager.send_reminders_once(
+        [DoseEvent(med, today.isoformat(), next(counter)) for med in due], settings))
+
+
+def measure(func):
+    times = []
+    started = time.perf_counter()
+    while len(times) < MAX_ROUNDS and (len(times) < MIN_ROUNDS or time.perf_counter() - started < TIME_BUDGET):
+        t = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t)
+    times = sorted(t * 1000 for t in times)
+    return {
+        'median_ms': statistics.median(times),
+        'p95_ms': times[min(len(times) - 1, int(len(times) * 0.95))],
+        'min_ms': times[0],
+        'rounds': len(times),
+    }
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """[(name, baseline ms, ms, ratio)] of the benchmarks that got slower than tolerance allows."""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        before, after = base[COMPARE], result[COMPARE]
+        if after - before > NOISE_FLOOR_MS and after > before * (1 + tolerance):
+            regressions.append((name, before, after, after / before))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the CareSync data layer and reminder logic.")
+    parser.add_argument("--users", type=int, default=3)
+    parser.add_argument("--medications", type=int, default=5, help="medications per user")
+    parser.add_argument("--years", type=float, default=3, help="years of history per user")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--filter", default="", help="only run benchmarks whose name contains this")
+    parser.add_argument("--output", default=os.path.join(HERE, "results.json"))
+    parser.add_argument("--baseline", default=os.path.join(HERE, "baseline.json"))
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="caresync-bench-")
+    try:
+        database.DB_PATH = os.path.join(workdir, "bench.db")
+        started = time.perf_counter()
+        counts = synthetic.generate(args.users, args.medications, args.years, args.seed)
+        print(f"Generated {counts['med_logs']} medication logs, {counts['moods']} moods and {counts['journals']} "
+              f"journal entries for {args.users} users in {time.perf_counter() - started:.1f}s")
+
+        define(counts['users'][0], database.add_user("Benchmark scratch"))
+        covered = {name for _, covers, _ in BENCHMARKS for name in covers}
+        public = {name for name, obj in vars(database).items()
+                  if inspect.isfunction(obj) and not name.startswith('_') and obj.__module__ == database.__name__}
+        missing = sorted(public - covered - NOT_BENCHMARKED)
+        if missing:
+            print(f"No benchmark for: {', '.join(missing)}", file=sys.stderr)
+
+        results = {}
+        for name, _, func in BENCHMARKS:
+            if args.filter in name:
+                results[name] = measure(func)
+        database.close_pool()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'users': args.users, 'medications': args.medications, 'years': args.years, 'seed': args.seed,
+            'rows': {kind: counts[kind] for kind in ('medications', 'med_logs', 'moods', 'journals')},
+        },
+        'results': results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    width = max(map(len, results), default=0)
+    print(f"{'benchmark':<{width}}  {'min ms':>10}  {'median ms':>10}  {'p95 ms':>10}  {'rounds':>6}  {'vs baseline':>11}")
+    for name, result in results.items():
+        change = f"{result[COMPARE] / baseline[name][COMPARE] - 1:+.0%}" if name in baseline and baseline[name][COMPARE] else ""
+        print(f"{name:<{width}}  {result['min_ms']:>10.3f}  {result['median_ms']:>10.3f}  {result['p95_ms']:>10.3f}  "
+              f"{result['rounds']:>6}  {change:>11}")
+
+    if args.save_baseline:
+        shutil.copyfile(args.output, args.baseline)
+        print(f"Saved as the baseline in {args.baseline}")
+        return 0
+    regressions = compare(results, baseline, args.tolerance)
+    for name, before, after, ratio in regressions:
+        print(f"REGRESSION {name}: {before:.3f} ms -> {after:.3f} ms ({ratio:.2f}x)", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
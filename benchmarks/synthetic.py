@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+CareSync - seeded synthetic history
+Fills a database with users, medications, and years of medication logs,
+moods and journal entries, through the same bulk writers the importer uses.
+The same seed and sizes always give the same data:
+
+    python benchmarks/synthetic.py synthetic.db --users 5 --medications 6 --years 3 --seed 1
+"""
+
+import argparse
+import os
+import random
+import sys
+from datetime import date, timedelta
+
+# Add the caresync directory to the Python path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'caresync'))
+
+from common import database
+
+MOODS = [(5, "😃"), (4, "🙂"), (3, "😐"), (2, "😔"), (1, "😢")]
+FREQUENCIES = ["Once daily", "Twice daily", "Three times daily", "As needed"]
+DRUGS = ["Aspirin", "Metformin", "Lisinopril", "Atorvastatin", "Levothyroxine", "Sertraline", "Omeprazole",
+         "Amlodipine", "Vitamin D", "Ibuprofen"]
+# Journal sentences by mood, so entries carry some lexicon words for the sentiment scoring
+SENTENCES = {
+    5: ["Had a great day and felt really happy.", "Went for a long walk, feeling energized and grateful.",
+        "Laughed a lot with friends tonight."],
+    4: ["Pretty good day overall.", "Felt calm and rested after a good night's sleep.",
+        "Productive morning, a bit tired by the evening."],
+    3: ["An okay day, nothing special.", "Work was fine, slept so-so.", "Felt a little restless but steady."],
+    2: ["Feeling low and tired today.", "Stressed about work and didn't sleep well.",
+        "A bit lonely this evening."],
+    1: ["Really bad day, felt hopeless and exhausted.", "Anxious all day and couldn't relax.",
+        "Cried this afternoon, everything felt overwhelming."],
+}
+FILLER = ["Made dinner.", "Read a few chapters.", "Called my sister.", "Cleaned the kitchen.", "Watched a film.",
+          "Took the bus to town.", "Worked on the garden.", "Had a headache around noon."]
+
+
+def _days(years, end):
+    start = end - timedelta(days=round(365.25 * years) - 1)
+    return [start + timedelta(days=i) for i in range((end - start).days + 1)]
+
+
+def generate(users=3, medications=4, years=2, seed=0, end=None):
+    """Write a synthetic history into the current database.DB_PATH.
+
+    Each user gets `medications` medications and a log per medication per
+    day, one or two moods a day and a journal entry on most days, for the
+    `years` years up to `end` (today by default). Returns
+    {'users': [ids], 'medications', 'med_logs', 'moods', 'journals': counts}.
+    """
+    rng = random.Random(seed)
+    days = _days(years, end or date.today())
+    counts = {"users": [], "medications": 0, "med_logs": 0, "moods": 0, "journals": 0}
+    database.init_db()
+    for n in range(users):
+        user_id = database.add_user(f"Synthetic {seed}-{n + 1}")
+        counts["users"].append(user_id)
+        adherence = rng.uniform(0.6, 0.98)
+
+        for m in range(medications):
+            minutes = rng.randrange(6 * 60, 22 * 60, 15)
+            database.add_medication(f"{rng.choice(DRUGS)} {m + 1}", f"{rng.choice([5, 10, 20, 50, 100])}mg",
+                                    rng.choice(FREQUENCIES), f"{minutes // 60:02d}:{minutes % 60:02d}:00", user_id)
+        med_ids = [med.id for med in database.get_today_medications(user_id)[0]]
+        counts["medications"] += len(med_ids)
+
+        counts["med_logs"] += database.log_medications_bulk(
+            ((med_id, day.isoformat(), "taken" if rng.random() < adherence else "missed")
+             for day in days for med_id in med_ids), user_id)
+
+        # Moods drift slowly, journals follow the day's mood
+        mood = 3.0
+        moods, journals = [], []
+        for day in days:
+            mood = min(5.0, max(1.0, mood + rng.gauss(0, 0.6) + (3.2 - mood) * 0.1))
+            for _ in range(rng.choice([1, 1, 2])):
+                score = min(5, max(1, round(mood + rng.gauss(0, 0.5))))
+                moods.append((score, dict(MOODS)[score], day.isoformat()))
+            if rng.random() < 0.7:
+                score = round(mood)
+                entry = " ".join([rng.choice(SENTENCES[score])] + rng.sample(FILLER, rng.randint(0, 3)))
+                journals.append((entry, day.isoformat()))
+        counts["moods"] += database.add_moods_bulk(moods, user_id)
+        counts["journals"] += database.add_journals_bulk(journals, user_id)
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fill a CareSync database with a seeded synthetic history.")
+    parser.add_argument("db", help="database file to create or add to")
+    parser.add_argument("--users", type=int, default=3)
+    parser.add_argument("--medications", type=int, default=4, help="medications per user")
+    parser.add_argument("--years", type=float, default=2, help="years of history per user")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    database.DB_PATH = args.db
+    counts = generate(args.users, args.medications, args.years, args.seed)
+    print(f"{len(counts['users'])} users, {counts['medications']} medications, {counts['med_logs']} medication logs, "
+          f"{counts['moods']} moods, {counts['journals']} journal entries written to {args.db}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,26 @@
 import streamlit as st
+import tempfile
 from medication import med_schedule, side_effects_ai
 from mental_health import mood_tracker, journal, mood_trends
-from common import database, utils
-from common.notifications import notification_manager
+from common import database, export, metrics, utils
+from common.notifications import get_email_password, notification_manager
+from common.scheduler import reminder_scheduler
 
-# Initialize session state variables
-if 'notification_settings' not in st.session_state:
-    st.session_state.notification_settings = {
-        'email_enabled': False,
-        'email_address': '',
-        'email_password': '',
-        'desktop_enabled': False,
-        'mobile_enabled': False
-    }
+# Create/upgrade the schema (runs the migrations once per process)
+database.init_db()
+
+# Optional Prometheus export of the timings, set in .streamlit/secrets.toml
+try:
+    metrics_port, metrics_file = st.secrets.get("metrics_port"), st.secrets.get("metrics_file")
+except Exception:
+    metrics_port = metrics_file = None
+metrics.start_exporters(port=metrics_port, path=metrics_file)
 
+# Deliver queued notifications, and send medication reminders, in the background
+notification_manager.outbox.start()
+reminder_scheduler.start()
+
+# Initialize session state variables
 if 'medications' not in st.session_state:
     st.session_state.medications = []
 
@@ -106,16 +113,56 @@ st.markdown("""
 </div>
 """, unsafe_allow_html=True)
 
+# Whose data this session shows and records. With sign-in set up (an [auth]
+# section in .streamlit/secrets.toml), that is the signed-in person's own
+# profile and no one else's; without it CareSync is a single-person install
+# on the default profile.
+try:
+    login_enabled = hasattr(st, "login") and "auth" in st.secrets
+except Exception:
+    login_enabled = False
+with st.sidebar:
+    if login_enabled:
+        if not st.user.get("is_logged_in"):
+            st.info("Sign in to see your CareSync data.")
+            st.button("🔑 Sign in", on_click=st.login)
+            st.stop()
+        identity = st.user.get("email") or st.user.get("sub")
+        st.session_state.user_id = database.get_identity_user(identity)
+        st.caption(f"👤 {st.user.get('name') or identity}")
+        st.button("Sign out", on_click=st.logout)
+    else:
+        st.session_state.user_id = database.DEFAULT_USER_ID
+
+# The notification settings shown and edited are the selected profile's saved ones
+if st.session_state.get('notification_settings_user') != utils.current_user():
+    notification_manager.load_settings(utils.current_user())
+
 # Navigation with better styling
 TABS = ["🏠 Home", "💊 Medication Tracker", "🧠 Mood & Journal", "📊 Insights", "⚙️ Settings"]
-tab_home, tab_meds, tab_mind, tab_insights, tab_settings = st.tabs(TABS)
 
-with tab_home:
+# Each tab body is a fragment, so a widget inside it reruns only that tab,
+# and each reads the (cached) dashboard snapshot itself for that reason.
+# Fragments need Streamlit 1.33+; older versions rerun the whole page.
+fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda func: func)
+
+def lazy_tabs(labels):
+    """st.tabs that only runs the selected tab's body, where Streamlit supports it"""
+    try:
+        return st.tabs(labels, key="main_tabs", on_change="rerun")
+    except TypeError:
+        return st.tabs(labels)
+
+@fragment
+@metrics.timed('caresync_tab_render_seconds', tab='home')
+def home_tab():
+    snapshot = database.load_dashboard_snapshot(utils.current_user())
+    
     st.markdown("### 🏠 Welcome to Your Wellness Dashboard")
     st.markdown("Here's your personalized overview for today.")
     
     # Reminder status at the top
-    med_schedule.show_reminder_status()
+    med_schedule.show_reminder_status(snapshot)
     
     # Main content in columns
     col1, col2 = st.columns([2, 1])
@@ -123,13 +170,13 @@ with tab_home:
     with col1:
         st.markdown('<div class="feature-card">', unsafe_allow_html=True)
         st.subheader("💊 Today's Medications")
-        med_schedule.show_today_schedule()
+        med_schedule.show_today_schedule(snapshot)
         st.markdown('</div>', unsafe_allow_html=True)
     
     with col2:
         st.markdown('<div class="feature-card">', unsafe_allow_html=True)
         st.subheader("😊 Mood Picker")
-        mood_tracker.mood_input("_home")
+        mood_tracker.mood_input("_home", snapshot)
         st.markdown('</div>', unsafe_allow_html=True)
         
         st.markdown('<div class="feature-card">', unsafe_allow_html=True)
@@ -146,14 +193,18 @@ with tab_home:
     </div>
     """, unsafe_allow_html=True)
 
-with tab_meds:
+@fragment
+@metrics.timed('caresync_tab_render_seconds', tab='medication')
+def meds_tab():
+    snapshot = database.load_dashboard_snapshot(utils.current_user())
+    
     st.markdown("### 💊 Medication Management")
     
     col1, col2 = st.columns([1, 1])
     
     with col1:
         st.markdown('<div class="feature-card">', unsafe_allow_html=True)
-        med_schedule.medication_manager()
+        med_schedule.medication_manager(snapshot)
         st.markdown('</div>', unsafe_allow_html=True)
     
     with col2:
@@ -161,14 +212,18 @@ with tab_meds:
         side_effects_ai.symptom_checker()
         st.markdown('</div>', unsafe_allow_html=True)
 
-with tab_mind:
+@fragment
+@metrics.timed('caresync_tab_render_seconds', tab='mood_journal')
+def mind_tab():
+    snapshot = database.load_dashboard_snapshot(utils.current_user())
+    
     st.markdown("### 🧠 Mental Health & Wellness")
     
     col1, col2 = st.columns([1, 1])
     
     with col1:
         st.markdown('<div class="feature-card">', unsafe_allow_html=True)
-        mood_tracker.mood_input("_mind")
+        mood_tracker.mood_input("_mind", snapshot)
         st.markdown('</div>', unsafe_allow_html=True)
         
         st.markdown('<div class="feature-card">', unsafe_allow_html=True)
@@ -177,17 +232,25 @@ with tab_mind:
     
     with col2:
         st.markdown('<div class="feature-card">', unsafe_allow_html=True)
-        journal.gpt_reflection()
+        journal.gpt_reflection(snapshot)
+        st.markdown('</div>', unsafe_allow_html=True)
+        
+        st.markdown('<div class="feature-card">', unsafe_allow_html=True)
+        journal.journal_search()
         st.markdown('</div>', unsafe_allow_html=True)
 
-with tab_insights:
+@fragment
+@metrics.timed('caresync_tab_render_seconds', tab='insights')
+def insights_tab():
+    snapshot = database.load_dashboard_snapshot(utils.current_user())
+    
     st.markdown("### 📊 Wellness Insights & Trends")
     
     col1, col2 = st.columns([1, 1])
     
     with col1:
         st.markdown('<div class="feature-card">', unsafe_allow_html=True)
-        mood_trends.plot_mood_trends()
+        mood_trends.plot_mood_trends(snapshot)
         st.markdown('</div>', unsafe_allow_html=True)
     
     with col2:
@@ -196,10 +259,12 @@ with tab_insights:
         st.markdown('</div>', unsafe_allow_html=True)
     
     st.markdown('<div class="feature-card">', unsafe_allow_html=True)
-    utils.show_ai_insights()
+    utils.show_ai_insights(snapshot)
     st.markdown('</div>', unsafe_allow_html=True)
 
-with tab_settings:
+@fragment
+@metrics.timed('caresync_tab_render_seconds', tab='settings')
+def settings_tab():
     st.markdown("### ⚙️ Notification Settings")
     
     col1, col2 = st.columns([1, 1])
@@ -211,17 +276,27 @@ with tab_settings:
         email_enabled = st.checkbox("Enable Email Notifications", 
                                   value=st.session_state.notification_settings.get('email_enabled', False))
         
-        if email_enabled:
+        if not email_enabled:
+            st.session_state.notification_settings['email_enabled'] = False
+        else:
             email = st.text_input("Email Address", 
                                 value=st.session_state.notification_settings.get('email_address', ''),
                                 type="email")
+            # Never prefilled: the password isn't saved with the settings
             password = st.text_input("App Password", 
-                                   value=st.session_state.notification_settings.get('email_password', ''),
                                    type="password",
-                                   help="Use Gmail App Password for security")
+                                   placeholder="Saved" if get_email_password(email) else "",
+                                   help="Use Gmail App Password for security. It is kept in your OS keyring "
+                                        "where there is one, not in the CareSync database.")
+            
+            with st.expander("SMTP server"):
+                smtp_server = st.text_input("Server", value=st.session_state.notification_settings.get('smtp_server', 'smtp.gmail.com'))
+                smtp_port = st.number_input("Port", min_value=1, max_value=65535,
+                                            value=int(st.session_state.notification_settings.get('smtp_port', 587)))
+                smtp_starttls = st.checkbox("Use STARTTLS", value=st.session_state.notification_settings.get('smtp_starttls', True))
             
             if st.button("Test Email Setup"):
-                if notification_manager.setup_email_notifications(email, password):
+                if notification_manager.setup_email_notifications(email, password, smtp_server, int(smtp_port), smtp_starttls):
                     st.success("✅ Email notifications configured!")
                 else:
                     st.error("❌ Email setup failed. Check your credentials.")
@@ -234,11 +309,20 @@ with tab_settings:
         
         desktop_enabled = st.checkbox("Enable Desktop Notifications",
                                     value=st.session_state.notification_settings.get('desktop_enabled', False))
+        st.session_state.notification_settings['desktop_enabled'] = desktop_enabled
         
         if desktop_enabled:
             st.info("Desktop notifications will appear as system alerts.")
             if st.button("Test Desktop Notification"):
-                if notification_manager.send_desktop_notification("CareSync Test", "Desktop notifications are working!"):
+                # Not waited for here: the result is reported on a later rerun
+                st.session_state.desktop_test = notification_manager.send_desktop_notification(
+                    "CareSync Test", "Desktop notifications are working!")
+            desktop_test = st.session_state.get('desktop_test')
+            if desktop_test is not None and not desktop_test.done():
+                st.info("🔔 Test notification sent; it should appear in a few seconds.")
+            elif desktop_test is not None:
+                del st.session_state.desktop_test
+                if desktop_test.result():
                     st.success("✅ Desktop notification sent!")
                 else:
                     st.warning("⚠️ Desktop notifications may not be supported on this system.")
@@ -251,6 +335,7 @@ with tab_settings:
     
     mobile_enabled = st.checkbox("Enable Mobile Notifications",
                                value=st.session_state.notification_settings.get('mobile_enabled', False))
+    st.session_state.notification_settings['mobile_enabled'] = mobile_enabled
     
     if mobile_enabled:
         st.info("Mobile notifications require additional setup with Firebase Cloud Messaging or similar service.")
@@ -263,19 +348,89 @@ with tab_settings:
     
     st.markdown('</div>', unsafe_allow_html=True)
     
+    # Saved for the background delivery as soon as they change, ahead of a test below
+    if notification_manager.save_settings(utils.current_user()):
+        reminder_scheduler.refresh()
+    
     # Test notifications
     st.markdown('<div class="feature-card">', unsafe_allow_html=True)
     st.subheader("🧪 Test Notifications")
     
     if st.button("Send Test Reminder"):
         test_meds = [("Test Medication", "100mg", "09:00:00")]
-        sent = notification_manager.send_medication_reminder("Test Medication", "100mg", "09:00:00")
+        sent = notification_manager.send_medication_reminder("Test Medication", "100mg", "09:00:00", user_id=utils.current_user())
         if sent:
             st.success("✅ Test notification sent!")
         else:
             st.warning("⚠️ No notifications configured or failed to send.")
     
     st.markdown('</div>', unsafe_allow_html=True)
+    
+    # Data export
+    st.markdown('<div class="feature-card">', unsafe_allow_html=True)
+    st.subheader("📦 Export Your Data")
+    st.caption("Your medications, medication logs, moods and journal entries, one file each, in a zip archive.")
+    
+    export_format = st.selectbox("Format", export.FORMATS, format_func=str.upper, key="export_format")
+    if st.button("Prepare Export"):
+        # Streamed to a temporary file rather than built up in memory
+        with tempfile.TemporaryFile() as f:
+            try:
+                counts = export.export_archive(f, export_format, utils.current_user())
+            except ValueError as e:
+                st.error(f"❌ {e}")
+            else:
+                # Streamlit serves downloads from memory, so only the finished archive is read in
+                f.seek(0)
+                st.download_button("⬇️ Download Export", f.read(), file_name=f"caresync-export-{utils.get_today()}.zip",
+                                   mime="application/zip")
+                st.caption(", ".join(f"{count} {kind.replace('_', ' ')}" for kind, count in counts.items()))
+    
+    st.markdown('</div>', unsafe_allow_html=True)
+    
+    # Performance diagnostics, opt-in
+    st.markdown('<div class="feature-card">', unsafe_allow_html=True)
+    st.subheader("⏱️ Performance Diagnostics")
+    
+    if st.checkbox("Show performance diagnostics", key="show_diagnostics"):
+        col1, col2 = st.columns(2)
+        with col1:
+            if st.button("🔄 Reset Timings", use_container_width=True):
+                metrics.reset()
+        with col2:
+            st.download_button("⬇️ Prometheus Metrics", metrics.render_prometheus(), file_name="caresync-metrics.prom",
+                               mime="text/plain", use_container_width=True)
+        
+        st.caption("Time spent since the app started (or the last reset) in database calls, SQL statements, "
+                   "AI requests, notification deliveries and tab renders, slowest total first.")
+        rows = metrics.summary()
+        if rows:
+            import pandas as pd
+            df = pd.DataFrame(rows).round({'total_ms': 1, 'mean_ms': 3, 'p50_ms': 3, 'p95_ms': 3})
+            st.dataframe(df, use_container_width=True, hide_index=True)
+        else:
+            st.info("Nothing has been timed yet.")
+        
+        cache = database.cache_stats()
+        st.caption(f"Query cache: {cache['hits']} hits, {cache['misses']} misses ({cache['hit_rate']:.0%}), "
+                   f"{cache['size']}/{cache['maxsize']} entries")
+        
+        st.markdown(f"**🐢 Slow queries** (over {metrics.SLOW_QUERY_SECONDS * 1000:.0f} ms, newest first)")
+        slow = metrics.slow_queries()
+        if slow:
+            st.dataframe([{'at': q.at, 'ms': round(q.seconds * 1000, 1), 'sql': q.sql} for q in slow],
+                         use_container_width=True, hide_index=True)
+        else:
+            st.caption("None so far.")
+    
+    st.markdown('</div>', unsafe_allow_html=True)
+
+tabs = lazy_tabs(TABS)
+for tab, render in zip(tabs, [home_tab, meds_tab, mind_tab, insights_tab, settings_tab]):
+    # open is None without selection tracking, in which case every tab renders
+    if getattr(tab, "open", None) is not False:
+        with tab:
+            render()
 
 # Beautiful disclaimer
 st.markdown("""
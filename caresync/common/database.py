@@ -1,82 +1,1547 @@
-# Database helpers for CareSync (stub) 
+# Database helpers for CareSync (stub)
 
+import functools
+import inspect
+import itertools
+import json
+import logging
+import queue
+import re
 import sqlite3
-from datetime import date
+import threading
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+import time
+from datetime import date, datetime
+
+from common import metrics, sentiment
+from common.models import DoseEvent, Medication, parse_minutes
+from common.timeseries import lttb
+
+logger = logging.getLogger(__name__)
 
 DB_PATH = 'caresync.db'
+POOL_SIZE = 8
+POOL_TIMEOUT = 30  # seconds to wait for a free connection / a busy lock
+CACHE_SIZE = 256  # cached read results kept per process
+BULK_CHUNK_SIZE = 5000  # rows handed to executemany at a time
+MOOD_MAX_POINTS = 500  # raw mood series longer than this are downsampled
+SEARCH_PAGE_SIZE = 20
+EXPORT_CHUNK_SIZE = 5000  # rows read per export page
+DEFAULT_USER_ID = 1  # the profile that owns everything written before users existed
 
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS medications (
+# Applied to every pooled connection. WAL lets readers run alongside a writer,
+# NORMAL sync is durable enough in WAL mode and avoids an fsync per commit.
+PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA busy_timeout=5000',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-8000',
+    'PRAGMA mmap_size=67108864',
+)
+
+
+class ConnectionPool:
+    """Bounded pool of long-lived SQLite connections shared by all script threads."""
+
+    def __init__(self, path, size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # Autocommit mode: transactions are opened explicitly by transaction()
+        conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                               check_same_thread=False, factory=metrics.TimedConnection)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+        if can_create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError("timed out waiting for a database connection")
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+        if self._closed:
+            self._discard(conn)
+        else:
+            self._idle.put(conn)
+
+    def _discard(self, conn):
+        with self._lock:
+            self._created -= 1
+        conn.close()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+
+class QueryCache:
+    """Bounded LRU cache of read results, keyed on a data generation counter.
+
+    Every committed write transaction bumps the generation, which drops all
+    cached results, so reads are served from memory until the data changes.
+    Only writes made through this process are seen.
+    """
+
+    def __init__(self, maxsize=CACHE_SIZE):
+        self.maxsize = maxsize
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, value
+
+    def put(self, generation, key, value):
+        with self._lock:
+            # A write landed while this result was being read; don't keep it
+            if generation != self.generation:
+                return
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def bump(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'generation': self.generation,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+_cache = QueryCache()
+_pool = None
+_pool_lock = threading.Lock()
+_local = threading.local()
+
+
+def get_pool():
+    """Return the process-wide pool for DB_PATH, opening (and migrating) it on first use."""
+    global _pool
+    pool = _pool
+    if pool is None or pool.path != DB_PATH:
+        with _pool_lock:
+            if _pool is None or _pool.path != DB_PATH:
+                if _pool is not None:
+                    _pool.close()
+                # Migrations run here, once per process and database file, so
+                # the per-rerun hot path never touches the schema
+                pool = ConnectionPool(DB_PATH)
+                with pool.connection() as conn:
+                    migrate(conn)
+                _pool = pool
+                _cache.bump()
+            pool = _pool
+    return pool
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+@contextmanager
+def transaction(write=True, invalidate=True):
+    """Run a block in one transaction on a pooled connection.
+
+    Write transactions take the write lock up front (BEGIN IMMEDIATE) so they
+    never deadlock upgrading from a read. Nested calls on the same thread join
+    the outer transaction. Writes to tables no cached query reads (ledgers,
+    queues) pass invalidate=False to leave the query cache alone.
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        _local.wrote = _local.wrote or (write and invalidate)
+        yield conn
+        return
+
+    with get_pool().connection() as conn:
+        conn.execute('BEGIN IMMEDIATE' if write else 'BEGIN')
+        _local.conn = conn
+        _local.wrote = write and invalidate
+        _local.after_commit = []
+        try:
+            yield conn
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            _local.conn = None
+        conn.execute('COMMIT')
+        if _local.wrote:
+            _cache.bump()
+        for callback in _local.after_commit:
+            callback()
+
+
+def after_commit(callback):
+    """Call callback once the current transaction commits, or right away outside one."""
+    if getattr(_local, 'conn', None) is None:
+        callback()
+    else:
+        _local.after_commit.append(callback)
+
+
+def cached(func):
+    """Serve a read helper from the query cache until the next write commits.
+
+    Results are shared between callers and must be treated as read-only.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # Inside a transaction we may be looking at uncommitted rows
+        if getattr(_local, 'conn', None) is not None:
+            return func(*args, **kwargs)
+        key = (func.__name__,) + args + tuple(sorted(kwargs.items()))
+        hit, value = _cache.get(key)
+        if hit:
+            return value
+        generation = _cache.generation
+        value = func(*args, **kwargs)
+        _cache.put(generation, key, value)
+        return value
+    return wrapper
+
+
+def _db_timed(func):
+    """Time every call of a data helper into caresync_db_call_seconds, labelled with its name.
+
+    Put it above @cached, so cache hits are timed too. A generator is timed
+    over its whole run, leaving out the time its caller holds each item.
+    """
+    if not inspect.isgeneratorfunction(func):
+        return metrics.timed('caresync_db_call_seconds', function=func.__name__)(func)
+    hist = metrics.histogram('caresync_db_call_seconds', function=func.__name__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        items = func(*args, **kwargs)
+        elapsed = 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.perf_counter() - start
+                yield item
+        finally:
+            items.close()
+            hist.observe(elapsed)
+    return wrapper
+
+
+def cache_stats():
+    return _cache.stats()
+
+
+def clear_cache():
+    _cache.bump()
+
+
+# Storage encodings. Dates are stored as days since 1970-01-01, reminder times
+# as minutes after midnight and log statuses as small integers; the helpers
+# below still take and return ISO dates and status names.
+EPOCH_JULIAN_DAY = 2440587.5  # julianday('1970-01-01')
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+STATUS_CODES = {'taken': 1, 'missed': 2}
+STATUS_NAMES = {code: name for name, code in STATUS_CODES.items()}
+
+def _day(value):
+    """Stored day number of an ISO date string or a date."""
+    if isinstance(value, str):
+        value = date.fromisoformat(value)
+    return value.toordinal() - _EPOCH_ORDINAL
+
+def _iso(day):
+    return date.fromordinal(day + _EPOCH_ORDINAL).isoformat()
+
+def _iso_sql(column):
+    """SQL for the ISO date of a stored day number."""
+    return f'date({column} + {EPOCH_JULIAN_DAY})'
+
+def _day_range(start, end):
+    """Stored day numbers of two ISO dates, either of which may be None for open-ended."""
+    return _day(start or '0001-01-01'), _day(end or '9999-12-31')
+
+# Times as older versions or hand-edited databases may hold them: "9am", "9:30 p.m.", "0900"
+_LOOSE_TIME_RE = re.compile(r'(\d{1,2})(?:[:.h]?(\d{2}))?(?::\d{2})?\s*(?:([ap])\.?\s*m?\.?)?')
+
+def _loose_minutes(value):
+    """Minutes after midnight of a reminder time in any format older versions may have stored, or None."""
+    if value is None:
+        return None
+    minutes = parse_minutes(str(value).strip())
+    if minutes is not None:
+        return minutes
+    match = _LOOSE_TIME_RE.fullmatch(str(value).strip().lower())
+    if not match:
+        return None
+    hour, minute, half = int(match[1]), int(match[2] or 0), match[3]
+    if half:
+        if not 1 <= hour <= 12:
+            return None
+        hour = hour % 12 + (12 if half == 'p' else 0)
+    return hour * 60 + minute if hour < 24 and minute < 60 else None
+
+def _loose_day(value):
+    """Stored day number of a date in any unambiguous format older versions may have stored, or None.
+
+    Day-first and month-first dates ("05/03/2024") are ambiguous and give None.
+    """
+    if value is None:
+        return None
+    text = str(value).strip()
+    for candidate in (text, text[:10], text[:10].replace('/', '-').replace('.', '-')):
+        try:
+            return _day(date.fromisoformat(candidate))
+        except ValueError:
+            pass
+    for fmt in ('%d %B %Y', '%d %b %Y', '%B %d, %Y', '%b %d, %Y', '%B %d %Y', '%b %d %Y'):
+        try:
+            return _day(datetime.strptime(text, fmt).date())
+        except ValueError:
+            pass
+    return None
+
+def _status_code(status):
+    try:
+        return STATUS_CODES[status]
+    except KeyError:
+        raise ValueError(f"unknown status {status!r}") from None
+
+
+def _migrate_v1(conn):
+    """Base schema."""
+    conn.execute('''CREATE TABLE IF NOT EXISTS medications (
         id INTEGER PRIMARY KEY, name TEXT, dose TEXT, frequency TEXT, time TEXT
     )''')
-    c.execute('''CREATE TABLE IF NOT EXISTS med_logs (
+    conn.execute('''CREATE TABLE IF NOT EXISTS med_logs (
         id INTEGER PRIMARY KEY, med_id INTEGER, log_date TEXT, status TEXT
     )''')
-    c.execute('''CREATE TABLE IF NOT EXISTS moods (
+    conn.execute('''CREATE TABLE IF NOT EXISTS moods (
         id INTEGER PRIMARY KEY, mood INTEGER, mood_emoji TEXT, mood_date TEXT
     )''')
-    c.execute('''CREATE TABLE IF NOT EXISTS journals (
+    conn.execute('''CREATE TABLE IF NOT EXISTS journals (
         id INTEGER PRIMARY KEY, entry TEXT, journal_date TEXT
     )''')
-    conn.commit()
-    conn.close()
-
-def add_medication(name, dose, frequency, time):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('INSERT INTO medications (name, dose, frequency, time) VALUES (?, ?, ?, ?)', (name, dose, frequency, time))
-    conn.commit()
-    conn.close()
-
-def get_today_medications():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    today = date.today().isoformat()
-    c.execute('SELECT * FROM medications')
-    meds = c.fetchall()
-    c.execute('SELECT med_id, status FROM med_logs WHERE log_date=?', (today,))
-    logs = {row[0]: row[1] for row in c.fetchall()}
-    conn.close()
+
+def _migrate_v2(conn):
+    """One log per medication per day, and indexes for the date lookups."""
+    # Keep only the latest log per medication per day before enforcing it
+    conn.execute('''DELETE FROM med_logs WHERE id NOT IN (
+        SELECT MAX(id) FROM med_logs GROUP BY med_id, log_date
+    )''')
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_med_logs_med_date ON med_logs (med_id, log_date)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_med_logs_date ON med_logs (log_date, med_id, status)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_moods_date ON moods (mood_date, mood, mood_emoji)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_journals_date ON journals (journal_date)')
+
+def _migrate_v3(conn):
+    """Adherence rollups kept in step with med_logs by triggers."""
+    conn.execute('''CREATE TABLE IF NOT EXISTS adherence_daily (
+        log_date TEXT PRIMARY KEY, taken INTEGER NOT NULL DEFAULT 0, missed INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS adherence_by_med (
+        med_id INTEGER PRIMARY KEY, taken INTEGER NOT NULL DEFAULT 0, missed INTEGER NOT NULL DEFAULT 0
+    )''')
+    # Add a log's counts (NEW) or take them away again (OLD)
+    add = '''
+        INSERT INTO adherence_daily (log_date, taken, missed)
+        VALUES (NEW.log_date, NEW.status = 'taken', NEW.status = 'missed')
+        ON CONFLICT (log_date) DO UPDATE SET taken = taken + excluded.taken, missed = missed + excluded.missed;
+        INSERT INTO adherence_by_med (med_id, taken, missed)
+        VALUES (NEW.med_id, NEW.status = 'taken', NEW.status = 'missed')
+        ON CONFLICT (med_id) DO UPDATE SET taken = taken + excluded.taken, missed = missed + excluded.missed;'''
+    remove = '''
+        UPDATE adherence_daily SET taken = taken - (OLD.status = 'taken'), missed = missed - (OLD.status = 'missed')
+        WHERE log_date = OLD.log_date;
+        UPDATE adherence_by_med SET taken = taken - (OLD.status = 'taken'), missed = missed - (OLD.status = 'missed')
+        WHERE med_id = OLD.med_id;'''
+    conn.execute(f'CREATE TRIGGER IF NOT EXISTS med_logs_rollup_insert AFTER INSERT ON med_logs BEGIN {add} END')
+    conn.execute(f'CREATE TRIGGER IF NOT EXISTS med_logs_rollup_update AFTER UPDATE ON med_logs BEGIN {remove} {add} END')
+    conn.execute(f'CREATE TRIGGER IF NOT EXISTS med_logs_rollup_delete AFTER DELETE ON med_logs BEGIN {remove} END')
+
+    conn.execute('DELETE FROM adherence_daily')
+    conn.execute('DELETE FROM adherence_by_med')
+    # Logs without a date or medication can't be keyed; they are left out here
+    # and dealt with when v10 converts the logs
+    conn.execute('''INSERT INTO adherence_daily (log_date, taken, missed)
+                    SELECT log_date, SUM(status = 'taken'), SUM(status = 'missed') FROM med_logs
+                    WHERE log_date IS NOT NULL GROUP BY log_date''')
+    conn.execute('''INSERT INTO adherence_by_med (med_id, taken, missed)
+                    SELECT med_id, SUM(status = 'taken'), SUM(status = 'missed') FROM med_logs
+                    WHERE med_id IS NOT NULL GROUP BY med_id''')
+
+def _migrate_v4(conn):
+    """Full-text index over journal entries, kept in sync by triggers."""
+    conn.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS journals_fts USING fts5(
+        entry, content='journals', content_rowid='id', tokenize='porter unicode61'
+    )''')
+    add = 'INSERT INTO journals_fts (rowid, entry) VALUES (NEW.id, NEW.entry);'
+    remove = "INSERT INTO journals_fts (journals_fts, rowid, entry) VALUES ('delete', OLD.id, OLD.entry);"
+    conn.execute(f'CREATE TRIGGER IF NOT EXISTS journals_fts_insert AFTER INSERT ON journals BEGIN {add} END')
+    conn.execute(f'CREATE TRIGGER IF NOT EXISTS journals_fts_update AFTER UPDATE OF entry ON journals BEGIN {remove} {add} END')
+    conn.execute(f'CREATE TRIGGER IF NOT EXISTS journals_fts_delete AFTER DELETE ON journals BEGIN {remove} END')
+    conn.execute("INSERT INTO journals_fts (journals_fts) VALUES ('rebuild')")
+
+def _migrate_v5(conn):
+    """Ledger of sent medication reminders, so each goes out exactly once."""
+    conn.execute('''CREATE TABLE IF NOT EXISTS reminder_ledger (
+        med_id INTEGER NOT NULL, remind_date TEXT NOT NULL, occurrence INTEGER NOT NULL, sent_at TEXT NOT NULL,
+        PRIMARY KEY (med_id, remind_date, occurrence)
+    ) WITHOUT ROWID''')
+
+def _migrate_v6(conn):
+    """Outbox of notifications waiting for delivery."""
+    conn.execute('''CREATE TABLE IF NOT EXISTS notification_outbox (
+        id INTEGER PRIMARY KEY,
+        idempotency_key TEXT NOT NULL UNIQUE,
+        channel TEXT NOT NULL,
+        title TEXT NOT NULL,
+        message TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at REAL NOT NULL,
+        last_error TEXT,
+        created_at TEXT NOT NULL,
+        sent_at TEXT
+    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_outbox_due ON notification_outbox (status, next_attempt_at)')
+
+def _migrate_v7(conn):
+    """Per-week mood and journal rollups for AI context, kept in step by triggers."""
+    conn.execute('''CREATE TABLE IF NOT EXISTS weekly_summaries (
+        week_start TEXT PRIMARY KEY,
+        mood_count INTEGER NOT NULL DEFAULT 0,
+        mood_sum INTEGER NOT NULL DEFAULT 0,
+        mood_min INTEGER,
+        mood_max INTEGER,
+        journal_count INTEGER NOT NULL DEFAULT 0,
+        journal_chars INTEGER NOT NULL DEFAULT 0,
+        excerpt TEXT,
+        excerpt_date TEXT
+    ) WITHOUT ROWID''')
+    mood_week = "date({}.mood_date, 'weekday 0', '-6 days')"  # Monday, as in MOOD_BUCKETS
+    journal_week = "date({}.journal_date, 'weekday 0', '-6 days')"
+    # Inserts are applied incrementally; the rarer updates and deletes
+    # recompute the affected week, since min/max/excerpt can't be undone
+    add_mood = f'''
+        INSERT INTO weekly_summaries (week_start, mood_count, mood_sum, mood_min, mood_max)
+        VALUES ({mood_week.format('NEW')}, 1, NEW.mood, NEW.mood, NEW.mood)
+        ON CONFLICT (week_start) DO UPDATE SET
+            mood_count = mood_count + 1, mood_sum = mood_sum + excluded.mood_sum,
+            mood_min = MIN(COALESCE(mood_min, excluded.mood_min), excluded.mood_min),
+            mood_max = MAX(COALESCE(mood_max, excluded.mood_max), excluded.mood_max);'''
+    add_journal = f'''
+        INSERT INTO weekly_summaries (week_start, journal_count, journal_chars, excerpt, excerpt_date)
+        VALUES ({journal_week.format('NEW')}, 1, length(NEW.entry), substr(NEW.entry, 1, 200), NEW.journal_date)
+        ON CONFLICT (week_start) DO UPDATE SET
+            journal_count = journal_count + 1, journal_chars = journal_chars + excluded.journal_chars,
+            excerpt = CASE WHEN excerpt_date IS NULL OR excluded.excerpt_date >= excerpt_date
+                           THEN excluded.excerpt ELSE excerpt END,
+            excerpt_date = MAX(COALESCE(excerpt_date, ''), excluded.excerpt_date);'''
+
+    def refresh_moods(week):
+        return f'''
+        UPDATE weekly_summaries SET (mood_count, mood_sum, mood_min, mood_max) = (
+            SELECT COUNT(*), COALESCE(SUM(mood), 0), MIN(mood), MAX(mood) FROM moods
+            WHERE mood_date BETWEEN week_start AND date(week_start, '+6 days')
+        ) WHERE week_start = {week};'''
+
+    def refresh_journals(week):
+        return f'''
+        UPDATE weekly_summaries SET (journal_count, journal_chars) = (
+            SELECT COUNT(*), COALESCE(SUM(length(entry)), 0) FROM journals
+            WHERE journal_date BETWEEN week_start AND date(week_start, '+6 days')
+        ), (excerpt, excerpt_date) = (
+            SELECT substr(entry, 1, 200), journal_date FROM journals
+            WHERE journal_date BETWEEN week_start AND date(week_start, '+6 days')
+            ORDER BY journal_date DESC, id DESC LIMIT 1
+        ) WHERE week_start = {week};'''
+
+    # Rows whose date SQLite can't read have no week; they are left out of the
+    # rollup (the update triggers' INSERT OR IGNORE skips them too) until v10
+    # converts or quarantines them
+    conn.execute(f'''CREATE TRIGGER IF NOT EXISTS moods_weekly_insert AFTER INSERT ON moods
+        WHEN {mood_week.format('NEW')} IS NOT NULL BEGIN {add_mood} END''')
+    conn.execute(f'''CREATE TRIGGER IF NOT EXISTS moods_weekly_update AFTER UPDATE OF mood, mood_date ON moods BEGIN
+        INSERT OR IGNORE INTO weekly_summaries (week_start) VALUES ({mood_week.format('NEW')});
+        {refresh_moods(mood_week.format('OLD'))} {refresh_moods(mood_week.format('NEW'))} END''')
+    conn.execute(f'''CREATE TRIGGER IF NOT EXISTS moods_weekly_delete AFTER DELETE ON moods BEGIN
+        {refresh_moods(mood_week.format('OLD'))} END''')
+    conn.execute(f'''CREATE TRIGGER IF NOT EXISTS journals_weekly_insert AFTER INSERT ON journals
+        WHEN {journal_week.format('NEW')} IS NOT NULL BEGIN {add_journal} END''')
+    conn.execute(f'''CREATE TRIGGER IF NOT EXISTS journals_weekly_update AFTER UPDATE OF entry, journal_date ON journals BEGIN
+        INSERT OR IGNORE INTO weekly_summaries (week_start) VALUES ({journal_week.format('NEW')});
+        {refresh_journals(journal_week.format('OLD'))} {refresh_journals(journal_week.format('NEW'))} END''')
+    conn.execute(f'''CREATE TRIGGER IF NOT EXISTS journals_weekly_delete AFTER DELETE ON journals BEGIN
+        {refresh_journals(journal_week.format('OLD'))} END''')
+
+    conn.execute('DELETE FROM weekly_summaries')
+    conn.execute(f'''INSERT INTO weekly_summaries (week_start, mood_count, mood_sum, mood_min, mood_max)
+                     SELECT {mood_week.format('moods')} AS week, COUNT(*), SUM(mood), MIN(mood), MAX(mood)
+                     FROM moods WHERE week IS NOT NULL GROUP BY week''')
+    conn.execute(f'''INSERT OR IGNORE INTO weekly_summaries (week_start)
+                     SELECT DISTINCT {journal_week.format('journals')} AS week FROM journals WHERE week IS NOT NULL''')
+    conn.execute(refresh_journals('week_start'))  # i.e. every week
+
+def _migrate_v8(conn):
+    """Offline sentiment score and dominant emotion per journal entry."""
+    conn.execute('ALTER TABLE journals ADD COLUMN sentiment REAL')
+    conn.execute('ALTER TABLE journals ADD COLUMN emotion TEXT')
+    _rescore(conn, conn.execute('SELECT id, entry FROM journals').fetchall())
+
+def _rescore(conn, rows):
+    for chunk in chunked(rows, BULK_CHUNK_SIZE):
+        scores = sentiment.analyze(entry for _, entry in chunk)
+        conn.executemany('UPDATE journals SET sentiment = ?, emotion = ? WHERE id = ?',
+                         [(score, emotion, journal_id) for (journal_id, _), (score, emotion) in zip(chunk, scores)])
+
+def _migrate_v9(conn):
+    """Users, with every user's rows partitioned by a user_id column."""
+    conn.execute('''CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, created_at TEXT NOT NULL
+    )''')
+    conn.execute("INSERT OR IGNORE INTO users (id, name, created_at) VALUES (1, 'Default', ?)",
+                 (datetime.now().isoformat(timespec='seconds'),))
+    # Existing rows all belong to the default user
+    for table in ('medications', 'med_logs', 'moods', 'journals', 'notification_outbox'):
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN user_id INTEGER NOT NULL DEFAULT 1')
+    # Lead every date index with user_id, so one user's range scans never
+    # touch other users' rows
+    conn.execute('DROP INDEX IF EXISTS idx_med_logs_date')
+    conn.execute('DROP INDEX IF EXISTS idx_moods_date')
+    conn.execute('DROP INDEX IF EXISTS idx_journals_date')
+    conn.execute('CREATE INDEX idx_medications_user ON medications (user_id, id)')
+    conn.execute('CREATE INDEX idx_med_logs_user_date ON med_logs (user_id, log_date, med_id, status)')
+    conn.execute('CREATE INDEX idx_moods_user_date ON moods (user_id, mood_date, mood, mood_emoji)')
+    conn.execute('CREATE INDEX idx_journals_user_date ON journals (user_id, journal_date)')
+
+    # Daily adherence is rolled up per user; adherence_by_med is already
+    # per medication, and so per user
+    for trigger in ('med_logs_rollup_insert', 'med_logs_rollup_update', 'med_logs_rollup_delete'):
+        conn.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+    conn.execute('DROP TABLE IF EXISTS adherence_daily')
+    conn.execute('''CREATE TABLE adherence_daily (
+        user_id INTEGER NOT NULL, log_date TEXT NOT NULL,
+        taken INTEGER NOT NULL DEFAULT 0, missed INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, log_date)
+    ) WITHOUT ROWID''')
+    add = '''
+        INSERT INTO adherence_daily (user_id, log_date, taken, missed)
+        VALUES (NEW.user_id, NEW.log_date, NEW.status = 'taken', NEW.status = 'missed')
+        ON CONFLICT (user_id, log_date) DO UPDATE SET taken = taken + excluded.taken, missed = missed + excluded.missed;
+        INSERT INTO adherence_by_med (med_id, taken, missed)
+        VALUES (NEW.med_id, NEW.status = 'taken', NEW.status = 'missed')
+        ON CONFLICT (med_id) DO UPDATE SET taken = taken + excluded.taken, missed = missed + excluded.missed;'''
+    remove = '''
+        UPDATE adherence_daily SET taken = taken - (OLD.status = 'taken'), missed = missed - (OLD.status = 'missed')
+        WHERE user_id = OLD.user_id AND log_date = OLD.log_date;
+        UPDATE adherence_by_med SET taken = taken - (OLD.status = 'taken'), missed = missed - (OLD.status = 'missed')
+        WHERE med_id = OLD.med_id;'''
+    conn.execute(f'CREATE TRIGGER med_logs_rollup_insert AFTER INSERT ON med_logs BEGIN {add} END')
+    conn.execute(f'CREATE TRIGGER med_logs_rollup_update AFTER UPDATE ON med_logs BEGIN {remove} {add} END')
+    conn.execute(f'CREATE TRIGGER med_logs_rollup_delete AFTER DELETE ON med_logs BEGIN {remove} END')
+    conn.execute('''INSERT INTO adherence_daily (user_id, log_date, taken, missed)
+                    SELECT user_id, log_date, SUM(status = 'taken'), SUM(status = 'missed')
+                    FROM med_logs WHERE log_date IS NOT NULL GROUP BY user_id, log_date''')
+
+    # Weekly summaries likewise, keyed by (user_id, week_start)
+    for trigger in ('moods_weekly_insert', 'moods_weekly_update', 'moods_weekly_delete',
+                    'journals_weekly_insert', 'journals_weekly_update', 'journals_weekly_delete'):
+        conn.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+    conn.execute('DROP TABLE IF EXISTS weekly_summaries')
+    conn.execute('''CREATE TABLE weekly_summaries (
+        user_id INTEGER NOT NULL,
+        week_start TEXT NOT NULL,
+        mood_count INTEGER NOT NULL DEFAULT 0,
+        mood_sum INTEGER NOT NULL DEFAULT 0,
+        mood_min INTEGER,
+        mood_max INTEGER,
+        journal_count INTEGER NOT NULL DEFAULT 0,
+        journal_chars INTEGER NOT NULL DEFAULT 0,
+        excerpt TEXT,
+        excerpt_date TEXT,
+        PRIMARY KEY (user_id, week_start)
+    ) WITHOUT ROWID''')
+    mood_week = "date({}.mood_date, 'weekday 0', '-6 days')"  # Monday, as in MOOD_BUCKETS
+    journal_week = "date({}.journal_date, 'weekday 0', '-6 days')"
+    add_mood = f'''
+        INSERT INTO weekly_summaries (user_id, week_start, mood_count, mood_sum, mood_min, mood_max)
+        VALUES (NEW.user_id, {mood_week.format('NEW')}, 1, NEW.mood, NEW.mood, NEW.mood)
+        ON CONFLICT (user_id, week_start) DO UPDATE SET
+            mood_count = mood_count + 1, mood_sum = mood_sum + excluded.mood_sum,
+            mood_min = MIN(COALESCE(mood_min, excluded.mood_min), excluded.mood_min),
+            mood_max = MAX(COALESCE(mood_max, excluded.mood_max), excluded.mood_max);'''
+    add_journal = f'''
+        INSERT INTO weekly_summaries (user_id, week_start, journal_count, journal_chars, excerpt, excerpt_date)
+        VALUES (NEW.user_id, {journal_week.format('NEW')}, 1, length(NEW.entry), substr(NEW.entry, 1, 200), NEW.journal_date)
+        ON CONFLICT (user_id, week_start) DO UPDATE SET
+            journal_count = journal_count + 1, journal_chars = journal_chars + excluded.journal_chars,
+            excerpt = CASE WHEN excerpt_date IS NULL OR excluded.excerpt_date >= excerpt_date
+                           THEN excluded.excerpt ELSE excerpt END,
+            excerpt_date = MAX(COALESCE(excerpt_date, ''), excluded.excerpt_date);'''
+    same_week = '''{0}.user_id = weekly_summaries.user_id
+                   AND {0}.{1} BETWEEN weekly_summaries.week_start AND date(weekly_summaries.week_start, '+6 days')'''
+
+    def refresh_moods(where):
+        return f'''
+        UPDATE weekly_summaries SET (mood_count, mood_sum, mood_min, mood_max) = (
+            SELECT COUNT(*), COALESCE(SUM(mood), 0), MIN(mood), MAX(mood) FROM moods
+            WHERE {same_week.format('moods', 'mood_date')}
+        ) WHERE {where};'''
+
+    def refresh_journals(where):
+        return f'''
+        UPDATE weekly_summaries SET (journal_count, journal_chars) = (
+            SELECT COUNT(*), COALESCE(SUM(length(entry)), 0) FROM journals
+            WHERE {same_week.format('journals', 'journal_date')}
+        ), (excerpt, excerpt_date) = (
+            SELECT substr(entry, 1, 200), journal_date FROM journals
+            WHERE {same_week.format('journals', 'journal_date')}
+            ORDER BY journal_date DESC, id DESC LIMIT 1
+        ) WHERE {where};'''
+
+    def week_of(row, week):
+        return f'user_id = {row}.user_id AND week_start = {week.format(row)}'
+
+    # As in v7, rows with unreadable dates stay out of the rollup until v10
+    conn.execute(f'''CREATE TRIGGER moods_weekly_insert AFTER INSERT ON moods
+        WHEN {mood_week.format('NEW')} IS NOT NULL BEGIN {add_mood} END''')
+    conn.execute(f'''CREATE TRIGGER moods_weekly_update AFTER UPDATE OF mood, mood_date, user_id ON moods BEGIN
+        INSERT OR IGNORE INTO weekly_summaries (user_id, week_start) VALUES (NEW.user_id, {mood_week.format('NEW')});
+        {refresh_moods(week_of('OLD', mood_week))} {refresh_moods(week_of('NEW', mood_week))} END''')
+    conn.execute(f'''CREATE TRIGGER moods_weekly_delete AFTER DELETE ON moods BEGIN
+        {refresh_moods(week_of('OLD', mood_week))} END''')
+    conn.execute(f'''CREATE TRIGGER journals_weekly_insert AFTER INSERT ON journals
+        WHEN {journal_week.format('NEW')} IS NOT NULL BEGIN {add_journal} END''')
+    conn.execute(f'''CREATE TRIGGER journals_weekly_update AFTER UPDATE OF entry, journal_date, user_id ON journals BEGIN
+        INSERT OR IGNORE INTO weekly_summaries (user_id, week_start) VALUES (NEW.user_id, {journal_week.format('NEW')});
+        {refresh_journals(week_of('OLD', journal_week))} {refresh_journals(week_of('NEW', journal_week))} END''')
+    conn.execute(f'''CREATE TRIGGER journals_weekly_delete AFTER DELETE ON journals BEGIN
+        {refresh_journals(week_of('OLD', journal_week))} END''')
+    conn.execute(f'''INSERT INTO weekly_summaries (user_id, week_start)
+                     SELECT DISTINCT user_id, {mood_week.format('moods')} AS week FROM moods WHERE week IS NOT NULL
+                     UNION SELECT DISTINCT user_id, {journal_week.format('journals')} AS week FROM journals
+                     WHERE week IS NOT NULL''')
+    conn.execute(refresh_moods('1'))  # i.e. every week
+    conn.execute(refresh_journals('1'))
+
+def _migrate_v10(conn):
+    """Compact STRICT tables: integer day numbers, reminder minutes and status codes.
+
+    Every table with a date, time or status is rebuilt, and med_logs is keyed
+    by (med_id, log_date) without a rowid. Values in other formats than the
+    app writes ("Taken", "2024-03-05 08:00", "9am") are converted. Rows that
+    still can't be stored, and medication times that can't be read, are
+    copied as they were into migration_quarantine instead of being lost.
+    """
+    # STRICT needs SQLite 3.37; older versions get the same layout without it
+    strict = sqlite3.sqlite_version_info >= (3, 37, 0)
+    options = 'STRICT' if strict else ''
+    without_rowid = 'WITHOUT ROWID, STRICT' if strict else 'WITHOUT ROWID'
+    day = "CAST(julianday({}) - 2440587.5 AS INTEGER)"
+    # Rows already in the app's own format are converted in SQL; the rest go
+    # through the lenient parsers in Python, row by row
+    iso = "{0} = date({0})"
+    quarantined = []
+
+    def quarantine(table, columns, row, reason):
+        quarantined.append((table, row[0] if columns[0] == 'id' else None,
+                            json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=str), reason))
+
+    def leftovers(table, columns, converted):
+        return conn.execute(f'SELECT {", ".join(columns)} FROM {table} WHERE NOT COALESCE({converted}, 0)').fetchall()
+
+    def mood_value(mood):
+        try:
+            value = float(str(mood).strip())
+        except ValueError:
+            return None
+        return int(value) if value.is_integer() else None
+
+    conn.execute(f'''CREATE TABLE migration_quarantine (
+        id INTEGER PRIMARY KEY,
+        source TEXT NOT NULL,  -- table the row came from
+        source_id INTEGER,  -- its id there
+        data TEXT NOT NULL,  -- the row as it was, as JSON
+        reason TEXT NOT NULL,
+        quarantined_at TEXT NOT NULL
+    ) {options}''')
+
+    # Triggers reference the tables being swapped out, so they go first
+    for (trigger,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'").fetchall():
+        conn.execute(f'DROP TRIGGER {trigger}')
+
+    conn.execute(f'''CREATE TABLE medications_new (
+        id INTEGER PRIMARY KEY, name TEXT, dose TEXT, frequency TEXT,
+        time INTEGER CHECK (time BETWEEN 0 AND 1439),  -- minutes after midnight
+        user_id INTEGER NOT NULL DEFAULT 1
+    ) {options}''')
+    columns = ('id', 'name', 'dose', 'frequency', 'time', 'user_id')
+    rows = conn.execute(f'SELECT {", ".join(columns)} FROM medications').fetchall()
+    for row in rows:
+        # The medication itself is kept, without a reminder time
+        if row[4] is not None and str(row[4]).strip() and _loose_minutes(row[4]) is None:
+            quarantine('medications', columns, row, 'unreadable reminder time')
+    conn.executemany('INSERT INTO medications_new VALUES (?, ?, ?, ?, ?, ?)',
+                     [row[:4] + (_loose_minutes(row[4]), row[5]) for row in rows])
+
+    conn.execute(f'''CREATE TABLE med_logs_new (
+        med_id INTEGER NOT NULL, log_date INTEGER NOT NULL,
+        status INTEGER NOT NULL CHECK (status IN (1, 2)),  -- 1 taken, 2 missed
+        user_id INTEGER NOT NULL DEFAULT 1,
+        PRIMARY KEY (med_id, log_date)
+    ) {without_rowid}''')
+    # The old unique index keeps these free of (med_id, day) duplicates
+    converted = f"med_id IS NOT NULL AND status IN ('taken', 'missed') AND {iso.format('log_date')}"
+    conn.execute(f'''INSERT INTO med_logs_new (med_id, log_date, status, user_id)
+                     SELECT med_id, {day.format('log_date')}, CASE status WHEN 'taken' THEN 1 ELSE 2 END, user_id
+                     FROM med_logs WHERE {converted}''')
+    columns = ('id', 'med_id', 'log_date', 'status', 'user_id')
+    for row in leftovers('med_logs', columns, converted):
+        med_id, log_date, status, user_id = row[1:]
+        log_day = _loose_day(log_date)
+        code = STATUS_CODES.get(str(status).strip().lower())
+        reason = ('no medication' if med_id is None else 'unreadable date' if log_day is None
+                  else 'unknown status' if code is None else None)
+        if reason is None:
+            if conn.execute('INSERT OR IGNORE INTO med_logs_new VALUES (?, ?, ?, ?)',
+                            (med_id, log_day, code, user_id)).rowcount:
+                continue
+            reason = 'another log for the same medication and day'
+        quarantine('med_logs', columns, row, reason)
+
+    conn.execute(f'''CREATE TABLE moods_new (
+        id INTEGER PRIMARY KEY, mood INTEGER, mood_emoji TEXT, mood_date INTEGER NOT NULL,
+        user_id INTEGER NOT NULL DEFAULT 1
+    ) {options}''')
+    converted = f"typeof(mood) IN ('integer', 'null') AND {iso.format('mood_date')}"
+    conn.execute(f'''INSERT INTO moods_new (id, mood, mood_emoji, mood_date, user_id)
+                     SELECT id, mood, mood_emoji, {day.format('mood_date')}, user_id
+                     FROM moods WHERE {converted}''')
+    columns = ('id', 'mood', 'mood_emoji', 'mood_date', 'user_id')
+    for row in leftovers('moods', columns, converted):
+        mood_day = _loose_day(row[3])
+        mood = None if row[1] is None else mood_value(row[1])
+        if mood_day is None or (mood is None and row[1] is not None):
+            quarantine('moods', columns, row, 'unreadable date' if mood_day is None else 'unreadable mood')
+        else:
+            conn.execute('INSERT INTO moods_new VALUES (?, ?, ?, ?, ?)', (row[0], mood, row[2], mood_day, row[4]))
+
+    conn.execute(f'''CREATE TABLE journals_new (
+        id INTEGER PRIMARY KEY, entry TEXT, journal_date INTEGER NOT NULL,
+        sentiment REAL, emotion TEXT, user_id INTEGER NOT NULL DEFAULT 1
+    ) {options}''')
+    converted = iso.format('journal_date')
+    conn.execute(f'''INSERT INTO journals_new (id, entry, journal_date, sentiment, emotion, user_id)
+                     SELECT id, entry, {day.format('journal_date')}, sentiment, emotion, user_id
+                     FROM journals WHERE {converted}''')
+    columns = ('id', 'entry', 'journal_date', 'sentiment', 'emotion', 'user_id')
+    for row in leftovers('journals', columns, converted):
+        journal_day = _loose_day(row[2])
+        if journal_day is None:
+            quarantine('journals', columns, row, 'unreadable date')
+        else:
+            conn.execute('INSERT INTO journals_new VALUES (?, ?, ?, ?, ?, ?)', row[:2] + (journal_day,) + row[3:])
+
+    conn.execute(f'''CREATE TABLE reminder_ledger_new (
+        med_id INTEGER NOT NULL, remind_date INTEGER NOT NULL, occurrence INTEGER NOT NULL, sent_at TEXT NOT NULL,
+        PRIMARY KEY (med_id, remind_date, occurrence)
+    ) {without_rowid}''')
+    converted = iso.format('remind_date')
+    conn.execute(f'''INSERT INTO reminder_ledger_new
+                     SELECT med_id, {day.format('remind_date')}, occurrence, sent_at
+                     FROM reminder_ledger WHERE {converted}''')
+    columns = ('med_id', 'remind_date', 'occurrence', 'sent_at')
+    for row in leftovers('reminder_ledger', columns, converted):
+        remind_day = _loose_day(row[1])
+        if remind_day is None:
+            quarantine('reminder_ledger', columns, row, 'unreadable date')
+        else:
+            conn.execute('INSERT OR IGNORE INTO reminder_ledger_new VALUES (?, ?, ?, ?)', (row[0], remind_day) + row[2:])
+
+    if quarantined:
+        now = datetime.now().isoformat(timespec='seconds')
+        conn.executemany('''INSERT INTO migration_quarantine (source, source_id, data, reason, quarantined_at)
+                            VALUES (?, ?, ?, ?, ?)''', [row + (now,) for row in quarantined])
+        logger.warning("%d rows or values could not be converted and were copied to the migration_quarantine table",
+                       len(quarantined))
+
+    # The rollups are rebuilt from the converted rows below
+    conn.execute(f'''CREATE TABLE adherence_daily_new (
+        user_id INTEGER NOT NULL, log_date INTEGER NOT NULL,
+        taken INTEGER NOT NULL DEFAULT 0, missed INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, log_date)
+    ) {without_rowid}''')
+    conn.execute(f'''CREATE TABLE weekly_summaries_new (
+        user_id INTEGER NOT NULL,
+        week_start INTEGER NOT NULL,
+        mood_count INTEGER NOT NULL DEFAULT 0,
+        mood_sum INTEGER NOT NULL DEFAULT 0,
+        mood_min INTEGER,
+        mood_max INTEGER,
+        journal_count INTEGER NOT NULL DEFAULT 0,
+        journal_chars INTEGER NOT NULL DEFAULT 0,
+        excerpt TEXT,
+        excerpt_date INTEGER,
+        PRIMARY KEY (user_id, week_start)
+    ) {without_rowid}''')
+
+    for table in ('medications', 'med_logs', 'moods', 'journals', 'reminder_ledger', 'adherence_daily', 'weekly_summaries'):
+        conn.execute(f'DROP TABLE {table}')
+        conn.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+
+    conn.execute('CREATE INDEX idx_medications_user ON medications (user_id, id)')
+    conn.execute('CREATE INDEX idx_med_logs_user_date ON med_logs (user_id, log_date, status)')
+    conn.execute('CREATE INDEX idx_moods_user_date ON moods (user_id, mood_date, mood, mood_emoji)')
+    conn.execute('CREATE INDEX idx_journals_user_date ON journals (user_id, journal_date)')
+
+    # Full-text index, on the same journal ids
+    add = 'INSERT INTO journals_fts (rowid, entry) VALUES (NEW.id, NEW.entry);'
+    remove = "INSERT INTO journals_fts (journals_fts, rowid, entry) VALUES ('delete', OLD.id, OLD.entry);"
+    conn.execute(f'CREATE TRIGGER journals_fts_insert AFTER INSERT ON journals BEGIN {add} END')
+    conn.execute(f'CREATE TRIGGER journals_fts_delete AFTER DELETE ON journals BEGIN {remove} END')
+    conn.execute(f'CREATE TRIGGER journals_fts_update AFTER UPDATE OF entry ON journals BEGIN {remove} {add} END')
+    conn.execute("INSERT INTO journals_fts (journals_fts) VALUES ('rebuild')")
+
+    # Adherence rollups
+    add = '''
+        INSERT INTO adherence_daily (user_id, log_date, taken, missed)
+        VALUES (NEW.user_id, NEW.log_date, NEW.status = 1, NEW.status = 2)
+        ON CONFLICT (user_id, log_date) DO UPDATE SET taken = taken + excluded.taken, missed = missed + excluded.missed;
+        INSERT INTO adherence_by_med (med_id, taken, missed)
+        VALUES (NEW.med_id, NEW.status = 1, NEW.status = 2)
+        ON CONFLICT (med_id) DO UPDATE SET taken = taken + excluded.taken, missed = missed + excluded.missed;'''
+    remove = '''
+        UPDATE adherence_daily SET taken = taken - (OLD.status = 1), missed = missed - (OLD.status = 2)
+        WHERE user_id = OLD.user_id AND log_date = OLD.log_date;
+        UPDATE adherence_by_med SET taken = taken - (OLD.status = 1), missed = missed - (OLD.status = 2)
+        WHERE med_id = OLD.med_id;'''
+    conn.execute(f'CREATE TRIGGER med_logs_rollup_insert AFTER INSERT ON med_logs BEGIN {add} END')
+    conn.execute(f'CREATE TRIGGER med_logs_rollup_update AFTER UPDATE ON med_logs BEGIN {remove} {add} END')
+    conn.execute(f'CREATE TRIGGER med_logs_rollup_delete AFTER DELETE ON med_logs BEGIN {remove} END')
+    conn.execute('''INSERT INTO adherence_daily (user_id, log_date, taken, missed)
+                    SELECT user_id, log_date, SUM(status = 1), SUM(status = 2) FROM med_logs GROUP BY user_id, log_date''')
+    conn.execute('DELETE FROM adherence_by_med')
+    conn.execute('''INSERT INTO adherence_by_med (med_id, taken, missed)
+                    SELECT med_id, SUM(status = 1), SUM(status = 2) FROM med_logs WHERE med_id IS NOT NULL GROUP BY med_id''')
+
+    # Weekly summaries; 1970-01-01 was a Thursday, so Monday is day - (day + 3) % 7
+    mood_week = '({0}.mood_date - ({0}.mood_date + 3) % 7)'
+    journal_week = '({0}.journal_date - ({0}.journal_date + 3) % 7)'
+    add_mood = f'''
+        INSERT INTO weekly_summaries (user_id, week_start, mood_count, mood_sum, mood_min, mood_max)
+        VALUES (NEW.user_id, {mood_week.format('NEW')}, 1, NEW.mood, NEW.mood, NEW.mood)
+        ON CONFLICT (user_id, week_start) DO UPDATE SET
+            mood_count = mood_count + 1, mood_sum = mood_sum + excluded.mood_sum,
+            mood_min = MIN(COALESCE(mood_min, excluded.mood_min), excluded.mood_min),
+            mood_max = MAX(COALESCE(mood_max, excluded.mood_max), excluded.mood_max);'''
+    add_journal = f'''
+        INSERT INTO weekly_summaries (user_id, week_start, journal_count, journal_chars, excerpt, excerpt_date)
+        VALUES (NEW.user_id, {journal_week.format('NEW')}, 1, length(NEW.entry), substr(NEW.entry, 1, 200), NEW.journal_date)
+        ON CONFLICT (user_id, week_start) DO UPDATE SET
+            journal_count = journal_count + 1, journal_chars = journal_chars + excluded.journal_chars,
+            excerpt = CASE WHEN excerpt_date IS NULL OR excluded.excerpt_date >= excerpt_date
+                           THEN excluded.excerpt ELSE excerpt END,
+            excerpt_date = MAX(COALESCE(excerpt_date, excluded.excerpt_date), excluded.excerpt_date);'''
+    same_week = '''{0}.user_id = weekly_summaries.user_id
+                   AND {0}.{1} BETWEEN weekly_summaries.week_start AND weekly_summaries.week_start + 6'''
+
+    def refresh_moods(where):
+        return f'''
+        UPDATE weekly_summaries SET (mood_count, mood_sum, mood_min, mood_max) = (
+            SELECT COUNT(*), COALESCE(SUM(mood), 0), MIN(mood), MAX(mood) FROM moods
+            WHERE {same_week.format('moods', 'mood_date')}
+        ) WHERE {where};'''
+
+    def refresh_journals(where):
+        return f'''
+        UPDATE weekly_summaries SET (journal_count, journal_chars) = (
+            SELECT COUNT(*), COALESCE(SUM(length(entry)), 0) FROM journals
+            WHERE {same_week.format('journals', 'journal_date')}
+        ), (excerpt, excerpt_date) = (
+            SELECT substr(entry, 1, 200), journal_date FROM journals
+            WHERE {same_week.format('journals', 'journal_date')}
+            ORDER BY journal_date DESC, id DESC LIMIT 1
+        ) WHERE {where};'''
+
+    def week_of(row, week):
+        return f'user_id = {row}.user_id AND week_start = {week.format(row)}'
+
+    conn.execute(f'CREATE TRIGGER moods_weekly_insert AFTER INSERT ON moods BEGIN {add_mood} END')
+    conn.execute(f'''CREATE TRIGGER moods_weekly_update AFTER UPDATE OF mood, mood_date, user_id ON moods BEGIN
+        INSERT OR IGNORE INTO weekly_summaries (user_id, week_start) VALUES (NEW.user_id, {mood_week.format('NEW')});
+        {refresh_moods(week_of('OLD', mood_week))} {refresh_moods(week_of('NEW', mood_week))} END''')
+    conn.execute(f'''CREATE TRIGGER moods_weekly_delete AFTER DELETE ON moods BEGIN
+        {refresh_moods(week_of('OLD', mood_week))} END''')
+    conn.execute(f'CREATE TRIGGER journals_weekly_insert AFTER INSERT ON journals BEGIN {add_journal} END')
+    conn.execute(f'''CREATE TRIGGER journals_weekly_update AFTER UPDATE OF entry, journal_date, user_id ON journals BEGIN
+        INSERT OR IGNORE INTO weekly_summaries (user_id, week_start) VALUES (NEW.user_id, {journal_week.format('NEW')});
+        {refresh_journals(week_of('OLD', journal_week))} {refresh_journals(week_of('NEW', journal_week))} END''')
+    conn.execute(f'''CREATE TRIGGER journals_weekly_delete AFTER DELETE ON journals BEGIN
+        {refresh_journals(week_of('OLD', journal_week))} END''')
+    conn.execute(f'''INSERT INTO weekly_summaries (user_id, week_start)
+                     SELECT DISTINCT user_id, {mood_week.format('moods')} FROM moods
+                     UNION SELECT DISTINCT user_id, {journal_week.format('journals')} FROM journals''')
+    conn.execute(refresh_moods('1'))
+    conn.execute(refresh_journals('1'))
+
+def _migrate_v11(conn):
+    """Rescore journals: negation no longer carries across clause punctuation."""
+    _rescore(conn, conn.execute('SELECT id, entry FROM journals').fetchall())
+
+def _migrate_v12(conn):
+    """Per-user notification settings, so background delivery doesn't depend on a browser session."""
+    options = 'STRICT' if sqlite3.sqlite_version_info >= (3, 37, 0) else ''
+    conn.execute(f'''CREATE TABLE notification_settings (
+        user_id INTEGER PRIMARY KEY,
+        settings TEXT NOT NULL,  -- JSON object, see NOTIFICATION_DEFAULTS
+        updated_at TEXT NOT NULL
+    ) {options}''')
+
+def _migrate_v13(conn):
+    """Bind users to the identity they sign in with."""
+    conn.execute('ALTER TABLE users ADD COLUMN identity TEXT')
+    conn.execute('CREATE UNIQUE INDEX idx_users_identity ON users (identity) WHERE identity IS NOT NULL')
+
+def _migrate_v14(conn):
+    """Index journals' user_id alongside the text, so a search matches within one user's entries."""
+    for trigger in ('journals_fts_insert', 'journals_fts_update', 'journals_fts_delete'):
+        conn.execute(f'DROP TRIGGER {trigger}')
+    conn.execute('DROP TABLE journals_fts')
+    conn.execute('''CREATE VIRTUAL TABLE journals_fts USING fts5(
+        entry, user_id, content='journals', content_rowid='id', tokenize='porter unicode61'
+    )''')
+    # Relevance comes from the entry text alone
+    conn.execute("INSERT INTO journals_fts (journals_fts, rank) VALUES ('rank', 'bm25(1.0, 0.0)')")
+    add = 'INSERT INTO journals_fts (rowid, entry, user_id) VALUES (NEW.id, NEW.entry, NEW.user_id);'
+    remove = "INSERT INTO journals_fts (journals_fts, rowid, entry, user_id) VALUES ('delete', OLD.id, OLD.entry, OLD.user_id);"
+    conn.execute(f'CREATE TRIGGER journals_fts_insert AFTER INSERT ON journals BEGIN {add} END')
+    conn.execute(f'CREATE TRIGGER journals_fts_delete AFTER DELETE ON journals BEGIN {remove} END')
+    conn.execute(f'CREATE TRIGGER journals_fts_update AFTER UPDATE OF entry, user_id ON journals BEGIN {remove} {add} END')
+    conn.execute("INSERT INTO journals_fts (journals_fts) VALUES ('rebuild')")
+
+def _migrate_v15(conn):
+    """Remove email app passwords from the saved notification settings; they are no longer stored."""
+    removed = 0
+    for user_id, settings in conn.execute('SELECT user_id, settings FROM notification_settings').fetchall():
+        settings = json.loads(settings)
+        if settings.pop('email_password', None) is not None:
+            conn.execute('UPDATE notification_settings SET settings = ? WHERE user_id = ?', (json.dumps(settings), user_id))
+            removed += 1
+    if removed:
+        logger.warning("%d saved email app passwords were removed from the database; set them again in Settings "
+                       "or in the CARESYNC_SMTP_PASSWORD environment variable", removed)
+
+# Ordered schema steps; step N upgrades a database from user_version N-1 to N.
+# Only ever append here, never edit a step that has shipped.
+MIGRATIONS = [
+    _migrate_v1,
+    _migrate_v2,
+    _migrate_v3,
+    _migrate_v4,
+    _migrate_v5,
+    _migrate_v6,
+    _migrate_v7,
+    _migrate_v8,
+    _migrate_v9,
+    _migrate_v10,
+    _migrate_v11,
+    _migrate_v12,
+    _migrate_v13,
+    _migrate_v14,
+    _migrate_v15,
+]
+
+def migrate(conn):
+    """Apply pending MIGRATIONS, each in its own transaction, tracked by PRAGMA user_version."""
+    while True:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Re-read under the write lock in case another process migrated first
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version >= len(MIGRATIONS):
+                conn.execute('COMMIT')
+                return version
+            MIGRATIONS[version](conn)
+            conn.execute(f'PRAGMA user_version = {version + 1}')
+            conn.execute('COMMIT')
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+
+def init_db():
+    """Create or upgrade the schema. A no-op once this process has migrated DB_PATH."""
+    get_pool()
+
+@_db_timed
+def add_user(name):
+    """Id of the user with this name, created if new."""
+    with transaction() as conn:
+        conn.execute('INSERT OR IGNORE INTO users (name, created_at) VALUES (?, ?)',
+                     (name, datetime.now().isoformat(timespec='seconds')))
+        return conn.execute('SELECT id FROM users WHERE name = ?', (name,)).fetchone()[0]
+
+@_db_timed
+def get_identity_user(identity):
+    """Id of the user who signs in as identity (an email address, say), created on their first sign-in."""
+    sql = 'SELECT id FROM users WHERE identity = ?'
+    with transaction(write=False) as conn:
+        row = conn.execute(sql, (identity,)).fetchone()
+    if row is None:
+        with transaction() as conn:
+            # Checked again under the write lock, for a first sign-in in two sessions at once
+            row = conn.execute(sql, (identity,)).fetchone()
+            if row is None:
+                return conn.execute('INSERT INTO users (name, identity, created_at) VALUES (?, ?, ?)',
+                                    (identity, identity, datetime.now().isoformat(timespec='seconds'))).lastrowid
+    return row[0]
+
+@_db_timed
+@cached
+def get_users():
+    """(id, name) of every user, in the order they were added."""
+    with transaction(write=False) as conn:
+        return conn.execute('SELECT id, name FROM users ORDER BY id').fetchall()
+
+@_db_timed
+def add_medication(name, dose, frequency, time, user_id=DEFAULT_USER_ID):
+    with transaction() as conn:
+        conn.execute('INSERT INTO medications (name, dose, frequency, time, user_id) VALUES (?, ?, ?, ?, ?)',
+                     (name, dose, frequency, parse_minutes(time), user_id))
+
+@_db_timed
+def get_today_medications(user_id=DEFAULT_USER_ID):
+    return _get_medications_for(date.today().isoformat(), user_id)
+
+@cached
+def _get_medications_for(day, user_id=DEFAULT_USER_ID):
+    """(Medication records, {med_id: status} of the day's logs) of one user."""
+    with transaction(write=False) as conn:
+        meds = [Medication(*row) for row in conn.execute('''SELECT id, name, dose, frequency, time, user_id FROM medications
+                                                            WHERE user_id = ? ORDER BY id''', (user_id,))]
+        logs = {row[0]: STATUS_NAMES[row[1]] for row in conn.execute('SELECT med_id, status FROM med_logs WHERE user_id = ? AND log_date = ?',
+                                                                     (user_id, _day(day)))}
     return meds, logs
 
-def log_medication(med_id, status):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    today = date.today().isoformat()
-    c.execute('INSERT OR REPLACE INTO med_logs (med_id, log_date, status) VALUES (?, ?, ?)', (med_id, today, status))
-    conn.commit()
-    conn.close()
-
-def add_mood(mood, mood_emoji):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    today = date.today().isoformat()
-    c.execute('INSERT INTO moods (mood, mood_emoji, mood_date) VALUES (?, ?, ?)', (mood, mood_emoji, today))
-    conn.commit()
-    conn.close()
-
-def get_moods():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('SELECT mood, mood_emoji, mood_date FROM moods ORDER BY mood_date DESC LIMIT 30')
-    moods = c.fetchall()
-    conn.close()
-    return moods
-
-def add_journal(entry):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    today = date.today().isoformat()
-    c.execute('INSERT INTO journals (entry, journal_date) VALUES (?, ?)', (entry, today))
-    conn.commit()
-    conn.close()
-
-def get_journals():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('SELECT entry, journal_date FROM journals ORDER BY journal_date DESC LIMIT 30')
-    journals = c.fetchall()
-    conn.close()
-    return journals 
\ No newline at end of file
+@_db_timed
+def get_dose_logs(day, user_id=DEFAULT_USER_ID):
+    """{med_id: status} of a user's logs on a day, read fresh: other processes may have logged since."""
+    with transaction(write=False) as conn:
+        return {row[0]: STATUS_NAMES[row[1]] for row in conn.execute('SELECT med_id, status FROM med_logs WHERE user_id = ? AND log_date = ?',
+                                                                     (user_id, _day(day)))}
+
+# Takes (med_id, day number, status code, med_id, user_id); a log is only
+# written for a medication of that user, and inherits its user_id
+LOG_UPSERT_SQL = '''INSERT INTO med_logs (med_id, log_date, status, user_id)
+                    SELECT ?, ?, ?, user_id FROM medications WHERE id = ? AND user_id = ?
+                    ON CONFLICT (med_id, log_date) DO UPDATE SET status=excluded.status'''
+MOOD_INSERT_SQL = 'INSERT INTO moods (mood, mood_emoji, mood_date, user_id) VALUES (?, ?, ?, ?)'
+JOURNAL_INSERT_SQL = 'INSERT INTO journals (entry, journal_date, sentiment, emotion, user_id) VALUES (?, ?, ?, ?, ?)'
+
+@_db_timed
+def log_medication(med_id, status, user_id=DEFAULT_USER_ID):
+    today = _day(date.today())
+    with transaction() as conn:
+        conn.execute(LOG_UPSERT_SQL, (med_id, today, _status_code(status), med_id, user_id))
+
+@_db_timed
+def add_mood(mood, mood_emoji, user_id=DEFAULT_USER_ID):
+    today = _day(date.today())
+    with transaction() as conn:
+        conn.execute(MOOD_INSERT_SQL, (mood, mood_emoji, today, user_id))
+
+@_db_timed
+@cached
+def get_moods(user_id=DEFAULT_USER_ID):
+    with transaction(write=False) as conn:
+        return conn.execute(f'''SELECT mood, mood_emoji, {_iso_sql('mood_date')} FROM moods WHERE user_id = ?
+                                ORDER BY mood_date DESC, id DESC LIMIT 30''', (user_id,)).fetchall()
+
+# Points of a mood series. Raw points have low == high == mood and count 1;
+# aggregated points carry the bucket's average, range and number of entries.
+MoodPoint = namedtuple('MoodPoint', ['date', 'mood', 'low', 'high', 'count'])
+
+# SQL expression mapping mood_date to the day number starting its bucket
+MOOD_BUCKETS = {
+    'daily': 'mood_date',
+    'weekly': '(mood_date - (mood_date + 3) % 7)',  # Monday of that week; 1970-01-01 was a Thursday
+    'monthly': f"(mood_date + 1 - CAST(strftime('%d', mood_date + {EPOCH_JULIAN_DAY}) AS INTEGER))",
+}
+
+@_db_timed
+@cached
+def get_mood_series(start=None, end=None, granularity='raw', max_points=MOOD_MAX_POINTS, user_id=DEFAULT_USER_ID):
+    """A user's moods between two ISO dates (inclusive, open-ended if None) as MoodPoints, oldest first.
+
+    Aggregation to daily/weekly/monthly buckets happens in SQL. Series longer
+    than max_points are downsampled with LTTB, so the result stays bounded
+    however long the range is.
+    """
+    bounds = (user_id,) + _day_range(start, end)
+    with transaction(write=False) as conn:
+        if granularity == 'raw':
+            rows = conn.execute('''SELECT mood_date, mood, mood, mood, 1 FROM moods
+                                   WHERE user_id = ? AND mood_date BETWEEN ? AND ?
+                                   ORDER BY mood_date, id''', bounds).fetchall()
+        elif granularity in MOOD_BUCKETS:
+            bucket = MOOD_BUCKETS[granularity]
+            rows = conn.execute(f'''SELECT {bucket} AS bucket, AVG(mood), MIN(mood), MAX(mood), COUNT(*)
+                                    FROM moods WHERE user_id = ? AND mood_date BETWEEN ? AND ?
+                                    GROUP BY bucket ORDER BY bucket''', bounds).fetchall()
+        else:
+            raise ValueError(f"unknown granularity {granularity!r}")
+
+    if len(rows) > max_points:
+        keyed = [(row[0], row[1], row) for row in rows]
+        rows = [row for _, _, row in lttb(keyed, max_points)]
+    return [MoodPoint(_iso(row[0]), *row[1:]) for row in rows]
+
+@_db_timed
+def add_journal(entry, user_id=DEFAULT_USER_ID):
+    today = _day(date.today())
+    with transaction() as conn:
+        conn.execute(JOURNAL_INSERT_SQL, (entry, today) + sentiment.analyze([entry])[0] + (user_id,))
+
+@_db_timed
+@cached
+def get_journals(user_id=DEFAULT_USER_ID):
+    with transaction(write=False) as conn:
+        return conn.execute(f'''SELECT entry, {_iso_sql('journal_date')} FROM journals WHERE user_id = ?
+                                ORDER BY journal_date DESC, id DESC LIMIT 30''', (user_id,)).fetchall()
+
+# A week's rollup: mood_avg/min/max are None without moods, excerpt is the
+# start of the week's latest journal entry (None without entries).
+WeeklySummary = namedtuple('WeeklySummary', ['week_start', 'mood_count', 'mood_avg', 'mood_min', 'mood_max',
+                                             'journal_count', 'journal_chars', 'excerpt'])
+
+@_db_timed
+@cached
+def get_weekly_summaries(before=None, limit=52, user_id=DEFAULT_USER_ID):
+    """A user's WeeklySummary rows for weeks starting before an ISO date (all if None), newest first."""
+    with transaction(write=False) as conn:
+        rows = conn.execute(f'''SELECT {_iso_sql('week_start')}, mood_count, CAST(mood_sum AS REAL) / NULLIF(mood_count, 0),
+                                       mood_min, mood_max, journal_count, journal_chars, excerpt
+                                FROM weekly_summaries
+                                WHERE user_id = ? AND week_start < ? AND (mood_count > 0 OR journal_count > 0)
+                                ORDER BY week_start DESC LIMIT ?''', (user_id, _day(before or '9999-12-31'), limit)).fetchall()
+    return [WeeklySummary(*row) for row in rows]
+
+@_db_timed
+def rescore_journals(only_missing=False, user_id=None):
+    """Recompute stored sentiment, e.g. after the lexicon changed, for one user or (None) everyone.
+
+    Returns the number of entries scored.
+    Works through the entries in batches of BULK_CHUNK_SIZE, each in its own
+    transaction, so writers aren't held up for the whole run.
+    """
+    where = 'AND sentiment IS NULL' if only_missing else ''
+    params = ()
+    if user_id is not None:
+        where += ' AND user_id = ?'
+        params = (user_id,)
+    last_id = count = 0
+    while True:
+        with transaction() as conn:
+            rows = conn.execute(f'SELECT id, entry FROM journals WHERE id > ? {where} ORDER BY id LIMIT ?',
+                                (last_id,) + params + (BULK_CHUNK_SIZE,)).fetchall()
+            if not rows:
+                return count
+            _rescore(conn, rows)
+        last_id = rows[-1][0]
+        count += len(rows)
+
+# Journal tone per bucket: average sentiment in [-1, 1], number of entries,
+# and the most frequent dominant emotion (None if no entry had one).
+TonePoint = namedtuple('TonePoint', ['date', 'sentiment', 'count', 'emotion'])
+
+@_db_timed
+@cached
+def get_journal_tone(start=None, end=None, granularity='daily', user_id=DEFAULT_USER_ID):
+    """TonePoints of a user's scored journal entries between two ISO dates (inclusive, open-ended if None), oldest first."""
+    bucket = MOOD_BUCKETS[granularity].replace('mood_date', 'journal_date')
+    bounds = (user_id,) + _day_range(start, end)
+    with transaction(write=False) as conn:
+        rows = conn.execute(f'''SELECT {bucket} AS bucket, AVG(sentiment), COUNT(*) FROM journals
+                                WHERE user_id = ? AND journal_date BETWEEN ? AND ? AND sentiment IS NOT NULL
+                                GROUP BY bucket ORDER BY bucket''', bounds).fetchall()
+        emotions = {}
+        for bucket_start, emotion, _ in conn.execute(f'''SELECT {bucket} AS bucket, emotion, COUNT(*) AS n FROM journals
+                                                         WHERE user_id = ? AND journal_date BETWEEN ? AND ? AND emotion IS NOT NULL
+                                                         GROUP BY bucket, emotion ORDER BY bucket, n''', bounds):
+            emotions[bucket_start] = emotion  # rows come in ascending count, so the last one wins
+    return [TonePoint(_iso(day), score, count, emotions.get(day)) for day, score, count in rows]
+
+@_db_timed
+@cached
+def get_adherence(start, end, user_id=DEFAULT_USER_ID):
+    """A user's daily (log_date, taken, missed) rollups between two ISO dates, inclusive, oldest first.
+
+    Days without any logs are absent.
+    """
+    with transaction(write=False) as conn:
+        return conn.execute(f'''SELECT {_iso_sql('log_date')}, taken, missed FROM adherence_daily
+                                WHERE user_id = ? AND log_date BETWEEN ? AND ? AND taken + missed > 0
+                                ORDER BY log_date''', (user_id,) + _day_range(start, end)).fetchall()
+
+@_db_timed
+@cached
+def get_medication_adherence(start=None, end=None, user_id=DEFAULT_USER_ID):
+    """Per-medication (med_id, name, taken, missed) of a user, over all time or between two ISO dates."""
+    with transaction(write=False) as conn:
+        if start is None and end is None:
+            return conn.execute('''SELECT m.id, m.name, a.taken, a.missed
+                                   FROM medications m JOIN adherence_by_med a ON a.med_id = m.id
+                                   WHERE m.user_id = ? AND a.taken + a.missed > 0 ORDER BY m.id''', (user_id,)).fetchall()
+        return conn.execute('''SELECT m.id, m.name, SUM(l.status = 1), SUM(l.status = 2)
+                               FROM med_logs l JOIN medications m ON m.id = l.med_id
+                               WHERE l.user_id = ? AND l.log_date BETWEEN ? AND ?
+                               GROUP BY m.id ORDER BY m.id''',
+                            (user_id,) + _day_range(start, end)).fetchall()
+
+# A journal search result. snippet has the matched terms wrapped in ** for
+# markdown; (rank, id) is the keyset cursor to pass as `after` for the next page.
+JournalHit = namedtuple('JournalHit', ['id', 'journal_date', 'snippet', 'rank'])
+
+def _fts_query(text, user_id):
+    # Quote every word so FTS5 syntax in user input is matched literally, and
+    # prefix-match the last one so results show up while typing. The user_id
+    # column filter keeps the match to that user's entries.
+    words = re.findall(r'\w+', text)
+    if not words:
+        return None
+    return f'user_id : "{int(user_id)}" AND entry : (' + ' '.join(f'"{w}"' for w in words) + '*)'
+
+@_db_timed
+@cached
+def search_journals(query, limit=SEARCH_PAGE_SIZE, after=None, user_id=DEFAULT_USER_ID):
+    """A user's best-matching journals for free text, as JournalHits ordered by relevance.
+
+    Pagination is keyset based: pass the last hit's (rank, id) as `after`.
+    """
+    match = _fts_query(query, user_id)
+    if match is None:
+        return []
+    sql = f'''SELECT f.rowid, {_iso_sql('j.journal_date')}, snippet(journals_fts, 0, '**', '**', '…', 12), f.rank
+             FROM journals_fts f JOIN journals j ON j.id = f.rowid
+             WHERE journals_fts MATCH ? {{page}}
+             ORDER BY f.rank, f.rowid LIMIT ?'''
+    with transaction(write=False) as conn:
+        if after is None:
+            rows = conn.execute(sql.format(page=''), (match, limit)).fetchall()
+        else:
+            rank, last_id = after
+            page = 'AND (f.rank > ? OR (f.rank = ? AND f.rowid > ?))'
+            rows = conn.execute(sql.format(page=page), (match, rank, rank, last_id, limit)).fetchall()
+    return [JournalHit(*row) for row in rows]
+
+@_db_timed
+def claim_reminder(med_id, remind_date, occurrence=0):
+    """Record a reminder as sent. True only for the first claim, across sessions and processes."""
+    with transaction(invalidate=False) as conn:
+        cur = conn.execute('''INSERT OR IGNORE INTO reminder_ledger (med_id, remind_date, occurrence, sent_at)
+                              VALUES (?, ?, ?, ?)''', (med_id, _day(remind_date), occurrence, datetime.now().isoformat(timespec='seconds')))
+        return cur.rowcount == 1
+
+@_db_timed
+def get_sent_reminders(remind_date):
+    """(med_id, occurrence) pairs already reminded about on a day."""
+    with transaction(write=False) as conn:
+        return set(conn.execute('SELECT med_id, occurrence FROM reminder_ledger WHERE remind_date=?', (_day(remind_date),)))
+
+# A notification claimed for delivery from the outbox
+OutboxItem = namedtuple('OutboxItem', ['id', 'idempotency_key', 'channel', 'title', 'message', 'attempts', 'user_id'])
+
+@_db_timed
+def enqueue_notifications(items, user_id=DEFAULT_USER_ID):
+    """Queue (idempotency_key, channel, title, message) notifications for a user; repeated keys are ignored.
+
+    Returns how many were newly queued. Call inside a transaction to queue
+    atomically with the change that caused them.
+    """
+    now = time.time()
+    created = datetime.now().isoformat(timespec='seconds')
+    count = 0
+    with transaction(invalidate=False) as conn:
+        for key, channel, title, message in items:
+            cur = conn.execute('''INSERT OR IGNORE INTO notification_outbox
+                                  (idempotency_key, channel, title, message, next_attempt_at, created_at, user_id)
+                                  VALUES (?, ?, ?, ?, ?, ?, ?)''', (key, channel, title, message, now, created, user_id))
+            count += cur.rowcount
+    return count
+
+@_db_timed
+def claim_outbox(limit, lease_seconds):
+    """Lease up to limit due notifications for delivery, oldest first.
+
+    A leased item that is neither completed nor retried within lease_seconds
+    (say the worker died) becomes due again.
+    """
+    now = time.time()
+    with transaction(invalidate=False) as conn:
+        rows = conn.execute('''SELECT id, idempotency_key, channel, title, message, attempts + 1, user_id
+                               FROM notification_outbox
+                               WHERE status IN ('pending', 'sending') AND next_attempt_at <= ?
+                               ORDER BY next_attempt_at LIMIT ?''', (now, limit)).fetchall()
+        conn.executemany('''UPDATE notification_outbox SET status = 'sending', attempts = attempts + 1, next_attempt_at = ?
+                            WHERE id = ?''', [(now + lease_seconds, row[0]) for row in rows])
+    return [OutboxItem(*row) for row in rows]
+
+@_db_timed
+def complete_outbox(item_id):
+    with transaction(invalidate=False) as conn:
+        conn.execute("UPDATE notification_outbox SET status = 'sent', sent_at = ?, last_error = NULL WHERE id = ?",
+                     (datetime.now().isoformat(timespec='seconds'), item_id))
+
+@_db_timed
+def retry_outbox(item_id, delay, error):
+    with transaction(invalidate=False) as conn:
+        conn.execute("UPDATE notification_outbox SET status = 'pending', next_attempt_at = ?, last_error = ? WHERE id = ?",
+                     (time.time() + delay, error, item_id))
+
+@_db_timed
+def fail_outbox(item_id, error):
+    with transaction(invalidate=False) as conn:
+        conn.execute("UPDATE notification_outbox SET status = 'failed', last_error = ? WHERE id = ?", (error, item_id))
+
+@_db_timed
+def next_outbox_due():
+    """Unix time the next queued notification becomes due, or None if the outbox is empty."""
+    with transaction(write=False) as conn:
+        return conn.execute('''SELECT MIN(next_attempt_at) FROM notification_outbox
+                               WHERE status IN ('pending', 'sending')''').fetchone()[0]
+
+# Delivery settings of a user who hasn't saved any. The email app password
+# isn't one of them and is never stored here; see notifications.get_email_password
+NOTIFICATION_DEFAULTS = {
+    'email_enabled': False,
+    'email_address': '',
+    'smtp_server': 'smtp.gmail.com',
+    'smtp_port': 587,
+    'smtp_starttls': True,
+    'desktop_enabled': False,
+    'mobile_enabled': False,
+}
+
+@_db_timed
+def get_notification_settings(user_id=DEFAULT_USER_ID):
+    """A user's saved notification settings, with defaults for anything not saved."""
+    with transaction(write=False) as conn:
+        row = conn.execute('SELECT settings FROM notification_settings WHERE user_id = ?', (user_id,)).fetchone()
+    return dict(NOTIFICATION_DEFAULTS, **(json.loads(row[0]) if row else {}))
+
+@_db_timed
+def get_all_notification_settings():
+    """{user_id: settings} of every user who has saved notification settings."""
+    with transaction(write=False) as conn:
+        rows = conn.execute('SELECT user_id, settings FROM notification_settings').fetchall()
+    return {user_id: dict(NOTIFICATION_DEFAULTS, **json.loads(settings)) for user_id, settings in rows}
+
+@_db_timed
+def save_notification_settings(settings, user_id=DEFAULT_USER_ID):
+    """Store a user's notification settings; keys outside NOTIFICATION_DEFAULTS are dropped."""
+    settings = {key: settings[key] for key in NOTIFICATION_DEFAULTS if key in settings}
+    with transaction(invalidate=False) as conn:
+        conn.execute('''INSERT INTO notification_settings (user_id, settings, updated_at) VALUES (?, ?, ?)
+                        ON CONFLICT (user_id) DO UPDATE SET settings = excluded.settings, updated_at = excluded.updated_at''',
+                     (user_id, json.dumps(settings), datetime.now().isoformat(timespec='seconds')))
+
+def chunked(rows, size):
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+def _bulk_write(sql, rows):
+    count = 0
+    with transaction() as conn:
+        for chunk in chunked(rows, BULK_CHUNK_SIZE):
+            count += conn.executemany(sql, chunk).rowcount
+    return count
+
+@_db_timed
+def log_medications_bulk(rows, user_id=DEFAULT_USER_ID):
+    """Upsert an iterable of (med_id, log_date, status) rows in one transaction.
+
+    Rows for medications that aren't the user's are skipped.
+    """
+    return _bulk_write(LOG_UPSERT_SQL, ((med_id, _day(log_date), _status_code(status), med_id, user_id)
+                                        for med_id, log_date, status in rows))
+
+@_db_timed
+def add_moods_bulk(rows, user_id=DEFAULT_USER_ID):
+    """Insert an iterable of (mood, mood_emoji, mood_date) rows in one transaction."""
+    return _bulk_write(MOOD_INSERT_SQL, ((mood, mood_emoji, _day(mood_date), user_id) for mood, mood_emoji, mood_date in rows))
+
+@_db_timed
+def add_journals_bulk(rows, user_id=DEFAULT_USER_ID):
+    """Insert an iterable of (entry, journal_date) rows in one transaction, scoring them as they go."""
+    def scored():
+        for chunk in chunked(rows, BULK_CHUNK_SIZE):
+            scores = sentiment.analyze(entry for entry, _ in chunk)
+            for (entry, journal_date), (score, emotion) in zip(chunk, scores):
+                yield entry, _day(journal_date), score, emotion, user_id
+    return _bulk_write(JOURNAL_INSERT_SQL, scored())
+
+# Exportable tables: kind -> (column names, keyset page query, first cursor,
+# cursor after a row). Columns match what the importer reads back.
+_EXPORTS = {
+    'medications': (
+        ('id', 'name', 'dose', 'frequency', 'time'),
+        '''SELECT id, name, dose, frequency, CASE WHEN time IS NOT NULL THEN printf('%02d:%02d:00', time / 60, time % 60) END
+           FROM medications
+           WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?''',
+        (0,), lambda row: (row[0],)),
+    'med_logs': (
+        ('med_id', 'log_date', 'status'),
+        f'''SELECT med_id, {_iso_sql('log_date')}, CASE status WHEN 1 THEN 'taken' WHEN 2 THEN 'missed' END FROM med_logs
+            WHERE user_id = ? AND (med_id, log_date) > (?, ?) ORDER BY med_id, log_date LIMIT ?''',
+        (0, 0), lambda row: (row[0], _day(row[1]))),
+    'moods': (
+        ('id', 'mood', 'mood_emoji', 'mood_date'),
+        f'''SELECT id, mood, mood_emoji, {_iso_sql('mood_date')} FROM moods
+            WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?''',
+        (0,), lambda row: (row[0],)),
+    'journals': (
+        ('id', 'entry', 'journal_date', 'sentiment', 'emotion'),
+        f'''SELECT id, entry, {_iso_sql('journal_date')}, sentiment, emotion FROM journals
+            WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?''',
+        (0,), lambda row: (row[0],)),
+}
+EXPORT_COLUMNS = {kind: columns for kind, (columns, *_) in _EXPORTS.items()}
+
+@_db_timed
+def export_chunks(kind, user_id=DEFAULT_USER_ID, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield all of a user's rows of one kind, in lists of up to chunk_size rows.
+
+    Rows are read a page at a time by keyset, each page in its own short read,
+    so memory stays flat and no connection is held while the caller writes.
+    """
+    try:
+        _, sql, cursor, next_cursor = _EXPORTS[kind]
+    except KeyError:
+        raise ValueError(f"unknown export kind {kind!r}")
+    while True:
+        with transaction(write=False) as conn:
+            rows = conn.execute(sql, (user_id,) + cursor + (chunk_size,)).fetchall()
+        if not rows:
+            return
+        yield rows
+        if len(rows) < chunk_size:
+            return
+        cursor = next_cursor(rows[-1])
+
+# Everything a dashboard rerun reads, taken from one consistent read transaction.
+# medications are Medication records, doses the day's DoseEvent for each of
+# them, logs maps med_id to the day's status, moods/journals are the most
+# recent entries, newest first. All of it is one user's.
+DashboardSnapshot = namedtuple('DashboardSnapshot', ['user_id', 'day', 'medications', 'doses', 'logs', 'moods', 'latest_mood', 'journals'])
+
+@_db_timed
+def load_dashboard_snapshot(user_id=DEFAULT_USER_ID):
+    return _load_dashboard_snapshot(date.today().isoformat(), user_id)
+
+@cached
+def _load_dashboard_snapshot(day, user_id=DEFAULT_USER_ID):
+    with transaction(write=False) as conn:
+        rows = conn.execute('''SELECT m.id, m.name, m.dose, m.frequency, m.time, m.user_id, l.status
+                               FROM medications m
+                               LEFT JOIN med_logs l ON l.med_id = m.id AND l.log_date = ?
+                               WHERE m.user_id = ?
+                               ORDER BY m.id''', (_day(day), user_id)).fetchall()
+        moods = conn.execute(f'''SELECT mood, mood_emoji, {_iso_sql('mood_date')} FROM moods WHERE user_id = ?
+                                 ORDER BY mood_date DESC, id DESC LIMIT 30''', (user_id,)).fetchall()
+        journals = conn.execute(f'''SELECT entry, {_iso_sql('journal_date')} FROM journals WHERE user_id = ?
+                                    ORDER BY journal_date DESC, id DESC LIMIT 30''', (user_id,)).fetchall()
+    medications = [Medication(*row[:6]) for row in rows]
+    statuses = [STATUS_NAMES.get(row[6]) for row in rows]
+    logs = {med.id: status for med, status in zip(medications, statuses) if status is not None}
+    return DashboardSnapshot(
+        user_id=user_id,
+        day=day,
+        medications=medications,
+        doses=[DoseEvent(med, day, 0, status) for med, status in zip(medications, statuses)],
+        logs=logs,
+        moods=moods,
+        latest_mood=moods[0] if moods else None,
+        journals=journals,
+    )
@@ -0,0 +1,104 @@
+# Streaming export of a user's medications, logs, moods and journals from CareSync
+
+import csv
+import io
+import json
+import os
+import zipfile
+
+from common import database
+
+EXPORT_KINDS = ("medications", "med_logs", "moods", "journals")
+FORMATS = ("csv", "jsonl", "parquet")
+
+# Parquet column types; every other column is a string
+_INT_COLUMNS = {"id", "med_id", "mood"}
+_FLOAT_COLUMNS = {"sentiment"}
+
+
+def write_csv(chunks, columns, f):
+    out = io.TextIOWrapper(f, encoding="utf-8", newline="")
+    writer = csv.writer(out)
+    writer.writerow(columns)
+    count = 0
+    for chunk in chunks:
+        writer.writerows(chunk)
+        count += len(chunk)
+    out.flush()
+    out.detach()  # leave f open for the caller
+    return count
+
+
+def write_jsonl(chunks, columns, f):
+    count = 0
+    for chunk in chunks:
+        lines = (json.dumps(dict(zip(columns, row)), ensure_ascii=False) for row in chunk)
+        f.write(("\n".join(lines) + "\n").encode("utf-8"))
+        count += len(chunk)
+    return count
+
+
+def write_parquet(chunks, columns, f):
+    """Write each chunk as its own row group, so only one chunk is ever in memory."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ValueError("Parquet export needs pyarrow (pip install pyarrow)") from None
+    schema = pa.schema([
+        (name, pa.int64() if name in _INT_COLUMNS else pa.float64() if name in _FLOAT_COLUMNS else pa.string())
+        for name in columns
+    ])
+    count = 0
+    with pq.ParquetWriter(f, schema) as writer:
+        for chunk in chunks:
+            arrays = [pa.array(values, type=field.type) for values, field in zip(zip(*chunk), schema)]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            count += len(chunk)
+    return count
+
+
+WRITERS = {
+    "csv": write_csv,
+    "jsonl": write_jsonl,
+    "parquet": write_parquet,
+}
+
+
+def export_records(kind, fmt, f, user_id=database.DEFAULT_USER_ID, chunk_size=database.EXPORT_CHUNK_SIZE):
+    """Write all of a user's records of one kind to a binary file, a chunk at a time.
+
+    Returns the number of records written. CSV and JSON Lines exports of
+    med_logs, moods and journals can be read back by the importer.
+    """
+    try:
+        writer = WRITERS[fmt]
+    except KeyError:
+        raise ValueError(f"unsupported export format {fmt!r}")
+    if kind not in database.EXPORT_COLUMNS:
+        raise ValueError(f"unknown export kind {kind!r}")
+    return writer(database.export_chunks(kind, user_id, chunk_size), database.EXPORT_COLUMNS[kind], f)
+
+
+def export_file(path, kind, fmt=None, user_id=database.DEFAULT_USER_ID, chunk_size=database.EXPORT_CHUNK_SIZE):
+    """Export one kind to a file; the format defaults to the file extension."""
+    if fmt is None:
+        fmt = os.path.splitext(path)[1].lower().lstrip(".")
+    with open(path, "wb") as f:
+        return export_records(kind, fmt, f, user_id, chunk_size)
+
+
+def export_archive(f, fmt="csv", user_id=database.DEFAULT_USER_ID, chunk_size=database.EXPORT_CHUNK_SIZE):
+    """Write a user's full history to a zip with one <kind>.<fmt> file per kind.
+
+    Each file is streamed into the archive as it is written. Returns
+    {kind: number of records}.
+    """
+    if fmt not in WRITERS:
+        raise ValueError(f"unsupported export format {fmt!r}")
+    counts = {}
+    with zipfile.ZipFile(f, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for kind in EXPORT_KINDS:
+            with archive.open(f"{kind}.{fmt}", "w", force_zip64=True) as entry:
+                counts[kind] = export_records(kind, fmt, entry, user_id, chunk_size)
+    return counts
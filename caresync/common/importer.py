@@ -0,0 +1,162 @@
+# Streaming import of medication logs, moods and journals into CareSync
+
+import csv
+import json
+import os
+import re
+from datetime import date
+
+from common import database
+
+IMPORT_CHUNK_SIZE = 5000  # records written per transaction
+READ_BUFFER_SIZE = 1 << 16
+MAX_JSON_ELEMENT_SIZE = 16 << 20  # characters one JSON array element may take
+
+STATUSES = ("taken", "missed")
+
+
+def _parse_date(value):
+    # Accept plain dates as well as timestamps exported by other trackers
+    return date.fromisoformat(str(value).strip()[:10]).isoformat()
+
+
+def _med_log_row(record):
+    status = str(record["status"]).strip().lower()
+    if status not in STATUSES:
+        raise ValueError(f"unknown status {record['status']!r}")
+    return int(record["med_id"]), _parse_date(record["log_date"]), status
+
+
+def _mood_row(record):
+    mood = int(record["mood"])
+    if not 1 <= mood <= 5:
+        raise ValueError(f"mood {mood} is outside 1-5")
+    return mood, record.get("mood_emoji") or "", _parse_date(record["mood_date"])
+
+
+def _journal_row(record):
+    return str(record["entry"]), _parse_date(record["journal_date"])
+
+
+# kind -> (record to row converter, bulk writer)
+KINDS = {
+    "med_logs": (_med_log_row, database.log_medications_bulk),
+    "moods": (_mood_row, database.add_moods_bulk),
+    "journals": (_journal_row, database.add_journals_bulk),
+}
+
+
+def iter_csv(f):
+    yield from csv.DictReader(f)
+
+
+def iter_jsonl(f):
+    for line in f:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+_SEPARATORS = re.compile(r"[\s,]*")
+
+
+def iter_json_array(f, buffer_size=READ_BUFFER_SIZE, max_element_size=MAX_JSON_ELEMENT_SIZE):
+    """Yield the elements of a top-level JSON array without loading the whole file.
+
+    Raises ValueError for an element longer than max_element_size characters,
+    which also bounds the buffer.
+    """
+    decoder = json.JSONDecoder()
+    buf, pos, eof, opened = "", 0, False, False
+    offset = 0  # characters of the file before buf
+    read_size = buffer_size
+    while True:
+        pos = _SEPARATORS.match(buf, pos).end()
+        if pos < len(buf):
+            if not opened:
+                if buf[pos] != "[":
+                    raise ValueError("expected a JSON array")
+                opened = True
+                pos += 1
+                continue
+            if buf[pos] == "]":
+                return
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                # Most likely the element is cut off at the end of the buffer
+                if eof:
+                    raise
+                pending = len(buf) - pos
+                if pending > max_element_size:
+                    raise ValueError(f"JSON array element at character {offset + pos} is malformed "
+                                     f"or longer than {max_element_size} characters") from None
+                # Read as much again as is buffered, so a long element is
+                # parsed a few times rather than once per buffer_size
+                read_size = max(buffer_size, pending)
+            else:
+                yield obj
+                pos = end
+                read_size = buffer_size
+                continue
+        elif eof:
+            raise ValueError("unexpected end of JSON array")
+        chunk = f.read(read_size)
+        eof = not chunk
+        offset += pos
+        buf = buf[pos:] + chunk
+        pos = 0
+
+
+READERS = {
+    "csv": iter_csv,
+    "jsonl": iter_jsonl,
+    "json": iter_json_array,
+}
+
+
+def iter_records(f, fmt):
+    try:
+        reader = READERS[fmt]
+    except KeyError:
+        raise ValueError(f"unsupported import format {fmt!r}")
+    return reader(f)
+
+
+def import_records(records, kind, chunk_size=IMPORT_CHUNK_SIZE, user_id=database.DEFAULT_USER_ID):
+    """Write an iterable of dict records of the given kind for a user, one transaction per chunk.
+
+    Returns the number of rows imported. Raises ValueError naming the first
+    bad record; chunks before it stay imported. Medication logs are only
+    imported for the user's own medications.
+    """
+    try:
+        convert, write = KINDS[kind]
+    except KeyError:
+        raise ValueError(f"unknown import kind {kind!r}")
+
+    def rows():
+        for n, record in enumerate(records, start=1):
+            try:
+                yield convert(record)
+            except KeyError as e:
+                raise ValueError(f"record {n}: missing field {e}") from e
+            except (TypeError, ValueError) as e:
+                raise ValueError(f"record {n}: {e}") from e
+
+    count = 0
+    for chunk in database.chunked(rows(), chunk_size):
+        count += write(chunk, user_id)
+    return count
+
+
+def import_file(path, kind, fmt=None, chunk_size=IMPORT_CHUNK_SIZE, user_id=database.DEFAULT_USER_ID):
+    """Stream a CSV, JSON Lines or JSON array file into the database.
+
+    The format defaults to the file extension (.csv, .jsonl/.ndjson, .json).
+    """
+    if fmt is None:
+        ext = os.path.splitext(path)[1].lower().lstrip(".")
+        fmt = "jsonl" if ext == "ndjson" else ext
+    with open(path, newline="", encoding="utf-8") as f:
+        return import_records(iter_records(f, fmt), kind, chunk_size, user_id)
@@ -0,0 +1,289 @@
+# In-process latency metrics for CareSync: histograms, a slow-query log and Prometheus text export
+
+import bisect
+import functools
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Histogram bucket upper bounds in seconds, as Prometheus' le labels
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SLOW_QUERY_SECONDS = 0.05  # statements slower than this go to the slow-query log
+SLOW_LOG_SIZE = 100  # slow queries kept, newest first
+EXPORT_INTERVAL = 15  # seconds between writes of the Prometheus file
+
+HELP = {
+    'caresync_db_call_seconds': "Time spent in a database helper, including query cache hits.",
+    'caresync_sql_seconds': "Time SQLite took to run a statement up to its first row, by statement type.",
+    'caresync_gpt_seconds': "Time to answer a GPT request, including cache hits and mock responses.",
+    'caresync_gpt_first_token_seconds': "Time from asking GPT to the first piece of the streamed answer, including cache hits and mock responses.",
+    'caresync_gpt_stream_seconds': "Time from asking GPT until its streamed answer was read to the end or abandoned.",
+    'caresync_notification_seconds': "Time to deliver a queued notification, by channel.",
+    'caresync_tab_render_seconds': "Time to render a tab of the app.",
+}
+
+
+class Histogram:
+    """Call count, total and bucketed distribution of durations in seconds."""
+
+    __slots__ = ('name', 'labels', 'counts', 'sum', 'count')
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        with _lock:
+            self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+            self.sum += seconds
+            self.count += 1
+
+    def quantile(self, q):
+        """Estimate a quantile by interpolating within its bucket, as Prometheus' histogram_quantile does."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                if i == len(BUCKETS):
+                    return BUCKETS[-1]
+                lower = BUCKETS[i - 1] if i else 0.0
+                return lower + (BUCKETS[i] - lower) * (rank - seen) / n
+            seen += n
+        return BUCKETS[-1]
+
+
+SlowQuery = namedtuple('SlowQuery', ['at', 'seconds', 'sql'])
+
+_lock = threading.Lock()
+_histograms = {}  # (name, ((label, value), ...)) -> Histogram
+_slow_queries = deque(maxlen=SLOW_LOG_SIZE)
+_slow_total = 0
+_sql_histograms = {}  # statement type -> Histogram, skipping histogram()'s key building per statement
+
+
+def histogram(name, **labels):
+    """The Histogram for a metric name and label values, created on first use."""
+    key = (name, tuple(sorted(labels.items())))
+    hist = _histograms.get(key)
+    if hist is None:
+        with _lock:
+            hist = _histograms.setdefault(key, Histogram(name, key[1]))
+    return hist
+
+
+def observe(name, seconds, **labels):
+    histogram(name, **labels).observe(seconds)
+
+
+@contextmanager
+def timer(name, **labels):
+    """Time the block into a histogram, whether or not it raises."""
+    hist = histogram(name, **labels)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        hist.observe(time.perf_counter() - start)
+
+
+def timed(name, **labels):
+    """Decorator timing every call of a function into a histogram."""
+    hist = histogram(name, **labels)
+
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                hist.observe(time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+def _statement(sql):
+    words = sql.split(None, 1)
+    return words[0].upper() if words else ''
+
+
+def _record_sql(sql, seconds):
+    global _slow_total
+    verb = _statement(sql)
+    hist = _sql_histograms.get(verb) or _sql_histograms.setdefault(verb, histogram('caresync_sql_seconds', statement=verb))
+    hist.observe(seconds)
+    if seconds >= SLOW_QUERY_SECONDS:
+        # Only the SQL text: parameters hold users' health data
+        text = " ".join(sql.split())
+        with _lock:
+            _slow_queries.appendleft(SlowQuery(datetime.now().isoformat(timespec='seconds'), seconds, text))
+            _slow_total += 1
+        logger.warning("Slow query (%.0f ms): %s", seconds * 1000, text)
+
+
+class TimedConnection(sqlite3.Connection):
+    """sqlite3 connection (pass as connect's factory) that times its statements and logs slow ones.
+
+    A statement is timed up to its first row, which for the aggregates and
+    writes that dominate here is all of it.
+    """
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _record_sql(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _record_sql(sql, time.perf_counter() - start)
+
+    def executescript(self, sql_script):
+        start = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            _record_sql(sql_script, time.perf_counter() - start)
+
+
+def slow_queries():
+    """The logged SlowQuery entries, newest first."""
+    with _lock:
+        return list(_slow_queries)
+
+
+def summary():
+    """One dict per histogram that has been called, slowest total first, for display."""
+    with _lock:
+        hists = [h for h in _histograms.values() if h.count]
+        rows = [{
+            'metric': h.name.replace('caresync_', '').replace('_seconds', ''),
+            'labels': ", ".join(f"{k}={v}" for k, v in h.labels),
+            'calls': h.count,
+            'total_ms': h.sum * 1000,
+            'mean_ms': h.sum * 1000 / h.count,
+            'p50_ms': h.quantile(0.5) * 1000,
+            'p95_ms': h.quantile(0.95) * 1000,
+        } for h in hists]
+    return sorted(rows, key=lambda row: row['total_ms'], reverse=True)
+
+
+def reset():
+    global _slow_total
+    with _lock:
+        for hist in _histograms.values():
+            hist.reset()
+        _slow_queries.clear()
+        _slow_total = 0
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(pairs):
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}" if pairs else ""
+
+
+def render_prometheus():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        families = {}
+        for hist in _histograms.values():
+            families.setdefault(hist.name, []).append(hist)
+        for name in sorted(families):
+            if name in HELP:
+                lines.append(f"# HELP {name} {HELP[name]}")
+            lines.append(f"# TYPE {name} histogram")
+            for hist in sorted(families[name], key=lambda h: h.labels):
+                cumulative = 0
+                for bound, n in zip(BUCKETS + ('+Inf',), hist.counts):
+                    cumulative += n
+                    lines.append(f"{name}_bucket{_labels(hist.labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{_labels(hist.labels)} {hist.sum!r}")
+                lines.append(f"{name}_count{_labels(hist.labels)} {hist.count}")
+        lines.append(f"# HELP caresync_slow_queries_total Statements slower than {SLOW_QUERY_SECONDS}s.")
+        lines.append("# TYPE caresync_slow_queries_total counter")
+        lines.append(f"caresync_slow_queries_total {_slow_total}")
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path):
+    """Write the metrics to path atomically, e.g. for node_exporter's textfile collector."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(render_prometheus())
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render_prometheus().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_exporters = {}  # what start_exporters has started, so Streamlit reruns start nothing twice
+
+
+def start_exporters(port=None, path=None, host='127.0.0.1', interval=EXPORT_INTERVAL):
+    """Serve the metrics at http://host:port/metrics and/or rewrite them to path every interval seconds.
+
+    Safe to call on every rerun: each exporter is started once per process.
+    """
+    with _lock:
+        if port and 'http' not in _exporters:
+            _exporters['http'] = None  # tried, even if the port turns out to be taken
+            try:
+                server = ThreadingHTTPServer((host, int(port)), _MetricsHandler)
+            except OSError:
+                logger.exception("Cannot serve metrics on %s:%s", host, port)
+            else:
+                threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+                _exporters['http'] = server
+        if path and 'file' not in _exporters:
+            def run():
+                while True:
+                    try:
+                        write_prometheus(path)
+                    except OSError:
+                        logger.exception("Failed to write metrics to %s", path)
+                    time.sleep(interval)
+            threading.Thread(target=run, name="metrics-file", daemon=True).start()
+            _exporters['file'] = path
@@ -0,0 +1,119 @@
+# Record types for medications and their scheduled doses
+
+MINUTES_PER_DAY = 24 * 60
+
+
+def parse_minutes(time_str):
+    """Minutes since midnight for an "HH:MM" or "HH:MM:SS" string, or None if it isn't one."""
+    try:
+        parts = [int(part) for part in time_str.split(":")]
+    except (AttributeError, ValueError):
+        return None
+    if len(parts) not in (2, 3) or not (0 <= parts[0] < 24 and 0 <= parts[1] < 60):
+        return None
+    return parts[0] * 60 + parts[1]
+
+
+def format_minutes(minutes):
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+def minutes_of(moment):
+    """Minutes since midnight of a datetime or time."""
+    return moment.hour * 60 + moment.minute
+
+
+class Medication:
+    """A medication and its daily reminder time.
+
+    time is given as an "HH:MM[:SS]" string or, as the database stores it,
+    minutes since midnight. minutes is the time as minutes since midnight,
+    parsed once when the record is built, or None if there is no valid time.
+    Records come out of the query cache and are shared, so treat them as
+    read-only.
+    """
+
+    __slots__ = ('id', 'name', 'dose', 'frequency', 'time', 'user_id', 'minutes')
+
+    def __init__(self, id, name, dose, frequency, time, user_id=None):
+        self.id = id
+        self.name = name
+        self.dose = dose
+        self.frequency = frequency
+        if isinstance(time, int):
+            self.minutes = time
+            self.time = format_minutes(time) + ":00"
+        else:
+            self.minutes = parse_minutes(time)
+            self.time = time
+        self.user_id = user_id
+
+    @property
+    def time_label(self):
+        return format_minutes(self.minutes) if self.minutes is not None else (self.time or "?")
+
+    def minutes_until(self, now_minutes):
+        """Minutes from now_minutes until today's dose (negative once it is past), or None without a valid time."""
+        return None if self.minutes is None else self.minutes - now_minutes
+
+    def __eq__(self, other):
+        return isinstance(other, Medication) and all(getattr(self, f) == getattr(other, f) for f in self.__slots__)
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return f"Medication(id={self.id!r}, name={self.name!r}, dose={self.dose!r}, time={self.time_label})"
+
+
+class DoseEvent:
+    """One scheduled dose of a medication on a given ISO day.
+
+    occurrence numbers the doses of that medication on that day; status is
+    the logged 'taken'/'missed', or None while the dose is still open.
+    """
+
+    __slots__ = ('medication', 'day', 'occurrence', 'status')
+
+    def __init__(self, medication, day, occurrence=0, status=None):
+        self.medication = medication
+        self.day = day
+        self.occurrence = occurrence
+        self.status = status
+
+    @property
+    def key(self):
+        """(med_id, day, occurrence), as recorded in the reminder ledger."""
+        return (self.medication.id, self.day, self.occurrence)
+
+    def __eq__(self, other):
+        return isinstance(other, DoseEvent) and self.key == other.key and self.status == other.status
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return f"DoseEvent({self.medication!r}, day={self.day!r}, occurrence={self.occurrence}, status={self.status!r})"
+
+
+def split_open_doses(doses, now_minutes):
+    """(overdue, upcoming) Medications of the DoseEvents not yet logged, by their time relative to now_minutes.
+
+    Doses without a valid time are in neither.
+    """
+    overdue, upcoming = [], []
+    for dose in doses:
+        until = dose.medication.minutes_until(now_minutes)
+        if dose.status is None and until is not None:
+            (overdue if until <= 0 else upcoming).append(dose.medication)
+    return overdue, upcoming
+
+
+def doses_due_soon(doses, now_minutes, window=30):
+    """(DoseEvent, minutes until due) of the doses not yet logged that fall due within window minutes of now_minutes, either side."""
+    due = []
+    for dose in doses:
+        until = dose.medication.minutes_until(now_minutes)
+        if dose.status is None and until is not None and -window <= until <= window:
+            due.append((dose, until))
+    return due
@@ -1,115 +1,367 @@
 import streamlit as st
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-import requests
-import json
-from datetime import datetime
+import hashlib
+import html
+import uuid
+import logging
 import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from datetime import datetime
+from common import database, metrics
+from common.models import DoseEvent, minutes_of
+from common.outbox import OutboxWorker
+
+logger = logging.getLogger(__name__)
+
+SMTP_IDLE_TIMEOUT = 60  # seconds an unused session is kept open
+SMTP_TIMEOUT = 15  # seconds for connect and each SMTP command
+DESKTOP_COALESCE_SECONDS = 2  # notifications this close together are shown as one
+DESKTOP_WORKERS = 2
+DESKTOP_TIMEOUT = 10  # seconds a notifier process may take
+SMTP_PASSWORD_ENV = 'CARESYNC_SMTP_PASSWORD'
+KEYRING_SERVICE = 'CareSync'
+
+# Email app passwords are never saved with the notification settings. They
+# come from the OS keyring (with the optional keyring package), or else from
+# $CARESYNC_SMTP_PASSWORD; one entered in Settings is also remembered here
+# for the rest of the process, for the background sends.
+_passwords = {}  # email address -> app password
+
+def get_email_password(address):
+    """App password for an email address, or '' if there is none"""
+    password = _passwords.get(address)
+    if password is None:
+        try:
+            import keyring
+            password = keyring.get_password(KEYRING_SERVICE, address)
+        except Exception:
+            password = None
+        password = password or os.environ.get(SMTP_PASSWORD_ENV, '')
+        if password:
+            _passwords[address] = password
+    return password
+
+def set_email_password(address, password):
+    """Remember an app password for this process, and in the OS keyring if there is one; True if it went into the keyring"""
+    _passwords[address] = password
+    try:
+        import keyring
+        keyring.set_password(KEYRING_SERVICE, address, password)
+        return True
+    except Exception:
+        logger.info("No OS keyring to keep the app password for %s in; it is kept until the app restarts", address)
+        return False
+
+class SMTPTransport:
+    """Reuses authenticated SMTP sessions instead of a handshake per message.
+    
+    One session is kept per server and account, and sends on different
+    sessions run concurrently. Sessions idle for longer than idle_timeout
+    are closed by a timer, and a session the server has dropped is
+    reconnected once before the send fails.
+    """
+    
+    def __init__(self, idle_timeout=SMTP_IDLE_TIMEOUT, timeout=SMTP_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._sessions = {}  # key -> (smtplib.SMTP, last used), for sessions not in use
+        self._key_locks = {}  # key -> Lock held while that account's session is in use
+        self._reaper = None
+        self._lock = threading.Lock()  # guards the dicts above; never held during network I/O
+    
+    def _key(self, settings):
+        return (settings.get('smtp_server', 'smtp.gmail.com'), settings.get('smtp_port', 587),
+                settings.get('email_address', ''),
+                settings.get('email_password') or get_email_password(settings.get('email_address', '')))
+    
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+    
+    def _open(self, settings):
+        import smtplib
+        server, port, user, password = self._key(settings)
+        smtp = smtplib.SMTP(server, port, timeout=self.timeout)
+        try:
+            if settings.get('smtp_starttls', True):
+                smtp.starttls()
+            if password:
+                smtp.login(user, password)
+        except Exception:
+            self._quit(smtp)
+            raise
+        return smtp
+    
+    def _quit(self, smtp):
+        try:
+            smtp.quit()
+        except Exception:
+            smtp.close()
+    
+    def _keep(self, key, smtp):
+        """Pool a session for reuse, and make sure the idle timer is running."""
+        with self._lock:
+            old = self._sessions.pop(key, None)
+            self._sessions[key] = (smtp, time.monotonic())
+            if self._reaper is None:
+                self._reaper = threading.Timer(self.idle_timeout, self._reap)
+                self._reaper.daemon = True
+                self._reaper.start()
+        if old:
+            self._quit(old[0])
+    
+    def _reap(self):
+        """Close sessions idle for longer than idle_timeout; runs on the idle timer."""
+        now = time.monotonic()
+        with self._lock:
+            idle = [key for key, (_, last_used) in self._sessions.items() if now - last_used > self.idle_timeout]
+            expired = [self._sessions.pop(key)[0] for key in idle]
+            self._reaper = None
+            if self._sessions:
+                # Check again when the oldest remaining session would expire
+                oldest = min(last_used for _, last_used in self._sessions.values())
+                self._reaper = threading.Timer(max(0.0, oldest + self.idle_timeout - now), self._reap)
+                self._reaper.daemon = True
+                self._reaper.start()
+        for smtp in expired:
+            self._quit(smtp)
+    
+    def verify(self, settings):
+        """Open and authenticate a fresh session (raising on failure) and keep it for sending."""
+        key = self._key(settings)
+        with self._key_lock(key):
+            self._keep(key, self._open(settings))
+    
+    def send(self, msg, settings):
+        import smtplib
+        key = self._key(settings)
+        with self._key_lock(key):
+            with self._lock:
+                session = self._sessions.pop(key, None)
+            smtp = session[0] if session else self._open(settings)
+            sent = False
+            try:
+                try:
+                    smtp.send_message(msg)
+                except (smtplib.SMTPServerDisconnected, ConnectionError):
+                    if session is None:
+                        raise
+                    # The pooled session went stale; retry once on a new one
+                    smtp.close()
+                    smtp = self._open(settings)
+                    smtp.send_message(msg)
+                sent = True
+            finally:
+                if not sent:
+                    self._quit(smtp)
+            self._keep(key, smtp)
+    
+    def close(self):
+        with self._lock:
+            sessions, self._sessions = list(self._sessions.values()), {}
+            if self._reaper is not None:
+                self._reaper.cancel()
+                self._reaper = None
+        for smtp, _ in sessions:
+            self._quit(smtp)
+
+def detect_desktop_backend():
+    """Pick the desktop notifier available on this system, or None."""
+    if sys.platform == "darwin" and shutil.which("osascript"):
+        return "osascript"
+    if shutil.which("notify-send"):
+        return "notify-send"
+    try:
+        from plyer import notification
+        return "plyer"
+    except ImportError:
+        return None
+
+class DesktopNotifier:
+    """Shows desktop notifications off the caller's thread, without going through a shell.
+    
+    The backend is detected once. Notifications arriving within
+    coalesce_seconds of each other are merged into one summary, and the
+    notifier processes run on a small fixed pool of worker threads. Each
+    notification's Future resolves to whether its summary was shown.
+    """
+    
+    def __init__(self, backend=None, coalesce_seconds=DESKTOP_COALESCE_SECONDS, max_workers=DESKTOP_WORKERS):
+        self.backend = backend or detect_desktop_backend()
+        self.coalesce_seconds = coalesce_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="caresync-desktop")
+        self._pending = []
+        self._timer = None
+        self._lock = threading.Lock()
+    
+    def notify(self, title, message):
+        """Queue a notification. Returns a Future of whether it was shown, already False if there is no way to show one here."""
+        shown = Future()
+        if self.backend is None:
+            shown.set_result(False)
+            return shown
+        with self._lock:
+            self._pending.append((title, message, shown))
+            if self._timer is None:
+                self._timer = threading.Timer(self.coalesce_seconds, self._flush)
+                self._timer.daemon = True
+                self._timer.start()
+        return shown
+    
+    def _flush(self):
+        with self._lock:
+            batch, self._pending, self._timer = self._pending, [], None
+        if len(batch) == 1:
+            title, message, _ = batch[0]
+        else:
+            title = f"CareSync: {len(batch)} notifications"
+            message = "\n".join(message for _, message, _ in batch)
+        
+        def resolve(done):
+            for *_, shown in batch:
+                shown.set_result(not done.cancelled() and done.result())
+        try:
+            self._executor.submit(self._show, title, message).add_done_callback(resolve)
+        except RuntimeError:
+            # The interpreter is shutting down
+            for *_, shown in batch:
+                shown.set_result(False)
+    
+    def _show(self, title, message):
+        try:
+            if self.backend == "osascript":
+                # Passed as arguments, so quotes in the text can't break the script
+                script = ["-e", "on run argv", "-e", "display notification (item 2 of argv) with title (item 1 of argv)", "-e", "end run"]
+                subprocess.run(["osascript", *script, title, message], check=True, capture_output=True, timeout=DESKTOP_TIMEOUT)
+            elif self.backend == "notify-send":
+                subprocess.run(["notify-send", "--app-name=CareSync", "--", title, message], check=True, capture_output=True, timeout=DESKTOP_TIMEOUT)
+            elif self.backend == "plyer":
+                from plyer import notification
+                notification.notify(title=title, message=message, app_icon=None, timeout=10)
+            return True
+        except Exception:
+            logger.exception("Desktop notification via %s failed", self.backend)
+            return False
 
 class NotificationManager:
     def __init__(self):
+        self.smtp = SMTPTransport()
+        self.desktop = DesktopNotifier()
+        # Reminders are queued in the database and delivered off the script thread
+        self.outbox = OutboxWorker({
+            'email': self._send_queued_email,
+            'desktop': self._send_queued_desktop,
+            'mobile': self._send_queued_mobile,
+        })
         self.email_enabled = False
         self.desktop_enabled = False
         self.mobile_enabled = False
-        self.load_settings()
-    
-    def load_settings(self):
-        """Load notification settings from session state"""
-        if 'notification_settings' not in st.session_state:
-            st.session_state.notification_settings = {
-                'email_enabled': False,
-                'desktop_enabled': False,
-                'mobile_enabled': False,
-                'email_address': '',
-                'email_password': '',
-                'smtp_server': 'smtp.gmail.com',
-                'smtp_port': 587
-            }
     
-    def setup_email_notifications(self, email, password, smtp_server="smtp.gmail.com", smtp_port=587):
-        """Setup email notifications"""
+    def load_settings(self, user_id=database.DEFAULT_USER_ID):
+        """Load a user's saved notification settings into session state"""
+        st.session_state.notification_settings = database.get_notification_settings(user_id)
+        st.session_state.notification_settings_user = user_id
+    
+    def save_settings(self, user_id=database.DEFAULT_USER_ID):
+        """Save the session's notification settings for a user if they changed; True if they did"""
+        settings = st.session_state.notification_settings
+        if settings == database.get_notification_settings(user_id):
+            return False
+        database.save_notification_settings(settings, user_id)
+        return True
+    
+    def _settings(self, settings=None):
+        # Background threads have no session, so they pass their settings explicitly
+        return settings if settings is not None else st.session_state.notification_settings
+    
+    def setup_email_notifications(self, email, password, smtp_server="smtp.gmail.com", smtp_port=587, smtp_starttls=True):
+        """Setup email notifications; an empty password uses the one already kept for email"""
         try:
-            # Test email connection
-            server = smtplib.SMTP(smtp_server, smtp_port)
-            server.starttls()
-            server.login(email, password)
-            server.quit()
-            
-            st.session_state.notification_settings.update({
+            settings = {
                 'email_enabled': True,
                 'email_address': email,
-                'email_password': password,
+                'email_password': password or get_email_password(email),
                 'smtp_server': smtp_server,
-                'smtp_port': smtp_port
-            })
+                'smtp_port': smtp_port,
+                'smtp_starttls': smtp_starttls
+            }
+            # Test email connection; the session is kept for the first reminders
+            self.smtp.verify(settings)
+            
+            # The password is kept apart from the settings, which are saved
+            set_email_password(email, settings.pop('email_password'))
+            st.session_state.notification_settings.update(settings)
             return True
-        except Exception as e:
-            st.error(f"Email setup failed: {str(e)}")
+        except Exception:
+            logger.warning("Email setup for %s failed", email, exc_info=True)
             return False
     
-    def send_email_notification(self, subject, message, recipient=None):
+    def send_email_notification(self, subject, message, recipient=None, settings=None):
         """Send email notification"""
-        if not st.session_state.notification_settings['email_enabled']:
+        settings = self._settings(settings)
+        if not settings['email_enabled']:
             return False
         
         try:
-            settings = st.session_state.notification_settings
-            msg = MIMEMultipart()
-            msg['From'] = settings['email_address']
-            msg['To'] = recipient or settings['email_address']
-            msg['Subject'] = subject
-            
-            body = f"""
-            <html>
-            <body>
-                <h2>🩺 CareSync Reminder</h2>
-                <p>{message}</p>
-                <hr>
-                <p><small>This is an automated reminder from CareSync. Please do not reply to this email.</small></p>
-            </body>
-            </html>
-            """
-            
-            msg.attach(MIMEText(body, 'html'))
-            
-            server = smtplib.SMTP(settings['smtp_server'], settings['smtp_port'])
-            server.starttls()
-            server.login(settings['email_address'], settings['email_password'])
-            server.send_message(msg)
-            server.quit()
-            
+            self._email(subject, message, settings, recipient)
             return True
-        except Exception as e:
-            st.error(f"Failed to send email: {str(e)}")
+        except Exception:
+            logger.exception("Failed to send email %r", subject)
             return False
     
-    def send_desktop_notification(self, title, message):
-        """Send desktop notification"""
+    def _email(self, subject, message, settings, recipient=None, message_id=None):
+        from email.mime.multipart import MIMEMultipart
+        from email.mime.text import MIMEText
+        msg = MIMEMultipart()
+        msg['From'] = settings['email_address']
+        msg['To'] = recipient or settings['email_address']
+        msg['Subject'] = subject
+        if message_id:
+            msg['Message-ID'] = message_id
+            
+        body = f"""
+        <html>
+        <body>
+            <h2>🩺 CareSync Reminder</h2>
+            <p>{message}</p>
+            <hr>
+            <p><small>This is an automated reminder from CareSync. Please do not reply to this email.</small></p>
+        </body>
+        </html>
+        """
+        
+        msg.attach(MIMEText(body, 'html'))
+        self.smtp.send(msg, settings)
+    
+    @metrics.timed('caresync_notification_seconds', channel='email')
+    def _send_queued_email(self, item, settings):
+        if not settings.get('email_enabled'):
+            raise RuntimeError("email notifications are not configured")
+        # A stable Message-ID lets mail clients drop a duplicate from a retried send
+        message_id = f"<{hashlib.sha1(item.idempotency_key.encode()).hexdigest()}@caresync>"
+        self._email(item.title, item.message, settings, message_id=message_id)
+        return True
+    
+    @metrics.timed('caresync_notification_seconds', channel='desktop')
+    def _send_queued_desktop(self, item, settings):
+        # The outbox worker can wait for the notifier; a page script must not
         try:
-            # For macOS
-            os.system(f"""
-            osascript -e 'display notification "{message}" with title "{title}"'
-            """)
-            return True
-        except:
-            try:
-                # For Linux
-                os.system(f'notify-send "{title}" "{message}"')
-                return True
-            except:
-                try:
-                    # For Windows
-                    from plyer import notification
-                    notification.notify(
-                        title=title,
-                        message=message,
-                        app_icon=None,
-                        timeout=10,
-                    )
-                    return True
-                except:
-                    return False
+            return self.send_desktop_notification(item.title, item.message).result(timeout=self.desktop.coalesce_seconds + DESKTOP_TIMEOUT)
+        except FutureTimeout:
+            logger.warning("Desktop notification %r was not shown in time", item.title)
+            return False
+    
+    @metrics.timed('caresync_notification_seconds', channel='mobile')
+    def _send_queued_mobile(self, item, settings):
+        return self.send_mobile_notification(item.title, item.message)
+    
+    def send_desktop_notification(self, title, message):
+        """Send desktop notification without waiting for it; returns a Future of whether it was shown"""
+        return self.desktop.notify(title, message)
     
     def send_mobile_notification(self, title, message, user_id=None):
         """Send mobile notification via web push or SMS"""
@@ -117,56 +369,91 @@ class NotificationManager:
         # - Firebase Cloud Messaging (FCM)
         # - Twilio SMS
         # - Pushbullet
-        # For now, we'll simulate with a web-based approach
-        
-        try:
-            # Simulate mobile notification (in real app, this would use FCM)
-            st.info(f"📱 Mobile notification would be sent: {title} - {message}")
-            return True
-        except:
-            return False
+        # None is set up yet, so nothing can be delivered
+        logger.info("No mobile notification service is configured; not sending %r", title)
+        return False
     
-    def send_medication_reminder(self, medication_name, dose, time_str, reminder_type="all"):
+    def send_medication_reminder(self, medication_name, dose, time_str, reminder_type="all", settings=None, user_id=database.DEFAULT_USER_ID):
         """Send medication reminder via selected channels"""
-        title = "💊 Medication Reminder"
-        message = f"Time to take {medication_name} ({dose}) at {time_str}"
+        return self.send_medication_digest([(medication_name, dose, time_str)], reminder_type, settings, user_id=user_id)
+    
+    def send_medication_digest(self, reminders, reminder_type="all", settings=None, key=None, user_id=database.DEFAULT_USER_ID):
+        """Queue one reminder covering several (name, dose, time_str) medications of a user on the selected channels
+        
+        key makes the send idempotent: a digest queued again under the same key is ignored.
+        """
+        settings = self._settings(settings)
+        lines = [f"{name} ({dose}) at {time_str}" for name, dose, time_str in reminders]
+        if len(lines) == 1:
+            title = "💊 Medication Reminder"
+            message = f"Time to take {lines[0]}"
+            email_message = html.escape(message)
+        else:
+            title = f"💊 {len(lines)} Medication Reminders"
+            message = "Time to take " + "; ".join(lines)
+            email_message = "Time to take:<ul>" + "".join(f"<li>{html.escape(line)}</li>" for line in lines) + "</ul>"
+        
+        key = key or uuid.uuid4().hex
+        items = []
         
-        success_count = 0
+        if reminder_type in ["all", "email"] and settings['email_enabled']:
+            items.append((f"{key}:email", 'email', title, email_message))
         
-        if reminder_type in ["all", "email"] and st.session_state.notification_settings['email_enabled']:
-            if self.send_email_notification(title, message):
-                success_count += 1
+        if reminder_type in ["all", "desktop"] and settings['desktop_enabled']:
+            items.append((f"{key}:desktop", 'desktop', title, message))
         
-        if reminder_type in ["all", "desktop"] and st.session_state.notification_settings['desktop_enabled']:
-            if self.send_desktop_notification(title, message):
-                success_count += 1
+        # Mobile reminders aren't queued until send_mobile_notification has a
+        # service to deliver them; queued now they would only fail
         
-        if reminder_type in ["all", "mobile"] and st.session_state.notification_settings['mobile_enabled']:
-            if self.send_mobile_notification(title, message):
-                success_count += 1
+        if not items:
+            return False
+        self.outbox.start()
+        database.enqueue_notifications(items, user_id)
+        database.after_commit(self.outbox.wake)
+        return True
+    
+    def send_reminders_once(self, reminders, settings=None):
+        """Send one digest for the DoseEvent reminders not yet sent
         
-        return success_count > 0
+        The reminders must all be for medications of the same user. Returns
+        the reminders this call queued for delivery.
+        """
+        settings = self._settings(settings)
+        # Only the channels send_medication_digest queues for
+        if not any(settings.get(channel) for channel in ('email_enabled', 'desktop_enabled')):
+            return []
+        # Claiming and queueing commit together: a claimed reminder is always
+        # in the outbox, and the outbox retries it until it is delivered
+        with database.transaction(invalidate=False):
+            claimed = [event for event in reminders if database.claim_reminder(*event.key)]
+            if claimed:
+                key = "reminder:" + ",".join("{}/{}/{}".format(*event.key) for event in claimed)
+                meds = [event.medication for event in claimed]
+                user_id = meds[0].user_id or database.DEFAULT_USER_ID
+                self.send_medication_digest([(m.name, m.dose, m.time_label) for m in meds], settings=settings, key=key, user_id=user_id)
+        return claimed
     
-    def check_and_send_reminders(self, medications):
-        """Check medications and send reminders for due/overdue ones"""
+    def send_reminder_once(self, event, settings=None):
+        """Send a medication reminder for a DoseEvent unless the ledger shows it already went out"""
+        return bool(self.send_reminders_once([event], settings))
+    
+    def check_and_send_reminders(self, medications, settings=None):
+        """Check Medication records and send reminders for due/overdue ones"""
         current_time = datetime.now()
-        sent_reminders = []
+        now = minutes_of(current_time)
+        today = current_time.date().isoformat()
         
-        for med in medications:
-            med_id, name, dose, freq, time_str = med
-            try:
-                med_time = datetime.strptime(time_str, "%H:%M:%S").time()
-                med_datetime = datetime.combine(current_time.date(), med_time)
-                time_diff = (med_datetime - current_time).total_seconds() / 60  # minutes
-                
-                # Send reminder if medication is due within 15 minutes or overdue
-                if -30 <= time_diff <= 15:
-                    if self.send_medication_reminder(name, dose, time_str):
-                        sent_reminders.append((name, time_str))
-            except:
-                pass
+        # Send reminder if medication is due within 15 minutes or overdue,
+        # and no dose of it has been logged today
+        users = {med.user_id or database.DEFAULT_USER_ID for med in medications}
+        logged = {(user_id, med_id) for user_id in users for med_id in database.get_dose_logs(today, user_id)}
+        due = [DoseEvent(med, today) for med in medications
+               if med.minutes is not None and -30 <= med.minutes_until(now) <= 15
+               and (med.user_id or database.DEFAULT_USER_ID, med.id) not in logged]
         
-        return sent_reminders
+        # All due medications go out together as one digest
+        sent = self.send_reminders_once(due, settings) if due else []
+        return [(event.medication.name, event.medication.time_label) for event in sent]
 
 # Global notification manager instance
 notification_manager = NotificationManager() 
\ No newline at end of file
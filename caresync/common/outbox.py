@@ -0,0 +1,119 @@
+# Asynchronous delivery of queued CareSync notifications
+
+import asyncio
+import logging
+import random
+import threading
+import time
+
+from common import database
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 20  # notifications leased per round
+POLL_INTERVAL = 30  # seconds between outbox checks when nothing wakes the worker
+MAX_ATTEMPTS = 6
+BACKOFF_BASE = 15  # seconds before the first retry, doubling after each failure
+BACKOFF_MAX = 3600
+# Desktop waits out the notifier's coalescing window and its process timeout
+CHANNEL_TIMEOUTS = {'email': 30, 'desktop': 20, 'mobile': 10}  # seconds per attempt
+DEFAULT_TIMEOUT = 30
+# Leases outlast the slowest channel so a live attempt is never handed out twice
+LEASE_SECONDS = max(CHANNEL_TIMEOUTS.values()) + 30
+
+
+def backoff_delay(attempts):
+    """Exponential backoff with jitter for the retry after the given attempt."""
+    delay = min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX)
+    return delay * random.uniform(0.8, 1.2)
+
+
+class OutboxWorker:
+    """Delivers notifications from the outbox table on a background asyncio loop.
+
+    Each round leases a batch of due items and sends them concurrently, each
+    with its channel's timeout. Failures are retried with exponential backoff
+    until MAX_ATTEMPTS, then marked failed. Senders are plain blocking
+    callables, run in threads: sender(item, settings) -> bool, called with
+    the item's user's settings as saved in the database at that attempt.
+    """
+
+    def __init__(self, senders):
+        self.senders = senders
+        self._loop = None
+        self._event = None
+        self._thread = None
+        self._stopped = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the worker thread if it isn't running."""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopped = False
+                self._thread = threading.Thread(target=self._run, name="caresync-outbox", daemon=True)
+                self._thread.start()
+
+    def wake(self):
+        """Check the outbox now rather than at the next poll."""
+        loop, event = self._loop, self._event
+        if loop is not None and event is not None:
+            loop.call_soon_threadsafe(event.set)
+
+    def stop(self):
+        self._stopped = True
+        self.wake()
+
+    def _run(self):
+        asyncio.run(self._main())
+
+    async def _main(self):
+        self._event = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        while not self._stopped:
+            # Cleared before looking, so a wake during the round isn't lost
+            self._event.clear()
+            try:
+                items = await asyncio.to_thread(database.claim_outbox, BATCH_SIZE, LEASE_SECONDS)
+                if items:
+                    await asyncio.gather(*(self._deliver(item) for item in items))
+                    continue
+                next_due = await asyncio.to_thread(database.next_outbox_due)
+            except Exception:
+                if not threading.main_thread().is_alive():
+                    return  # interpreter shutdown; pending items are picked up next start
+                logger.exception("Outbox worker round failed")
+                next_due = None
+            timeout = POLL_INTERVAL if next_due is None else min(POLL_INTERVAL, max(0, next_due - time.time()))
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _deliver(self, item):
+        sender = self.senders.get(item.channel)
+        error = None
+        if sender is None:
+            error = f"no sender for channel {item.channel!r}"
+        else:
+            timeout = CHANNEL_TIMEOUTS.get(item.channel, DEFAULT_TIMEOUT)
+            try:
+                settings = await asyncio.to_thread(database.get_notification_settings, item.user_id)
+                if await asyncio.wait_for(asyncio.to_thread(sender, item, settings), timeout):
+                    await asyncio.to_thread(database.complete_outbox, item.id)
+                    return
+                error = "channel reported failure"
+            except asyncio.TimeoutError:
+                error = f"timed out after {timeout}s"
+            except Exception as e:
+                error = str(e) or type(e).__name__
+
+        try:
+            if sender is None or item.attempts >= MAX_ATTEMPTS:
+                logger.warning("Giving up on notification %s: %s", item.idempotency_key, error)
+                await asyncio.to_thread(database.fail_outbox, item.id, error)
+            else:
+                await asyncio.to_thread(database.retry_outbox, item.id, backoff_delay(item.attempts), error)
+        except Exception:
+            # The lease expires on its own and the item is retried then
+            logger.exception("Failed to record outcome for notification %s", item.idempotency_key)
@@ -0,0 +1,165 @@
+# Background medication reminder scheduler for CareSync
+
+import heapq
+import logging
+import threading
+from datetime import date, datetime, timedelta
+
+from common import database
+from common.models import DoseEvent
+from common.notifications import notification_manager
+
+logger = logging.getLogger(__name__)
+
+REMINDER_LEAD_MINUTES = 15   # remind this long before a dose is due
+REMINDER_GRACE_MINUTES = 30  # and keep trying until this long after
+REMINDER_RETRY_MINUTES = 5   # wait between attempts when delivery fails
+DIGEST_WINDOW_MINUTES = 5    # reminders this close together go out as one digest
+CHANNELS = ('email_enabled', 'desktop_enabled')  # the channels reminders are queued for
+
+
+def due_at(event):
+    """When a DoseEvent's dose is due, as a datetime."""
+    return datetime.combine(date.fromisoformat(event.day), datetime.min.time()) + timedelta(minutes=event.medication.minutes)
+
+
+class ReminderScheduler:
+    """Sends each medication reminder once, from a thread that sleeps until the next one is due.
+
+    Upcoming reminders sit in a min-heap of (send time, DoseEvent key,
+    DoseEvent) entries, the key keeping DoseEvents out of comparisons. It is
+    rebuilt from the database when medications, logs or settings change and
+    at midnight; sends are claimed in the reminder ledger, so reruns, other
+    sessions and other processes never repeat one. Reminders are scheduled
+    for every user whose saved notification settings enable a channel, and
+    never for a dose that has already been logged.
+    """
+
+    def __init__(self, notifier):
+        self.notifier = notifier
+        self._heap = []
+        self._reload = True
+        self._stopped = False
+        self._thread = None
+        self._cond = threading.Condition()
+
+    def start(self):
+        """Start the scheduler thread if it isn't running."""
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopped = False
+                self._thread = threading.Thread(target=self._run, name="caresync-reminders", daemon=True)
+                self._thread.start()
+
+    def refresh(self):
+        """Re-read medications, logs and settings, e.g. after a dose was logged."""
+        with self._cond:
+            self._reload = True
+            self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def next_reminder(self, user_id=database.DEFAULT_USER_ID):
+        """(send time, medication name) of a user's next pending reminder, or None."""
+        with self._cond:
+            for send_at, _, event in sorted(self._heap):
+                if event is not None and event.medication.user_id == user_id:
+                    return send_at, event.medication.name
+        return None
+
+    def _load(self, now):
+        heap = []
+        users = [user_id for user_id, settings in database.get_all_notification_settings().items()
+                 if any(settings.get(channel) for channel in CHANNELS)]
+        meds = [med for user_id in users for med in database.get_today_medications(user_id)[0]]
+        for day in (now.date(), now.date() + timedelta(days=1)):
+            sent = database.get_sent_reminders(day.isoformat())
+            logged = {med_id for user_id in users for med_id in database.get_dose_logs(day.isoformat(), user_id)}
+            for med in meds:
+                if med.minutes is None or (med.id, 0) in sent or med.id in logged:
+                    continue
+                event = DoseEvent(med, day.isoformat())
+                if self._expires(event) < now:
+                    continue
+                send_at = due_at(event) - timedelta(minutes=REMINDER_LEAD_MINUTES)
+                heap.append((send_at, event.key, event))
+        # Wake at midnight to schedule the new day
+        midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+        heap.append((midnight, (0, "", 0), None))
+        heapq.heapify(heap)
+        self._heap = heap
+
+    def _next_due(self):
+        """Block until reminders are due and return them, or None once stopped."""
+        with self._cond:
+            while not self._stopped:
+                now = datetime.now()
+                if self._reload:
+                    self._reload = False
+                    self._load(now)
+                if self._heap[0][0] <= now:
+                    # Pull in whatever else falls in the digest window too
+                    window_end = now + timedelta(minutes=DIGEST_WINDOW_MINUTES)
+                    due = []
+                    while self._heap and self._heap[0][0] <= window_end:
+                        due.append(heapq.heappop(self._heap))
+                    if any(entry[2] is None for entry in due):
+                        self._reload = True
+                    return due, now
+                self._cond.wait((self._heap[0][0] - now).total_seconds())
+        return None
+
+    def _run(self):
+        while True:
+            try:
+                batch = self._next_due()
+                if batch is None:
+                    return
+                self._send_due(*batch)
+            except Exception:
+                # Reloading brings back whatever is still unsent
+                logger.exception("Reminder scheduler failed to load or check reminders")
+                with self._cond:
+                    self._cond.wait(60)
+                    self._reload = True
+
+    def _send_due(self, due, now):
+        by_user = {}
+        for _, _, event in due:
+            if event is not None and now <= self._expires(event):
+                by_user.setdefault(event.medication.user_id, []).append(event)
+        # Read fresh, as another session or process may have changed them since the load
+        settings = database.get_all_notification_settings()
+        for user_id, events in by_user.items():
+            logs = {day: database.get_dose_logs(day, user_id) for day in {event.day for event in events}}
+            events = [event for event in events if event.medication.id not in logs[event.day]]
+            # With no channel enabled there is nothing to send; saving the
+            # settings reloads the schedule and picks these up again
+            if events and any(settings.get(user_id, {}).get(channel) for channel in CHANNELS):
+                self._deliver(events, now, settings[user_id])
+
+    def _expires(self, event):
+        return due_at(event) + timedelta(minutes=REMINDER_GRACE_MINUTES)
+
+    def _deliver(self, events, now, settings):
+        sent = []
+        try:
+            sent = self.notifier.send_reminders_once(events, settings)
+        except Exception:
+            logger.exception("Failed to send %d reminder(s)", len(events))
+        # Retry whatever neither we nor another session managed to send
+        sent = {event.key for event in sent}
+        retry_at = now + timedelta(minutes=REMINDER_RETRY_MINUTES)
+        for event in events:
+            med_id, day, occurrence = event.key
+            if event.key in sent or (med_id, occurrence) in database.get_sent_reminders(day):
+                continue
+            if retry_at <= self._expires(event):
+                with self._cond:
+                    heapq.heappush(self._heap, (retry_at, event.key, event))
+
+
+reminder_scheduler = ReminderScheduler(notification_manager)
@@ -0,0 +1,153 @@
+# Offline, lexicon-based sentiment and emotion scoring for journal entries
+
+import functools
+import re
+
+EMOTIONS = ('joy', 'calm', 'sadness', 'anxiety', 'anger')
+
+# word: (valence from -4 to 4, emotion or None)
+LEXICON = {
+    # joy
+    'happy': (3, 'joy'), 'happier': (3, 'joy'), 'happiest': (3, 'joy'), 'happiness': (3, 'joy'),
+    'joy': (3, 'joy'), 'joyful': (3, 'joy'), 'glad': (2, 'joy'), 'great': (3, 'joy'), 'good': (2, 'joy'),
+    'wonderful': (3, 'joy'), 'amazing': (3, 'joy'), 'awesome': (3, 'joy'), 'fantastic': (3, 'joy'),
+    'excited': (3, 'joy'), 'exciting': (3, 'joy'), 'love': (3, 'joy'), 'loved': (3, 'joy'), 'lovely': (3, 'joy'),
+    'fun': (2, 'joy'), 'enjoy': (2, 'joy'), 'enjoyed': (2, 'joy'), 'proud': (2, 'joy'), 'grateful': (3, 'joy'),
+    'thankful': (2, 'joy'), 'hopeful': (2, 'joy'), 'hope': (1, 'joy'), 'optimistic': (2, 'joy'),
+    'better': (2, 'joy'), 'best': (3, 'joy'), 'laugh': (2, 'joy'), 'laughed': (2, 'joy'), 'smile': (2, 'joy'),
+    'smiled': (2, 'joy'), 'energized': (2, 'joy'), 'motivated': (2, 'joy'), 'productive': (2, 'joy'),
+    'accomplished': (2, 'joy'), 'delighted': (3, 'joy'), 'cheerful': (2, 'joy'), 'nice': (2, 'joy'),
+    # calm
+    'calm': (2, 'calm'), 'relaxed': (2, 'calm'), 'relaxing': (2, 'calm'), 'peaceful': (2, 'calm'),
+    'rested': (2, 'calm'), 'content': (2, 'calm'), 'okay': (1, 'calm'), 'ok': (1, 'calm'), 'fine': (1, 'calm'),
+    'safe': (1, 'calm'), 'comfortable': (2, 'calm'), 'relieved': (2, 'calm'), 'relief': (2, 'calm'),
+    'balanced': (2, 'calm'), 'steady': (1, 'calm'), 'stable': (1, 'calm'), 'serene': (2, 'calm'),
+    'refreshed': (2, 'calm'), 'settled': (1, 'calm'),
+    # sadness
+    'sad': (-2, 'sadness'), 'sadness': (-2, 'sadness'), 'unhappy': (-2, 'sadness'), 'down': (-1, 'sadness'),
+    'depressed': (-3, 'sadness'), 'depressing': (-3, 'sadness'), 'lonely': (-2, 'sadness'), 'alone': (-1, 'sadness'),
+    'cry': (-2, 'sadness'), 'cried': (-2, 'sadness'), 'crying': (-2, 'sadness'), 'tired': (-1, 'sadness'),
+    'exhausted': (-2, 'sadness'), 'drained': (-2, 'sadness'), 'hopeless': (-3, 'sadness'), 'empty': (-2, 'sadness'),
+    'miserable': (-3, 'sadness'), 'grief': (-3, 'sadness'), 'lost': (-2, 'sadness'), 'hurt': (-2, 'sadness'),
+    'low': (-1, 'sadness'), 'bad': (-2, 'sadness'), 'worse': (-2, 'sadness'), 'worst': (-3, 'sadness'),
+    'awful': (-3, 'sadness'), 'terrible': (-3, 'sadness'), 'disappointed': (-2, 'sadness'), 'numb': (-2, 'sadness'),
+    'unmotivated': (-2, 'sadness'), 'worthless': (-3, 'sadness'), 'sick': (-2, 'sadness'), 'pain': (-2, 'sadness'),
+    # anxiety
+    'anxious': (-2, 'anxiety'), 'anxiety': (-2, 'anxiety'), 'worried': (-2, 'anxiety'), 'worry': (-2, 'anxiety'),
+    'worrying': (-2, 'anxiety'), 'nervous': (-2, 'anxiety'), 'scared': (-2, 'anxiety'), 'afraid': (-2, 'anxiety'),
+    'fear': (-2, 'anxiety'), 'panic': (-3, 'anxiety'), 'stressed': (-2, 'anxiety'), 'stress': (-2, 'anxiety'),
+    'stressful': (-2, 'anxiety'), 'overwhelmed': (-2, 'anxiety'), 'restless': (-1, 'anxiety'), 'tense': (-1, 'anxiety'),
+    'uneasy': (-1, 'anxiety'), 'insomnia': (-2, 'anxiety'), 'dread': (-3, 'anxiety'), 'pressure': (-1, 'anxiety'),
+    # anger
+    'angry': (-2, 'anger'), 'anger': (-2, 'anger'), 'mad': (-2, 'anger'), 'annoyed': (-1, 'anger'),
+    'irritated': (-1, 'anger'), 'frustrated': (-2, 'anger'), 'frustrating': (-2, 'anger'), 'furious': (-3, 'anger'),
+    'hate': (-3, 'anger'), 'hated': (-3, 'anger'), 'resent': (-2, 'anger'), 'upset': (-2, 'anger'),
+    'unfair': (-2, 'anger'), 'irritable': (-1, 'anger'),
+}
+NEGATIONS = {'not', 'no', 'never', 'nothing', 'hardly', 'without', "don't", "didn't", "isn't", "wasn't",
+             "can't", "couldn't", "won't", "doesn't", "aren't", 'cannot', 'dont', 'didnt', 'cant', 'isnt', 'wasnt'}
+INTENSIFIERS = {'very': 1.5, 'really': 1.4, 'so': 1.3, 'extremely': 1.8, 'super': 1.5, 'incredibly': 1.7,
+                'totally': 1.4, 'quite': 1.2, 'slightly': 0.6, 'somewhat': 0.7, 'little': 0.7, 'bit': 0.7}
+NEGATION_SCOPE = 3  # words after a negation whose valence is flipped, within its clause
+NORMALIZATION = 15  # larger values compress scores less towards 0
+
+# Words, and the punctuation that ends a clause (and with it a negation or intensifier)
+TOKEN_RE = re.compile(r"[a-z]+(?:'[a-z]+)?|[.,;:!?()\u2013\u2014]")
+
+VOCAB = {word: i for i, word in enumerate(LEXICON)}
+
+
+@functools.lru_cache(maxsize=None)
+def _tables():
+    """(valence per lexicon word, emotion weights per word), built on first use.
+
+    NumPy is imported lazily so importing this module stays cheap for pages
+    that never score anything.
+    """
+    import numpy as np
+    valence = np.array([valence for valence, _ in LEXICON.values()], dtype=float)
+    # One row per lexicon word, with its strength in the column of its emotion
+    emotion_weights = np.zeros((len(LEXICON), len(EMOTIONS)))
+    for i, (word_valence, emotion) in enumerate(LEXICON.values()):
+        if emotion:
+            emotion_weights[i, EMOTIONS.index(emotion)] = abs(word_valence)
+    return valence, emotion_weights
+
+
+def _hits(text):
+    """Lexicon indices in text with their weights from negation and intensifiers."""
+    indices, weights = [], []
+    negated_until = -1
+    boost = 1.0
+    for pos, token in enumerate(TOKEN_RE.findall(text.lower())):
+        if not token[0].isalpha():
+            negated_until = -1
+            boost = 1.0
+            continue
+        if token in NEGATIONS:
+            negated_until = pos + NEGATION_SCOPE
+            continue
+        if token in INTENSIFIERS:
+            boost *= INTENSIFIERS[token]
+            continue
+        index = VOCAB.get(token)
+        if index is not None:
+            indices.append(index)
+            weights.append(-boost if pos <= negated_until else boost)
+        boost = 1.0
+    return indices, weights
+
+
+def score_texts(texts):
+    """Score many texts at once.
+
+    Returns (sentiment, emotions): sentiment is an array in [-1, 1] per text,
+    emotions an array of per-text shares of EMOTIONS (rows of zeros for texts
+    without emotional words). Negated words count for the opposite valence
+    and no emotion.
+    """
+    import numpy as np
+    valence, emotion_weights = _tables()
+    texts = list(texts)
+    doc_ids, indices, weights = [], [], []
+    for doc, text in enumerate(texts):
+        hit_indices, hit_weights = _hits(text or "")
+        doc_ids.extend([doc] * len(hit_indices))
+        indices.extend(hit_indices)
+        weights.extend(hit_weights)
+    doc_ids = np.array(doc_ids, dtype=np.intp)
+    indices = np.array(indices, dtype=np.intp)
+    weights = np.array(weights, dtype=float)
+
+    raw = np.bincount(doc_ids, weights=valence[indices] * weights, minlength=len(texts))
+    sentiment = raw / np.sqrt(raw * raw + NORMALIZATION)
+
+    emotions = np.zeros((len(texts), len(EMOTIONS)))
+    np.add.at(emotions, doc_ids, emotion_weights[indices] * np.clip(weights, 0, None)[:, None])
+    totals = emotions.sum(axis=1, keepdims=True)
+    np.divide(emotions, totals, out=emotions, where=totals > 0)
+    return sentiment, emotions
+
+
+def analyze(texts):
+    """(sentiment rounded to 3 places, dominant emotion or None) per text, as stored with journals."""
+    sentiment, emotions = score_texts(texts)
+    dominant = emotions.argmax(axis=1)
+    has_emotion = emotions.max(axis=1) > 0
+    return [(round(float(score), 3), EMOTIONS[emotion] if present else None)
+            for score, emotion, present in zip(sentiment, dominant, has_emotion)]
+
+
+def label(score):
+    """Word for a sentiment score."""
+    if score is None:
+        return "unknown"
+    if score >= 0.5:
+        return "very positive"
+    if score >= 0.15:
+        return "positive"
+    if score > -0.15:
+        return "neutral"
+    if score > -0.5:
+        return "negative"
+    return "very negative"
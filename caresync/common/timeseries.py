@@ -0,0 +1,37 @@
+# Time series helpers for CareSync charts
+
+
+def lttb(points, threshold):
+    """Downsample (x, y, ...) points to at most threshold using Largest-Triangle-Three-Buckets.
+
+    Points must be sorted by x. The first and last points are always kept, and
+    in between the point forming the largest triangle with its neighbours is
+    picked from each bucket, which preserves peaks and dips far better than
+    plain striding. Extra tuple fields ride along with the chosen point.
+    """
+    n = len(points)
+    if threshold >= n or threshold < 3:
+        return list(points)
+
+    sampled = [points[0]]
+    bucket_size = (n - 2) / (threshold - 2)
+    a = 0  # index of the last selected point
+    for i in range(threshold - 2):
+        # Average of the next bucket is the third triangle vertex
+        next_start = int((i + 1) * bucket_size) + 1
+        next_end = min(int((i + 2) * bucket_size) + 1, n)
+        span = next_end - next_start
+        avg_x = sum(points[j][0] for j in range(next_start, next_end)) / span
+        avg_y = sum(points[j][1] for j in range(next_start, next_end)) / span
+
+        ax, ay = points[a][0], points[a][1]
+        best, best_area = None, -1.0
+        for j in range(int(i * bucket_size) + 1, next_start):
+            x, y = points[j][0], points[j][1]
+            area = abs((ax - avg_x) * (y - ay) - (ax - x) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        sampled.append(points[best])
+        a = best
+    sampled.append(points[-1])
+    return sampled
@@ -1,16 +1,39 @@
 import streamlit as st
-import openai
-from datetime import date
-from common import database
+import hashlib
+import heapq
+import itertools
+import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from datetime import date, timedelta
+from common import database, metrics, sentiment
 
 # Try to get OpenAI API key
 try:
-    openai.api_key = st.secrets["openai_api_key"]
-    AI_ENABLED = True
+    OPENAI_API_KEY = st.secrets["openai_api_key"]
+    AI_ENABLED = bool(OPENAI_API_KEY)
 except:
-    openai.api_key = None
+    OPENAI_API_KEY = None
     AI_ENABLED = False
 
+# Optional alternative endpoint, e.g. a proxy or a local fake server for testing
+try:
+    OPENAI_API_BASE = st.secrets["openai_api_base"]
+except Exception:
+    OPENAI_API_BASE = None
+
+def _openai():
+    """The configured openai module, imported on first use since it is slow to import"""
+    import openai
+    openai.api_key = OPENAI_API_KEY
+    if OPENAI_API_BASE:
+        openai.api_base = OPENAI_API_BASE
+    return openai
+
+STREAM_REFRESH_SECONDS = 0.05  # how often streamed text is redrawn
+
 # Mock AI responses for free usage (fallback)
 MOCK_SYMPTOM_RESPONSES = [
     "That sounds like a common reaction. Try staying hydrated and getting some rest. If symptoms persist, consider consulting your healthcare provider.",
@@ -30,31 +53,465 @@ MOCK_INSIGHTS = [
     "Your wellness journey is unique. Keep up the good work with your daily reflections."
 ]
 
+AI_CACHE_PATH = 'caresync_ai_cache.db'
+AI_CACHE_TTL = 7 * 24 * 3600  # seconds a cached response stays valid
+AI_CACHE_MAX_ENTRIES = 2000
+AI_CACHE_MAX_BYTES = 8 * 1024 * 1024
+
+class ResponseCache:
+    """On-disk cache of AI responses, shared by every process using the same file.
+    
+    Entries expire after ttl seconds; beyond max_entries or max_bytes the
+    least recently used ones are evicted. Hit/miss counts are kept in the
+    file too, so stats cover all processes.
+    """
+    
+    def __init__(self, path=AI_CACHE_PATH, ttl=AI_CACHE_TTL, max_entries=AI_CACHE_MAX_ENTRIES, max_bytes=AI_CACHE_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._pool = None
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def make_key(model, system, prompt, temperature):
+        raw = json.dumps([model, system, prompt, temperature], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+    
+    def _connection(self):
+        with self._lock:
+            if self._pool is None:
+                pool = database.ConnectionPool(self.path, size=4)
+                with pool.connection() as conn:
+                    conn.execute('''CREATE TABLE IF NOT EXISTS responses (
+                        key TEXT PRIMARY KEY, response TEXT NOT NULL,
+                        created_at REAL NOT NULL, accessed_at REAL NOT NULL, size INTEGER NOT NULL
+                    ) WITHOUT ROWID''')
+                    conn.execute('CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses (accessed_at)')
+                    conn.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+                    conn.execute("INSERT OR IGNORE INTO stats VALUES ('hits', 0), ('misses', 0), ('evictions', 0)")
+                self._pool = pool
+        return self._pool.connection()
+    
+    def get(self, key):
+        """Cached response for key, or None"""
+        now = time.time()
+        with self._connection() as conn:
+            row = conn.execute('SELECT response FROM responses WHERE key = ? AND created_at > ?', (key, now - self.ttl)).fetchone()
+            conn.execute("UPDATE stats SET value = value + 1 WHERE name = ?", ('hits' if row else 'misses',))
+            if row is None:
+                return None
+            conn.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (now, key))
+            return row[0]
+    
+    def put(self, key, response):
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+                         (key, response, now, now, len(response.encode("utf-8"))))
+            conn.execute('DELETE FROM responses WHERE created_at <= ?', (now - self.ttl,))
+            count, total = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+            evicted = 0
+            # Drop least recently used entries until back within both bounds
+            for old_key, size in conn.execute('SELECT key, size FROM responses ORDER BY accessed_at').fetchall():
+                if count <= self.max_entries and total <= self.max_bytes:
+                    break
+                conn.execute('DELETE FROM responses WHERE key = ?', (old_key,))
+                count, total, evicted = count - 1, total - size, evicted + 1
+            if evicted:
+                conn.execute("UPDATE stats SET value = value + ? WHERE name = 'evictions'", (evicted,))
+            conn.execute('COMMIT')
+    
+    def stats(self):
+        with self._connection() as conn:
+            stats = dict(conn.execute('SELECT name, value FROM stats'))
+            stats['entries'], stats['bytes'] = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+    
+    def clear(self):
+        with self._connection() as conn:
+            conn.execute('DELETE FROM responses')
+
+ai_cache = ResponseCache()
+
+AI_MAX_CONCURRENCY = 4  # upstream calls in flight at once, streams included
+AI_REQUESTS_PER_MINUTE = 60
+AI_TOKENS_PER_MINUTE = 40000
+AI_MAX_TOKENS = 300  # completion tokens requested per call
+AI_REQUEST_TIMEOUT = 120  # seconds a caller waits for a queued request
+PRIORITY_INTERACTIVE = 0  # someone is waiting on the page
+PRIORITY_BACKGROUND = 10
+
+class TokenBucket:
+    """Allows rate units per second on average, in bursts of up to capacity"""
+    
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._level = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self, amount=1):
+        """Block until amount units are available, then take them"""
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._level = min(self.capacity, self._level + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._level >= amount:
+                    self._level -= amount
+                    return
+                wait = (amount - self._level) / self.rate
+            time.sleep(wait)
+
+class SharedStream:
+    """The pieces of one streamed response, for every reader that joined it
+    
+    The worker emits pieces as they arrive; each reader iterates over all of
+    them from the start, waiting for more until the stream finishes.
+    """
+    
+    def __init__(self):
+        self._parts = []
+        self._done = False
+        self._error = None
+        self._cond = threading.Condition()
+    
+    def emit(self, part):
+        with self._cond:
+            self._parts.append(part)
+            self._cond.notify_all()
+    
+    def set_result(self, result):
+        with self._cond:
+            self._done = True
+            self._cond.notify_all()
+    
+    def set_exception(self, error):
+        with self._cond:
+            self._error = error
+            self._done = True
+            self._cond.notify_all()
+    
+    def __iter__(self):
+        seen = 0
+        while True:
+            with self._cond:
+                if not self._cond.wait_for(lambda: self._done or len(self._parts) > seen, AI_REQUEST_TIMEOUT):
+                    raise TimeoutError(f"no response within {AI_REQUEST_TIMEOUT}s")
+                parts, done, error = self._parts[seen:], self._done, self._error
+            seen += len(parts)
+            yield from parts
+            if done:
+                if error is not None:
+                    raise error
+                return
+
+class AIRequestBroker:
+    """Funnels every upstream AI call through one place.
+    
+    Identical requests (same key) made while one is in flight share it
+    instead of calling again: a request's result, or a stream's pieces,
+    which are fanned out to every reader. The rest wait in a priority queue
+    for a worker; a concurrency cap and request/token buckets keep the total
+    under the provider's rate limits. Jobs return (result, tokens used).
+    """
+    
+    def __init__(self, concurrency=AI_MAX_CONCURRENCY, requests_per_minute=AI_REQUESTS_PER_MINUTE,
+                 tokens_per_minute=AI_TOKENS_PER_MINUTE):
+        self.concurrency = concurrency
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._requests = TokenBucket(requests_per_minute / 60, max(1, requests_per_minute // 6))
+        self._tokens = TokenBucket(tokens_per_minute / 60, max(1, tokens_per_minute // 6))
+        self._queue = []
+        self._inflight = {}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._workers = []
+        self._latencies = deque(maxlen=500)
+        self._counts = {'requests': 0, 'coalesced': 0, 'errors': 0, 'tokens': 0, 'streams': 0}
+    
+    def submit(self, key, job, estimated_tokens, priority=PRIORITY_INTERACTIVE):
+        """Future for job(); joins the in-flight request with the same key if there is one"""
+        return self._enqueue(key, job, estimated_tokens, priority, Future)
+    
+    def stream(self, key, job, estimated_tokens, priority=PRIORITY_INTERACTIVE):
+        """SharedStream of the pieces job(emit) emits; joins the in-flight stream with the same key if there is one"""
+        return self._enqueue(('stream', key), job, estimated_tokens, priority, SharedStream)
+    
+    def _enqueue(self, key, job, estimated_tokens, priority, kind):
+        with self._cond:
+            sink = self._inflight.get(key)
+            if sink is not None:
+                self._counts['coalesced'] += 1
+                return sink
+            sink = kind()
+            self._inflight[key] = sink
+            heapq.heappush(self._queue, (priority, next(self._seq), key, job, estimated_tokens, sink))
+            self._ensure_workers()
+            self._cond.notify()
+        return sink
+    
+    def stats(self):
+        with self._cond:
+            stats = dict(self._counts)
+            latencies = sorted(self._latencies)
+            stats['queued'] = len(self._queue)
+        stats['p50_latency'] = latencies[len(latencies) // 2] if latencies else 0.0
+        stats['p95_latency'] = latencies[int(len(latencies) * 0.95)] if latencies else 0.0
+        return stats
+    
+    def _ensure_workers(self):
+        self._workers = [worker for worker in self._workers if worker.is_alive()]
+        while len(self._workers) < self.concurrency:
+            worker = threading.Thread(target=self._work, name=f"caresync-ai-{len(self._workers)}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+    
+    def _throttle(self, estimated_tokens):
+        self._requests.acquire()
+        self._tokens.acquire(estimated_tokens)
+    
+    def _record(self, start, tokens, error=False, stream=False):
+        with self._cond:
+            self._latencies.append(time.monotonic() - start)
+            self._counts['streams' if stream else 'requests'] += 1
+            self._counts['tokens'] += tokens
+            if error:
+                self._counts['errors'] += 1
+    
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                _, _, key, job, estimated_tokens, sink = heapq.heappop(self._queue)
+            stream = isinstance(sink, SharedStream)
+            start = time.monotonic()
+            try:
+                self._throttle(estimated_tokens)
+                with self._slots:
+                    result, tokens = job(sink.emit) if stream else job()
+            except BaseException as e:
+                self._record(start, estimated_tokens, error=True, stream=stream)
+                with self._cond:
+                    del self._inflight[key]
+                sink.set_exception(e)
+            else:
+                self._record(start, tokens, stream=stream)
+                with self._cond:
+                    del self._inflight[key]
+                sink.set_result(result)
+
+ai_broker = AIRequestBroker()
+
+def _estimate_tokens(prompt, system=None):
+    # ~4 characters per token, plus the completion budget
+    return (len(prompt) + len(system or "")) // 4 + AI_MAX_TOKENS
+
+AI_CONTEXT_TOKENS = 1200  # budget for the history sent with a weekly summary
+AI_CONTEXT_WEEKS = 26  # earliest week considered for the history
+AI_CONTEXT_ENTRY_CHARS = 400  # longer journal entries are trimmed to this
+
+def count_tokens(text):
+    """Rough token count, ~4 characters per token"""
+    return len(text) // 4 + 1
+
+def _trim(text, limit):
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit - 1].rstrip() + "…"
+
+def _week_line(week):
+    parts = [f"Week of {week.week_start}:"]
+    if week.mood_count:
+        parts.append(f"{week.mood_count} moods, average {week.mood_avg:.1f} (range {week.mood_min}-{week.mood_max});")
+    if week.journal_count:
+        parts.append(f"{week.journal_count} journal entries, latest began \"{_trim(week.excerpt, 160)}\"")
+    return " ".join(parts).rstrip(";")
+
+def _week_start(day):
+    """Monday of the week of an ISO date, as an ISO date"""
+    day = date.fromisoformat(day)
+    return (day - timedelta(days=day.weekday())).isoformat()
+
+def build_insight_context(snapshot=None, token_budget=AI_CONTEXT_TOKENS):
+    """The user's history for an insight prompt, kept within token_budget
+    
+    This week's moods and journal entries go in individually; earlier weeks
+    come from the weekly_summaries rollup, one line each, newest first, for as
+    many weeks as fit. Returns (context, tokens used).
+    """
+    snapshot = snapshot or database.load_dashboard_snapshot(current_user())
+    week_start = _week_start(snapshot.day)
+    
+    sections = [
+        ("This week's moods:",
+         [f"- {d}: {e} ({m})" for m, e, d in snapshot.moods if d >= week_start]),
+        ("This week's journal entries:",
+         [f"- {d}: {_trim(j, AI_CONTEXT_ENTRY_CHARS)}" for j, d in snapshot.journals if d >= week_start]),
+        ("Earlier weeks:",
+         [f"- {_week_line(w)}" for w in database.get_weekly_summaries(week_start, AI_CONTEXT_WEEKS, snapshot.user_id)]),
+    ]
+    lines = []
+    used = 0
+    for header, items in sections:
+        header_cost = count_tokens(header)
+        for item in items:
+            cost = count_tokens(item) + (header_cost if header else 0)
+            if used + cost > token_budget:
+                break
+            if header:
+                lines.append(header)
+                header = None
+            lines.append(item)
+            used += cost
+    return "\n".join(lines), used
+
 def get_today():
     return date.today().isoformat()
 
-def gpt_ask(prompt, system=None, model="gpt-4o"):
+def current_user():
+    """Id of the profile selected in this session"""
+    return st.session_state.get('user_id', database.DEFAULT_USER_ID)
+
+@metrics.timed('caresync_gpt_seconds')
+def gpt_ask(prompt, system=None, model="gpt-4o", temperature=0.7, priority=PRIORITY_INTERACTIVE):
     """Real GPT function with fallback to mock responses"""
-    if AI_ENABLED and openai.api_key:
+    if AI_ENABLED:
         try:
-            messages = []
-            if system:
-                messages.append({"role": "system", "content": system})
-            messages.append({"role": "user", "content": prompt})
+            key = ai_cache.make_key(model, system, prompt, temperature)
+            cached = ai_cache.get(key)
+            if cached is not None:
+                return cached
             
-            response = openai.ChatCompletion.create(
-                model=model,
-                messages=messages,
-                temperature=0.7,
-                max_tokens=300
-            )
-            return response.choices[0].message.content.strip()
+            def complete():
+                response = _openai().ChatCompletion.create(
+                    model=model,
+                    messages=_messages(prompt, system),
+                    temperature=temperature,
+                    max_tokens=AI_MAX_TOKENS
+                )
+                answer = response.choices[0].message.content.strip()
+                ai_cache.put(key, answer)
+                usage = getattr(response, "usage", None)
+                return answer, usage.total_tokens if usage else _estimate_tokens(prompt, system)
+            
+            future = ai_broker.submit(key, complete, _estimate_tokens(prompt, system), priority)
+            return future.result(timeout=AI_REQUEST_TIMEOUT)
         except Exception as e:
             st.warning(f"AI API error: {str(e)}. Using fallback response.")
             return _get_mock_response(prompt)
     else:
         return _get_mock_response(prompt)
 
+def _messages(prompt, system=None):
+    messages = []
+    if system:
+        messages.append({"role": "system", "content": system})
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+def gpt_ask_stream(prompt, system=None, model="gpt-4o", temperature=0.7, priority=PRIORITY_INTERACTIVE):
+    """Like gpt_ask, but yields the response in pieces as they arrive"""
+    start = time.perf_counter()
+    waiting = True
+    try:
+        for token in _gpt_stream(prompt, system, model, temperature, priority):
+            if waiting:
+                metrics.observe('caresync_gpt_first_token_seconds', time.perf_counter() - start)
+                waiting = False
+            yield token
+    finally:
+        # Includes the time the page took to draw what came before
+        metrics.observe('caresync_gpt_stream_seconds', time.perf_counter() - start)
+
+def _gpt_stream(prompt, system, model, temperature, priority):
+    if not (AI_ENABLED):
+        yield from _stream_words(_get_mock_response(prompt))
+        return
+    
+    key = ai_cache.make_key(model, system, prompt, temperature)
+    cached = ai_cache.get(key)
+    if cached is not None:
+        yield cached
+        return
+    
+    estimate = _estimate_tokens(prompt, system)
+    
+    def stream(emit):
+        response = _openai().ChatCompletion.create(
+            model=model,
+            messages=_messages(prompt, system),
+            temperature=temperature,
+            max_tokens=AI_MAX_TOKENS,
+            stream=True
+        )
+        parts = []
+        for chunk in response:
+            token = chunk["choices"][0]["delta"].get("content")
+            if token:
+                # Leading whitespace is dropped, as gpt_ask's strip() would
+                if not parts:
+                    token = token.lstrip()
+                    if not token:
+                        continue
+                parts.append(token)
+                emit(token)
+        # Cached here rather than by the readers, so it happens even if they all stop reading
+        answer = "".join(parts).strip()
+        ai_cache.put(key, answer)
+        # Streams carry no usage; count the prompt estimate plus what came back
+        return answer, estimate - AI_MAX_TOKENS + len(parts)
+    
+    received = False
+    try:
+        # Sessions asking the same thing at once all read one upstream stream
+        for token in ai_broker.stream(key, stream, estimate, priority):
+            received = True
+            yield token
+    except Exception as e:
+        if received:
+            st.warning(f"AI API error: {str(e)}. The response may be incomplete.")
+            return
+        st.warning(f"AI API error: {str(e)}. Using fallback response.")
+        yield from _stream_words(_get_mock_response(prompt))
+
+def _stream_words(text):
+    words = text.split(" ")
+    for i, word in enumerate(words):
+        yield word if i == 0 else " " + word
+
+def render_stream(tokens, render=None):
+    """Show streamed tokens as they arrive in a single placeholder; returns the full text
+    
+    render(text) turns the text so far into the HTML to show; plain markdown if omitted.
+    """
+    placeholder = st.empty()
+    
+    def draw(text):
+        if render:
+            placeholder.markdown(render(text), unsafe_allow_html=True)
+        else:
+            placeholder.markdown(text)
+    
+    text = ""
+    last_draw = 0
+    for token in tokens:
+        text += token
+        # Redraw at most every STREAM_REFRESH_SECONDS, not once per token
+        now = time.monotonic()
+        if now - last_draw >= STREAM_REFRESH_SECONDS:
+            draw(text + "▌")
+            last_draw = now
+    draw(text)
+    return text
+
 def _get_mock_response(prompt):
     """Get appropriate mock response based on prompt content"""
     import random
@@ -67,34 +524,41 @@ def _get_mock_response(prompt):
     else:
         return random.choice(MOCK_INSIGHTS)
 
-@st.cache_data(show_spinner=False)
-def cache_ai_summary(prompt, system=None):
-    return gpt_ask(prompt, system)
-
-def show_ai_insights():
+def show_ai_insights(snapshot=None):
     st.subheader("AI Insights")
     
     # Show AI status
-    if AI_ENABLED and openai.api_key:
+    if AI_ENABLED:
         st.success("🤖 Real AI enabled")
     else:
         st.info("🤖 Using demo AI responses (add OpenAI API key for real AI)")
     
-    moods = database.get_moods()
-    journals = database.get_journals()
-    meds, logs = database.get_today_medications()
+    if AI_ENABLED:
+        stats = ai_cache.stats()
+        if stats['hits'] + stats['misses']:
+            st.caption(f"⚡ AI response cache: {stats['hit_rate']:.0%} hit rate, {stats['entries']} saved responses")
+        broker = ai_broker.stats()
+        if broker['requests'] + broker['streams']:
+            st.caption(f"🚦 AI calls: {broker['requests'] + broker['streams']} made, {broker['coalesced']} shared, "
+                       f"p95 latency {broker['p95_latency']:.1f}s, ~{broker['tokens']} tokens")
     
-    if not moods and not journals:
+    snapshot = snapshot or database.load_dashboard_snapshot(current_user())
+    context, _ = build_insight_context(snapshot)
+    
+    if not context:
         st.info("Not enough data for insights.")
         return
     
-    mood_text = "\n".join([f"{d}: {e} ({s})" for s, e, d in moods])
-    journal_text = "\n".join([f"{d}: {j}" for j, d in journals])
-    prompt = f"Here are the user's recent moods:\n{mood_text}\n\nAnd recent journal entries:\n{journal_text}\n\nGenerate a friendly weekly summary, highlight any patterns (e.g. mood drops after missed meds), and offer a gentle suggestion."
+    tone = database.get_journal_tone(_week_start(snapshot.day), None, 'weekly', snapshot.user_id)
+    if tone:
+        this_week = tone[-1]
+        st.caption(f"📝 Journal tone this week: {sentiment.label(this_week.sentiment)}"
+                   + (f", mostly {this_week.emotion}" if this_week.emotion else "")
+                   + f" ({this_week.count} entries)")
+    
+    prompt = f"Here is the user's recent mood and journal history:\n{context}\n\nGenerate a friendly weekly summary, highlight any patterns (e.g. mood drops after missed meds), and offer a gentle suggestion."
     system = "You are a wellness assistant. Summarize the user's week, spot patterns, and give gentle, non-medical suggestions."
     
     if st.button("Generate Weekly AI Summary"):
-        with st.spinner("Generating insights..."):
-            summary = cache_ai_summary(prompt, system)
         st.success("AI Weekly Summary:")
-        st.write(summary) 
\ No newline at end of file
+        render_stream(gpt_ask_stream(prompt, system)) 
\ No newline at end of file
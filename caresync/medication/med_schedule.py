@@ -1,71 +1,63 @@
 import streamlit as st
 from common import database
-import pandas as pd
-from datetime import datetime, time
-from common.notifications import notification_manager
+from common.models import doses_due_soon, minutes_of, split_open_doses
+from common.utils import current_user
+from datetime import date, datetime, time, timedelta
+from common.scheduler import reminder_scheduler
 
-def show_today_schedule():
-    database.init_db()
-    meds, logs = database.get_today_medications()
+def log_dose(med_id, status, user_id):
+    database.log_medication(med_id, status, user_id)
+    # A logged dose needs no reminder
+    reminder_scheduler.refresh()
+
+def show_today_schedule(snapshot=None):
+    snapshot = snapshot or database.load_dashboard_snapshot(current_user())
+    meds, doses = snapshot.medications, snapshot.doses
     
     # Check for upcoming/overdue medications
-    current_time = datetime.now().time()
-    upcoming_meds = []
-    overdue_meds = []
-    
-    for med in meds:
-        med_id, name, dose, freq, time_str = med
-        try:
-            med_time = datetime.strptime(time_str, "%H:%M:%S").time()
-            status = logs.get(med_id, None)
-            
-            if status is None:  # Not taken yet
-                if med_time <= current_time:
-                    overdue_meds.append((med_id, name, dose, freq, time_str))
-                else:
-                    upcoming_meds.append((med_id, name, dose, freq, time_str))
-        except:
-            pass
+    overdue_meds, upcoming_meds = split_open_doses(doses, minutes_of(datetime.now()))
     
-    # Send notifications for due/overdue medications
+    # Reminders are sent from the background scheduler, once each
     if meds:
-        sent_reminders = notification_manager.check_and_send_reminders(meds)
-        if sent_reminders:
-            st.info(f"🔔 Sent {len(sent_reminders)} reminder(s) for due medications")
+        next_reminder = reminder_scheduler.next_reminder(snapshot.user_id)
+        if next_reminder:
+            send_at, name = next_reminder
+            st.caption(f"🔔 Next reminder: {name} at {send_at.strftime('%H:%M')}")
     
     # Show overdue medications as urgent alerts
     if overdue_meds:
         st.markdown("### ⚠️ Overdue Medications")
-        for med_id, name, dose, freq, time_str in overdue_meds:
+        for med in overdue_meds:
+            med_id, name = med.id, med.name
             st.markdown(f"""
             <div style="background: linear-gradient(135deg, #ffebee 0%, #ffcdd2 100%); 
                         padding: 1rem; border-radius: 10px; border-left: 4px solid #f44336;">
-                <h4>🚨 {name} - {dose}</h4>
-                <p><strong>Due:</strong> {time_str} • <strong>Status:</strong> Overdue</p>
+                <h4>🚨 {name} - {med.dose}</h4>
+                <p><strong>Due:</strong> {med.time_label} • <strong>Status:</strong> Overdue</p>
             </div>
             """, unsafe_allow_html=True)
             
             col1, col2 = st.columns(2)
             with col1:
                 if st.button(f"✅ Take Now", key=f"take_overdue_{med_id}", use_container_width=True):
-                    database.log_medication(med_id, "taken")
+                    log_dose(med_id, "taken", snapshot.user_id)
                     st.success(f"✅ {name} marked as taken!")
                     st.rerun()
             with col2:
                 if st.button(f"❌ Skip", key=f"skip_overdue_{med_id}", use_container_width=True):
-                    database.log_medication(med_id, "missed")
+                    log_dose(med_id, "missed", snapshot.user_id)
                     st.warning(f"❌ {name} marked as missed")
                     st.rerun()
     
     # Show upcoming medications
     if upcoming_meds:
         st.markdown("### ⏰ Upcoming Medications")
-        for med_id, name, dose, freq, time_str in upcoming_meds:
+        for med in upcoming_meds:
             st.markdown(f"""
             <div style="background: linear-gradient(135deg, #e8f5e8 0%, #c8e6c9 100%); 
                         padding: 1rem; border-radius: 10px; border-left: 4px solid #4caf50;">
-                <h4>⏰ {name} - {dose}</h4>
-                <p><strong>Due:</strong> {time_str} • <strong>Status:</strong> Upcoming</p>
+                <h4>⏰ {med.name} - {med.dose}</h4>
+                <p><strong>Due:</strong> {med.time_label} • <strong>Status:</strong> Upcoming</p>
             </div>
             """, unsafe_allow_html=True)
     
@@ -75,16 +67,16 @@ def show_today_schedule():
         return
     
     st.markdown("### 📋 All Today's Medications")
-    for med in meds:
-        med_id, name, dose, freq, time_str = med
-        status = logs.get(med_id, None)
+    for dose in doses:
+        med, status = dose.medication, dose.status
+        med_id, name = med.id, med.name
         
         # Create a card for each medication
         with st.container():
             col1, col2, col3 = st.columns([3, 2, 2])
             with col1:
                 st.markdown(f"**💊 {name}**")
-                st.caption(f"{dose} • {freq} • {time_str}")
+                st.caption(f"{med.dose} • {med.frequency} • {med.time_label}")
             
             with col2:
                 if status == "taken":
@@ -93,19 +85,19 @@ def show_today_schedule():
                     st.markdown('<div class="warning-card">❌ Missed</div>', unsafe_allow_html=True)
                 else:
                     if st.button(f"✅ Mark Taken", key=f"taken_{med_id}", use_container_width=True):
-                        database.log_medication(med_id, "taken")
+                        log_dose(med_id, "taken", snapshot.user_id)
                         st.success(f"✅ {name} marked as taken!")
                         st.rerun()
             
             with col3:
                 if status is None:
                     if st.button(f"❌ Missed", key=f"missed_{med_id}", use_container_width=True):
-                        database.log_medication(med_id, "missed")
+                        log_dose(med_id, "missed", snapshot.user_id)
                         st.warning(f"❌ {name} marked as missed")
                         st.rerun()
             st.markdown("---")
 
-def medication_manager():
+def medication_manager(snapshot=None):
     st.subheader("➕ Add New Medication")
     
     with st.form("add_med_form", clear_on_submit=True):
@@ -131,7 +123,8 @@ def medication_manager():
         
         submitted = st.form_submit_button("➕ Add Medication", use_container_width=True)
         if submitted and name and dose:
-            database.add_medication(name, dose, freq, str(time_input))
+            database.add_medication(name, dose, freq, str(time_input), current_user())
+            reminder_scheduler.refresh()
             st.success(f"✅ Added {name} successfully!")
             if enable_reminder:
                 st.info(f"🔔 Reminder set for {time_input} via {notification_type.lower()} notifications")
@@ -139,9 +132,11 @@ def medication_manager():
     
     st.markdown("---")
     st.subheader("📋 Current Medications")
-    meds, _ = database.get_today_medications()
+    meds = (snapshot or database.load_dashboard_snapshot(current_user())).medications
     if meds:
-        df = pd.DataFrame(meds, columns=["ID", "Name", "Dose", "Frequency", "Time"])
+        import pandas as pd
+        df = pd.DataFrame([(m.id, m.name, m.dose, m.frequency, m.time_label) for m in meds],
+                          columns=["ID", "Name", "Dose", "Frequency", "Time"])
         st.dataframe(
             df.drop(columns=["ID"]),
             use_container_width=True,
@@ -150,38 +145,60 @@ def medication_manager():
     else:
         st.info("No medications added yet. Add your first medication above!")
 
+ADHERENCE_RANGES = {"Last 7 days": 7, "Last 30 days": 30, "Last 90 days": 90, "Last year": 365}
+
 def plot_adherence():
+    import plotly.graph_objs as go
     st.subheader("📈 Medication Adherence Over Time")
-    # Placeholder: implement adherence graph using med_logs
-    st.info("Adherence tracking will be available once you log some medications.")
+    range_label = st.selectbox("Range", list(ADHERENCE_RANGES), index=1, key="adherence_range")
+    end = date.today()
+    start = end - timedelta(days=ADHERENCE_RANGES[range_label] - 1)
+    
+    # Daily rollups: one row per logged day, independent of total log volume
+    user_id = current_user()
+    daily = database.get_adherence(start.isoformat(), end.isoformat(), user_id)
+    if not daily:
+        st.info("Adherence tracking will be available once you log some medications.")
+        return
+    
+    by_day = {log_date: (taken, missed) for log_date, taken, missed in daily}
+    days = [(start + timedelta(days=i)).isoformat() for i in range((end - start).days + 1)]
+    rates = []
+    for day in days:
+        taken, missed = by_day.get(day, (0, 0))
+        rates.append(round(100 * taken / (taken + missed)) if taken + missed else None)
+    
+    total_taken = sum(taken for _, taken, _ in daily)
+    total_logged = sum(taken + missed for _, taken, missed in daily)
+    st.metric("Adherence", f"{100 * total_taken / total_logged:.0f}%", help=f"{total_taken} of {total_logged} logged doses taken")
+    
+    fig = go.Figure()
+    fig.add_trace(go.Bar(x=days, y=rates, marker_color="#667eea", name="Taken %"))
+    fig.update_layout(yaxis=dict(range=[0, 100]), xaxis_title="Date", yaxis_title="Doses taken (%)", height=300)
+    st.plotly_chart(fig, use_container_width=True)
+    
+    per_med = database.get_medication_adherence(start.isoformat(), end.isoformat(), user_id)
+    if per_med:
+        names = [name for _, name, _, _ in per_med]
+        med_rates = [round(100 * taken / (taken + missed)) for _, _, taken, missed in per_med]
+        fig = go.Figure(go.Bar(x=med_rates, y=names, orientation="h", marker_color="#764ba2"))
+        fig.update_layout(xaxis=dict(range=[0, 100]), xaxis_title="Doses taken (%)", height=60 + 40 * len(names))
+        st.plotly_chart(fig, use_container_width=True)
 
-def show_reminder_status():
+def show_reminder_status(snapshot=None):
     """Show current reminder status and upcoming medications"""
     st.markdown("### 🔔 Reminder Status")
     
-    current_time = datetime.now()
-    meds, logs = database.get_today_medications()
+    now = minutes_of(datetime.now())
+    snapshot = snapshot or database.load_dashboard_snapshot(current_user())
     
-    if not meds:
+    if not snapshot.medications:
         st.info("No medications to remind about.")
         return
     
-    # Check for medications due soon
-    due_soon = []
-    for med in meds:
-        med_id, name, dose, freq, time_str = med
-        status = logs.get(med_id, None)
-        
-        if status is None:  # Not taken yet
-            try:
-                med_time = datetime.strptime(time_str, "%H:%M:%S").time()
-                med_datetime = datetime.combine(current_time.date(), med_time)
-                time_diff = (med_datetime - current_time).total_seconds() / 60  # minutes
-                
-                if -30 <= time_diff <= 30:  # Within 30 minutes
-                    due_soon.append((name, dose, time_str, time_diff))
-            except:
-                pass
+    # Check for medications due within 30 minutes
+    due_soon = [(dose.medication.name, dose.medication.dose, dose.medication.time_label, time_diff)
+                for dose, time_diff in doses_due_soon(snapshot.doses, now)]
     
     if due_soon:
         st.markdown("### ⏰ Medications Due Soon")
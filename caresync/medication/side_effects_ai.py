@@ -1,5 +1,5 @@
 import streamlit as st
-from common.utils import gpt_ask
+from common.utils import gpt_ask_stream, render_stream
 
 def symptom_checker():
     st.write("**🤖 AI Symptom Analysis**")
@@ -31,11 +31,8 @@ def symptom_checker():
         if submitted and med_name and reaction:
             system = f"You are a helpful assistant analyzing a reaction to {med_name}. The user said: '{reaction}'. Give friendly, informative insight without diagnosing. Suggest hydration, rest, or medical attention if needed."
             
-            with st.spinner("🤖 AI is analyzing your symptoms..."):
-                feedback = gpt_ask(reaction, system)
-            
             st.markdown("### 💡 AI Analysis")
-            st.markdown(f"""
+            render_stream(gpt_ask_stream(reaction, system), render=lambda feedback: f"""
             <div style="background: linear-gradient(135deg, #fff3e0 0%, #ffe0b2 100%); 
                         padding: 1.5rem; border-radius: 10px; border-left: 4px solid #ff9800;">
                 <h4>📋 Analysis for {med_name}</h4>
@@ -45,7 +42,7 @@ def symptom_checker():
                 <h5>🤖 AI Feedback:</h5>
                 {feedback}
             </div>
-            """, unsafe_allow_html=True)
+            """)
             
             # Additional recommendations
             st.markdown("### 💡 General Tips")
@@ -1,6 +1,6 @@
 import streamlit as st
-from common import database
-from common.utils import gpt_ask
+from common import database, sentiment
+from common.utils import current_user, gpt_ask_stream, render_stream
 
 def quick_journal():
     st.write("**How do you feel? (1-2 sentences)**")
@@ -17,7 +17,7 @@ def quick_journal():
         st.caption(f"Characters: {char_count}/200")
         
         if st.button("💾 Save Quick Journal", use_container_width=True):
-            database.add_journal(entry)
+            database.add_journal(entry, current_user())
             st.success("✅ Journal entry saved!")
             st.balloons()
 
@@ -36,14 +36,14 @@ def journal_entry():
         st.caption(f"Characters: {char_count}")
         
         if st.button("💾 Save Journal Entry", use_container_width=True):
-            database.add_journal(entry)
+            database.add_journal(entry, current_user())
             st.success("✅ Journal entry saved!")
             st.balloons()
 
-def gpt_reflection():
+def gpt_reflection(snapshot=None):
     st.write("**🤖 AI Reflection**")
     
-    journals = database.get_journals()
+    journals = (snapshot or database.load_dashboard_snapshot(current_user())).journals
     if not journals:
         st.info("📝 No journal entries yet. Write something first!")
         return
@@ -59,15 +59,46 @@ def gpt_reflection():
     last_entry = journals[0][0]
     st.markdown(f"**Latest entry:** {journals[0][1]}")
     
+    # Instant, offline read of the tone; the AI reflection goes deeper
+    score, emotion = sentiment.analyze([last_entry])[0]
+    st.caption(f"Tone: {sentiment.label(score)} ({score:+.2f})" + (f", mostly {emotion}" if emotion else ""))
+    
     if st.button("🧠 Analyze My Journal", use_container_width=True):
-        with st.spinner("🤖 AI is reflecting on your entry..."):
-            system = "You are a supportive assistant. Analyze the user's journal entry for emotional tone, repeated negative patterns, and offer a gentle suggestion if needed."
-            reflection = gpt_ask(last_entry, system)
+        system = "You are a supportive assistant. Analyze the user's journal entry for emotional tone, repeated negative patterns, and offer a gentle suggestion if needed."
         
         st.markdown("### 💭 AI Reflection")
-        st.markdown(f"""
+        render_stream(gpt_ask_stream(last_entry, system), render=lambda reflection: f"""
         <div style="background: linear-gradient(135deg, #e3f2fd 0%, #bbdefb 100%); 
                     padding: 1rem; border-radius: 10px; border-left: 4px solid #2196F3;">
             {reflection}
         </div>
-        """, unsafe_allow_html=True) 
\ No newline at end of file
+        """)
+
+def journal_search():
+    st.write("**🔎 Search Your Journal**")
+    query = st.text_input("Search entries", key="journal_search", placeholder="e.g., sleep, anxious, walk...")
+    if not query.strip():
+        return
+    
+    # Keyset cursors of the pages before the current one; reset on a new query or profile
+    user_id = current_user()
+    if st.session_state.get("journal_search_query") != (user_id, query):
+        st.session_state.journal_search_query = (user_id, query)
+        st.session_state.journal_search_cursors = [None]
+    cursors = st.session_state.journal_search_cursors
+    
+    hits = database.search_journals(query, after=cursors[-1], user_id=user_id)
+    if not hits:
+        st.info("No matching entries." if len(cursors) == 1 else "No more results.")
+    for hit in hits:
+        st.markdown(f"**{hit.journal_date}:** {hit.snippet}")
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        if len(cursors) > 1 and st.button("⬅️ Previous", key="journal_search_prev", use_container_width=True):
+            cursors.pop()
+            st.rerun()
+    with col2:
+        if len(hits) == database.SEARCH_PAGE_SIZE and st.button("Next ➡️", key="journal_search_next", use_container_width=True):
+            cursors.append((hits[-1].rank, hits[-1].id))
+            st.rerun()
@@ -1,5 +1,6 @@
 import streamlit as st
 from common import database
+from common.utils import current_user
 
 MOODS = [
     ("😃", 5, "Great"),
@@ -9,7 +10,7 @@ MOODS = [
     ("😢", 1, "Bad")
 ]
 
-def mood_input(key_suffix=""):
+def mood_input(key_suffix="", snapshot=None):
     st.write("**How are you feeling today?**")
     
     # Create mood selection with better styling
@@ -32,14 +33,14 @@ def mood_input(key_suffix=""):
         st.markdown(f"**Selected:** {emoji} {label}")
         
         if st.button("📝 Log This Mood", key=f"log_mood{key_suffix}", use_container_width=True):
-            database.add_mood(score, emoji)
+            database.add_mood(score, emoji, current_user())
             st.success(f"✅ Mood logged: {emoji} {label}")
             st.balloons()
     
     # Show today's mood if already logged
     else:
         # Check if mood was already logged today
-        moods = database.get_moods()
-        if moods and moods[0][2] == database.get_today():
-            today_mood = moods[0]
+        snapshot = snapshot or database.load_dashboard_snapshot(current_user())
+        today_mood = snapshot.latest_mood
+        if today_mood and today_mood[2] == snapshot.day:
             st.info(f"📊 Today's mood: {today_mood[1]} {today_mood[0]}") 
\ No newline at end of file
@@ -1,17 +1,55 @@
 import streamlit as st
-import plotly.graph_objs as go
-from common import database
+from datetime import date, timedelta
+from common import database, sentiment
+from common.utils import current_user
 
-def plot_mood_trends():
+MOOD_RANGES = {"Last 30 days": 30, "Last 90 days": 90, "Last year": 365, "All time": None}
+GRANULARITIES = {"Raw": "raw", "Daily": "daily", "Weekly": "weekly", "Monthly": "monthly"}
+MOOD_EMOJIS = {5: "😃", 4: "🙂", 3: "😐", 2: "😔", 1: "😢"}
+
+def plot_mood_trends(snapshot=None):
+    import plotly.graph_objs as go
     st.subheader("Mood Trends Over Time")
-    moods = database.get_moods()
-    if not moods:
+    snapshot = snapshot or database.load_dashboard_snapshot(current_user())
+    if not snapshot.moods:
         st.info("No mood data yet.")
         return
-    dates = [m[2] for m in moods][::-1]
-    scores = [m[0] for m in moods][::-1]
-    emojis = [m[1] for m in moods][::-1]
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        range_label = st.selectbox("Range", list(MOOD_RANGES), key="mood_range")
+    with col2:
+        granularity = st.selectbox("Granularity", list(GRANULARITIES), key="mood_granularity")
+    
+    days = MOOD_RANGES[range_label]
+    start = (date.today() - timedelta(days=days - 1)).isoformat() if days else None
+    points = database.get_mood_series(start, None, GRANULARITIES[granularity], user_id=snapshot.user_id)
+    if not points:
+        st.info("No moods logged in this range.")
+        return
+    
+    dates = [p.date for p in points]
+    scores = [p.mood for p in points]
     fig = go.Figure()
-    fig.add_trace(go.Scatter(x=dates, y=scores, mode='lines+markers', text=emojis, marker=dict(size=12)))
-    fig.update_layout(yaxis=dict(range=[0,5], tickvals=[1,2,3,4,5]), xaxis_title="Date", yaxis_title="Mood (1-5)")
-    st.plotly_chart(fig, use_container_width=True) 
\ No newline at end of file
+    if granularity == "Raw":
+        emojis = [MOOD_EMOJIS.get(p.mood, "") for p in points]
+        fig.add_trace(go.Scatter(x=dates, y=scores, mode='lines+markers', text=emojis, marker=dict(size=12)))
+    else:
+        # Shade each bucket's low..high range behind its average
+        fig.add_trace(go.Scatter(x=dates, y=[p.high for p in points], mode='lines', line=dict(width=0), hoverinfo='skip', showlegend=False))
+        fig.add_trace(go.Scatter(x=dates, y=[p.low for p in points], mode='lines', line=dict(width=0), fill='tonexty',
+                                 fillcolor='rgba(102, 126, 234, 0.2)', hoverinfo='skip', showlegend=False))
+        fig.add_trace(go.Scatter(x=dates, y=scores, mode='lines+markers', customdata=[p.count for p in points],
+                                 hovertemplate="%{x}: %{y:.1f} (%{customdata} entries)<extra></extra>", showlegend=False))
+    # Journal tone from the sentiment stored with each entry, on its own axis
+    tone = database.get_journal_tone(start, None, GRANULARITIES[granularity] if granularity != "Raw" else "daily",
+                                     snapshot.user_id)
+    if tone:
+        fig.add_trace(go.Scatter(x=[t.date for t in tone], y=[t.sentiment for t in tone], yaxis='y2', mode='lines',
+                                 name="Journal tone", line=dict(dash='dot', color='#ff9800'),
+                                 customdata=[[sentiment.label(t.sentiment), t.emotion or "-"] for t in tone],
+                                 hovertemplate="%{x}: %{customdata[0]}, mostly %{customdata[1]}<extra></extra>"))
+    fig.update_layout(yaxis=dict(range=[0,5], tickvals=[1,2,3,4,5]), xaxis_title="Date", yaxis_title="Mood (1-5)",
+                      yaxis2=dict(range=[-1, 1], overlaying='y', side='right', title="Journal tone", showgrid=False),
+                      legend=dict(orientation='h'))
+    st.plotly_chart(fig, use_container_width=True)
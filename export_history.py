@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+CareSync - export a user's history
+Writes a zip archive with one file per kind, or a single kind to one file:
+
+    python export_history.py caresync-export.zip --format jsonl
+    python export_history.py moods.parquet --kind moods --user 2
+"""
+
+import argparse
+import os
+import sys
+
+# Add the caresync directory to the Python path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'caresync'))
+
+from common import database, export
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export CareSync data without loading it all into memory.")
+    parser.add_argument("output", help="file to write: a .zip archive of every kind, or one kind's file with --kind")
+    parser.add_argument("--kind", choices=export.EXPORT_KINDS, help="export only this kind")
+    parser.add_argument("--format", choices=export.FORMATS,
+                        help="file format (default: from the output extension, or csv for archives)")
+    parser.add_argument("--user", type=int, default=database.DEFAULT_USER_ID, help="user id (default: %(default)s)")
+    parser.add_argument("--db", default=database.DB_PATH, help="database file (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    database.DB_PATH = args.db
+    try:
+        if args.kind:
+            count = export.export_file(args.output, args.kind, args.format, args.user)
+            print(f"{count} {args.kind} written to {args.output}")
+        else:
+            with open(args.output, "wb") as f:
+                counts = export.export_archive(f, args.format or "csv", args.user)
+            for kind, count in counts.items():
+                print(f"{count} {kind} written to {args.output}")
+    except ValueError as e:
+        parser.exit(1, f"error: {e}\n")
+
+
+if __name__ == "__main__":
+    main()
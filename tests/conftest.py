@@ -0,0 +1,5 @@
+# The app imports its modules as `common.*`, from inside the caresync directory
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'caresync'))
@@ -0,0 +1,18 @@
+import io
+import json
+
+import pytest
+
+from common import importer
+
+
+def test_json_array_elements_longer_than_the_read_buffer():
+    records = [{"entry": "x" * n, "journal_date": "2024-03-05"} for n in (10, 200_000, 3)]
+    stream = io.StringIO(json.dumps(records))
+    assert list(importer.iter_json_array(stream, buffer_size=1024)) == records
+
+
+def test_json_array_element_over_the_size_limit_is_refused():
+    stream = io.StringIO(json.dumps([1, "x" * 200_000, 2]))
+    with pytest.raises(ValueError, match="at character 4 is malformed or longer than 100000 characters"):
+        list(importer.iter_json_array(stream, buffer_size=1024, max_element_size=100_000))
@@ -0,0 +1,95 @@
+import json
+import sqlite3
+
+import pytest
+
+from common import database
+
+
+@pytest.fixture
+def legacy_db():
+    """An unversioned database with the original schema, as the first releases wrote it."""
+    conn = sqlite3.connect(':memory:', isolation_level=None)
+    conn.execute('CREATE TABLE medications (id INTEGER PRIMARY KEY, name TEXT, dose TEXT, frequency TEXT, time TEXT)')
+    conn.execute('CREATE TABLE med_logs (id INTEGER PRIMARY KEY, med_id INTEGER, log_date TEXT, status TEXT)')
+    conn.execute('CREATE TABLE moods (id INTEGER PRIMARY KEY, mood INTEGER, mood_emoji TEXT, mood_date TEXT)')
+    conn.execute('CREATE TABLE journals (id INTEGER PRIMARY KEY, entry TEXT, journal_date TEXT)')
+    conn.execute("INSERT INTO medications VALUES (1, 'Aspirin', '1 tablet', 'Daily', '08:00'), "
+                 "(2, 'Vitamin D', '1 capsule', 'Daily', '9am'), (3, 'Iron', '1 tablet', 'Daily', 'after lunch')")
+    yield conn
+    conn.close()
+
+
+def quarantined(conn, source):
+    return {source_id: (json.loads(data), reason) for source_id, data, reason in conn.execute(
+        'SELECT source_id, data, reason FROM migration_quarantine WHERE source = ?', (source,))}
+
+
+def test_logs_without_a_medication_or_date_are_quarantined(legacy_db):
+    legacy_db.execute("INSERT INTO med_logs (med_id, log_date, status) VALUES "
+                      "(1, '2024-03-05', 'taken'), (NULL, '2024-03-05', 'taken'), "
+                      "(NULL, '2024-03-06', 'missed'), (2, NULL, 'taken'), (2, '2024/03/05', 'Taken')")
+
+    assert database.migrate(legacy_db) == len(database.MIGRATIONS)
+
+    assert {source_id: reason for source_id, (_, reason) in quarantined(legacy_db, 'med_logs').items()} == {
+        2: 'no medication', 3: 'no medication', 4: 'unreadable date'}
+    assert quarantined(legacy_db, 'med_logs')[4][0]['med_id'] == 2
+    day = database._day('2024-03-05')
+    assert sorted(legacy_db.execute('SELECT med_id, log_date, status FROM med_logs')) == [(1, day, 1), (2, day, 1)]
+    assert legacy_db.execute('SELECT med_id, taken, missed FROM adherence_by_med ORDER BY med_id').fetchall() == [
+        (1, 1, 0), (2, 1, 0)]
+    assert legacy_db.execute('SELECT log_date, taken, missed FROM adherence_daily').fetchall() == [(day, 2, 0)]
+
+
+def test_unreadable_mood_and_journal_dates_are_quarantined(legacy_db):
+    legacy_db.execute("INSERT INTO moods (mood, mood_emoji, mood_date) VALUES "
+                      "(3, '😐', '2024-03-05'), (4, '🙂', '2024/03/05'), (2, '😔', 'March 5, 2024'), "
+                      "(1, '😢', 'bad date'), (5, '😄', NULL)")
+    legacy_db.execute("INSERT INTO journals (entry, journal_date) VALUES "
+                      "('ok', '2024-03-05'), ('slashes', '2024/03/05'), ('bad', 'bad date'), ('none', NULL)")
+
+    assert database.migrate(legacy_db) == len(database.MIGRATIONS)
+
+    assert {source_id: reason for source_id, (_, reason) in quarantined(legacy_db, 'moods').items()} == {
+        4: 'unreadable date', 5: 'unreadable date'}
+    assert quarantined(legacy_db, 'moods')[4][0]['mood_date'] == 'bad date'
+    assert {source_id: reason for source_id, (_, reason) in quarantined(legacy_db, 'journals').items()} == {
+        3: 'unreadable date', 4: 'unreadable date'}
+    day = database._day('2024-03-05')
+    assert legacy_db.execute('SELECT id, mood_date FROM moods ORDER BY id').fetchall() == [(1, day), (2, day), (3, day)]
+    assert legacy_db.execute('SELECT id, journal_date FROM journals ORDER BY id').fetchall() == [(1, day), (2, day)]
+    assert legacy_db.execute('SELECT week_start, mood_count, mood_sum, journal_count FROM weekly_summaries').fetchall() == [
+        (database._day('2024-03-04'), 3, 9, 2)]
+
+
+def test_unreadable_reminder_times_are_quarantined_and_the_medication_kept(legacy_db):
+    assert database.migrate(legacy_db) == len(database.MIGRATIONS)
+
+    assert legacy_db.execute('SELECT id, time FROM medications ORDER BY id').fetchall() == [
+        (1, 8 * 60), (2, 9 * 60), (3, None)]
+    assert {source_id: reason for source_id, (_, reason) in quarantined(legacy_db, 'medications').items()} == {
+        3: 'unreadable reminder time'}
+
+
+def test_migrating_again_is_a_no_op(legacy_db):
+    legacy_db.execute("INSERT INTO moods (mood, mood_emoji, mood_date) VALUES (1, '😢', 'bad date')")
+    database.migrate(legacy_db)
+    count = legacy_db.execute('SELECT COUNT(*) FROM migration_quarantine').fetchone()
+
+    assert database.migrate(legacy_db) == len(database.MIGRATIONS)
+    assert legacy_db.execute('SELECT COUNT(*) FROM migration_quarantine').fetchone() == count
+
+
+def test_saved_email_passwords_are_removed(legacy_db):
+    # Settings as v12 to v14 saved them
+    for step in database.MIGRATIONS[:14]:
+        step(legacy_db)
+    legacy_db.execute('PRAGMA user_version = 14')
+    legacy_db.execute("INSERT INTO notification_settings VALUES (1, ?, '2024-03-05T08:00:00')",
+                      (json.dumps({'email_enabled': True, 'email_address': 'me@example.com', 'email_password': 'secret'}),))
+
+    database.migrate(legacy_db)
+
+    (settings,), = legacy_db.execute('SELECT settings FROM notification_settings')
+    assert json.loads(settings) == {'email_enabled': True, 'email_address': 'me@example.com'}
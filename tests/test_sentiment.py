@@ -0,0 +1,27 @@
+from common import sentiment
+
+
+def score(text):
+    return sentiment.analyze([text])[0][0]
+
+
+def test_negation_flips_the_words_after_it():
+    assert score("I am not happy") < 0
+
+
+def test_negation_stops_at_a_comma():
+    assert score("No, I feel happy today") > 0
+
+
+def test_words_after_a_negated_clause_keep_their_valence():
+    assert score("I am not happy, very sad today") < score("I am not happy")
+
+
+def test_negation_stops_at_a_sentence_break():
+    # "awful" and "anxious" are in a new sentence and stay negative
+    assert score("Not great. Feeling awful and anxious.") < score("Not great.")
+    assert sentiment.analyze(["Not great. Feeling awful and anxious."])[0][1] in ('sadness', 'anxiety')
+
+
+def test_intensifier_does_not_carry_across_punctuation():
+    assert score("very. happy") == score("happy")
@@ -0,0 +1,146 @@
+import socket
+import socketserver
+import threading
+import time
+from email.message import EmailMessage
+
+import pytest
+
+from common.notifications import SMTPTransport
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    """Just enough of an SMTP server on localhost to count sessions and messages."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeSMTPHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.quits = 0
+        self.messages = []
+        self.live = set()  # sockets of open sessions
+
+    def drop_all(self):
+        """Close every open session from the server side, as a server timing them out would."""
+        with self.lock:
+            live = list(self.live)
+        for sock in live:
+            sock.shutdown(socket.SHUT_RDWR)
+        wait_for(lambda: not self.live)
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, *lines):
+        self.wfile.write(''.join(line + '\r\n' for line in lines).encode())
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+            server.live.add(self.request)
+        try:
+            self.reply('220 localhost fake ESMTP')
+            data = None
+            for raw in self.rfile:
+                line = raw.decode().rstrip('\r\n')
+                if data is not None:
+                    if line == '.':
+                        with server.lock:
+                            server.messages.append('\n'.join(data))
+                        data = None
+                        self.reply('250 queued')
+                    else:
+                        data.append(line)
+                    continue
+                verb = line.split(' ', 1)[0].upper()
+                if verb == 'EHLO':
+                    self.reply('250-localhost', '250 AUTH PLAIN')
+                elif verb == 'AUTH':
+                    self.reply('235 authenticated')
+                elif verb == 'DATA':
+                    data = []
+                    self.reply('354 end with .')
+                elif verb == 'QUIT':
+                    with server.lock:
+                        server.quits += 1
+                    self.reply('221 bye')
+                    return
+                else:
+                    self.reply('250 ok')
+        except OSError:
+            pass
+        finally:
+            with server.lock:
+                server.live.discard(self.request)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def server():
+    server = FakeSMTPServer()
+    thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def settings(server):
+    return {'smtp_server': '127.0.0.1', 'smtp_port': server.server_address[1], 'smtp_starttls': False,
+            'email_address': 'me@example.com', 'email_password': 'app-password'}
+
+
+def message(n):
+    msg = EmailMessage()
+    msg['From'] = msg['To'] = 'me@example.com'
+    msg['Subject'] = f'Reminder {n}'
+    msg.set_content('Time to take your medication')
+    return msg
+
+
+def test_sends_share_one_session(server, settings):
+    transport = SMTPTransport()
+    try:
+        for n in range(5):
+            transport.send(message(n), settings)
+    finally:
+        transport.close()
+
+    assert server.connections == 1
+    assert len(server.messages) == 5
+    wait_for(lambda: server.quits == 1)
+
+
+def test_reconnects_after_the_server_drops_the_session(server, settings):
+    transport = SMTPTransport()
+    try:
+        transport.send(message(1), settings)
+        server.drop_all()
+        transport.send(message(2), settings)
+    finally:
+        transport.close()
+
+    assert server.connections == 2
+    assert len(server.messages) == 2
+
+
+def test_idle_sessions_are_closed(server, settings):
+    transport = SMTPTransport(idle_timeout=0.2)
+    try:
+        transport.send(message(1), settings)
+        wait_for(lambda: server.quits == 1)
+
+        transport.send(message(2), settings)
+    finally:
+        transport.close()
+
+    assert server.connections == 2